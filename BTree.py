@@ -8,7 +8,17 @@
 # Licence:     <your licence>
 #-------------------------------------------------------------------------------
 
+import bisect
+import contextlib
+import copy
+import multiprocessing.pool
+import threading
+import timeit
 import BTreeBuffer
+import BTreeAllocator
+import BTreeLayout
+
+BTREE_STATS = ('splits', 'merges', 'borrows', 'allocations', 'frees') # Counters kept by BTree.enableStats, besides the timings of the operations.
 
 class BTreeError(RuntimeError):
     '''Class to raise BTree Errors.'''
@@ -46,10 +56,23 @@ class EntryInfo(object):
 
 class BTree(object):
     '''BTree class implements a genralized BTree for the MS-PST file format.
-       It implements BTreeCreate, BTreeSearch, BTreeInsertEntry and BTreeRemoveEntry funtions.
+       It implements BTreeCreate, BTreeBulkLoad, BTreeSearch, BTreeSearchMany, BTreeScan, BTreeInsertEntry, BTreeUpdateEntry, BTreeUpsertEntry,
+       BTreeUpdateMany, BTreeRemoveEntry, BTreeRemoveRange, BTreeRemoveMany and BTreeCompact funtions.
        It can only be used as a parent class to different versions of BTrees used by the MS- PST file format.
        One needs to inherit BTree class in their child class and implement the following functions in their own class:
-       readNodeIntoBuffer, writeNodeFromBuffer, genIntermediateEntry, getChildRef, allocateNode and delNodeAllocation.'''
+       readNodeIntoBuffer, writeNodeFromBuffer, allocateNode and delNodeAllocation.
+       genIntermediateEntry and getChildRef only need to be implemented if intermediate entries are not a little-endian key
+       followed by a little-endian child reference. Otherwise entries are encoded and decoded in place by the NodeLayout of the geometry.
+       Nodes are created and deleted through a BTreeAllocator object which can be passed to the BTree to change the allocation policy.
+       Modified nodes are marked as changed in the BTreeBuffer and only changed nodes are written back (see commitNode).
+       Many insert and remove operations can be grouped into one atomic write to the PST file with 'batch'.
+       If 'pin_upper_levels' is True, the keys and child references of all intermediate nodes are kept in memory,
+       so that BTreeSearch only reads the leaf node from the PST file.
+       If 'copy_on_write' is True, nodes which readers can reach are never changed in place. All changes are made in batches,
+       and other threads search the BTree through snapshots which are not disturbed by a batch running at the same time.
+       enableStats starts counting the structural changes of the BTree, timing its operations and counting the I/O of its BTreeBuffer.
+       BTreeVerify checks the invariants of the BTree and BTreeStats reports its shape, fill and fragmentation.
+       setTracer reports every node read, write, allocation, deletion, split and restore to a tracer object, e.g. to record a trace file.'''
 
     btree_buffer = []       # A BtreeBuffer object which has to be declared outside the Btree. Passed as a parameter to initialize the BTree.
     nodeSize = 0            # The size of node including space required for metadata of node.
@@ -68,8 +91,28 @@ class BTree(object):
     leafMaxEntries = 0      # The actual maximum number of leaf entries that can be contained in a node.
     recMaxEntries = 0       # The recommended maximum number of intermediate entries that can be contained in a node.
     recLeafMaxEntries = 0   # The recommended maximum number of leaf entries that can be contained in a node.
-
-    def __init__(self, btree_buffer, nodeEntriesSize, nodeMetaData, nodeSize, entrySize, leafEntrySize, keySize, root_ref = None):
+    node_allocator = None   # The BTreeAllocator object used to create and delete nodes.
+    keyStructs = {}         # Compiled struct.Struct objects decoding all keys of a node, for each (entry size, number of entries). Shared with the layout.
+    layout = None           # The BTreeLayout.NodeLayout of the geometry of the BTree.
+    layoutEntries = False   # True if intermediate entries are encoded and decoded by the layout, i.e. genIntermediateEntry and getChildRef are not overridden.
+    pinUpperLevels = False  # True if the intermediate nodes are kept in memory in upperLevels.
+    upperLevels = None      # Maps the reference of each intermediate node to its (keys, child references). None until built by buildUpperLevels.
+    copyOnWrite = False     # True if batches write changed nodes to new nodes and only switch the published root at their end.
+    publishedRoot = None    # The root reference seen by new snapshots. Only used if copyOnWrite is True.
+    generation = 0          # Number of copy-on-write batches published so far.
+    snapshotPins = {}       # Number of open snapshots of each generation.
+    snapshotLock = None     # Lock guarding publishedRoot, generation and snapshotPins, which are shared with the snapshots.
+    retiredNodes = []       # List of (generation, node references) of the nodes replaced or deleted by the batch publishing that generation.
+    cowPrivate = None       # References of the nodes created in the current copy-on-write batch. None outside of a batch.
+    cowChanged = None       # References of the published nodes changed in the current copy-on-write batch.
+    cowRetired = None       # References of the published nodes deleted in the current copy-on-write batch.
+    stats = None            # Counters of BTREE_STATS and timings of the operations, see enableStats. None while counting is disabled.
+    timedOperations = ('BTreeCreate', 'BTreeBulkLoad', 'BTreeSearch', 'BTreeSearchMany', 'BTreeInsertEntry', 'BTreeUpdateEntry', 'BTreeUpsertEntry',
+                       'BTreeUpdateMany', 'BTreeRemoveEntry', 'BTreeRemoveRange', 'BTreeRemoveMany', 'BTreeCompact') # Operations timed by enableStats.
+    tracer = None           # The object whose traceEvent method is called for each call of the methods in traceOperations, see setTracer.
+    traceOperations = ('readNodeIntoBuffer', 'writeNodeFromBuffer', 'allocateNode', 'delNodeAllocation', 'splitNode', 'restoreNode') # Methods reported to the tracer.
+
+    def __init__(self, btree_buffer, nodeEntriesSize, nodeMetaData, nodeSize, entrySize, leafEntrySize, keySize, root_ref = None, node_allocator = None, pin_upper_levels = False, copy_on_write = False):
         self.btree_buffer = btree_buffer
         self.nodeSize = nodeSize
         self.nodeEntriesSize = nodeEntriesSize
@@ -87,6 +130,27 @@ class BTree(object):
         self.recLeafMaxEntries = int(self.nodeBucketSize / leafEntrySize)
         self.maxEntries = int(nodeEntriesSize / entrySize)
         self.leafMaxEntries = int(nodeEntriesSize / leafEntrySize)
+        if node_allocator == None:
+            node_allocator = BTreeAllocator.BTreeAllocator()
+        self.node_allocator = node_allocator
+        self.node_allocator.attach(self)
+        self.layout = BTreeLayout.nodeLayout(nodeEntriesSize, nodeMetaData, nodeSize, entrySize, leafEntrySize, keySize)
+        self.keyStructs = self.layout.keyStructs
+        self.layoutEntries = (self.layout.entryStruct != None and type(self).genIntermediateEntry.im_func is BTree.genIntermediateEntry.im_func
+                              and type(self).getChildRef.im_func is BTree.getChildRef.im_func)
+        self.pinUpperLevels = pin_upper_levels
+        self.upperLevels = None
+        self.copyOnWrite = copy_on_write
+        self.publishedRoot = root_ref
+        self.generation = 0
+        self.snapshotPins = {}
+        self.snapshotLock = threading.Lock()
+        self.retiredNodes = []
+        self.cowPrivate = None
+        self.cowChanged = None
+        self.cowRetired = None
+        self.stats = None
+        self.tracer = None
 
     def readNodeIntoBuffer(self, node_ref):
         '''A method to read BTree Node into buffer.
@@ -104,40 +168,231 @@ class BTree(object):
 
     def genIntermediateEntry(self, key, node_ref):
         '''Returns a generated Itermediate Entry with given key and reference.
-           The Intermediate entry bytearray MUST be of size non Leaf Entry (entrySize).'''
-        raise NotImplementedError, 'Implement genIntermediateEntry in class'
+           The Intermediate entry bytearray MUST be of size non Leaf Entry (entrySize).
+           By default the entry is the little-endian key followed by the little-endian reference. Override this in class for other entries.'''
+        if self.layout.entryStruct != None:
+            return self.layout.packEntry(key, node_ref)
+        return self.toLitteEndian(key, self.keySize) + self.toLitteEndian(node_ref, self.entrySize - self.keySize)
 
     def getChildRef(self, entry):
-        '''Returns the the reference to a child node in an entry.'''
-        raise NotImplementedError, 'Implement getChild in class'
+        '''Returns the the reference to a child node in an entry.
+           By default the reference is the little-endian number following the key. Override this in class for other entries.'''
+        if self.layout.childRefStruct != None:
+            return self.layout.childRefStruct.unpack_from(entry, self.keySize)[0]
+        return self.toBigEndian(entry[self.keySize:])
+
+    def nodeChildRef(self, currentNode, position):
+        '''Returns the reference to the child node of the entry at 'position' of the given intermediate node.
+           The reference is decoded in place by the layout, unless getChildRef is overridden.'''
+        if self.layoutEntries:
+            return self.layout.childRef(currentNode, position)
+        return self.getChildRef(currentNode[self.nbind(position) : self.nbind(position) + self.entrySize])
 
     def allocateNode(self):
         '''Returns an reference where a new node can can be written to.'''
         raise NotImplementedError, 'Implement allocateNode in class'
 
     def delNodeAllocation(self, node_ref):
-        '''Deletes a given node and its allocation.'''
+        '''Deletes a given node and its allocation.
+           The cached copy of the node has already been dropped from the BTreeBuffer, so the node can be marked deleted in the PST file directly.'''
         raise NotImplementedError, 'Implement delNodeAllocation in class'
 
-    def createNode(self, level):
+    def isDeletedNode(self, currentNode):
+        '''Returns True if the given node carries the deletion marker written by delNodeAllocation.
+           Allocators which reuse deleted nodes use this to find them in the PST file.
+           Implement this in class if the deletion marker of nodes can be recognised.'''
+        return False
+
+    def createNode(self, level, near_ref = None, node_ref = None):
         '''Creates an empty new node with required metadata.
            The level given as a parameter is maintained to be the level of the creaed node.
+           The node is preferably allocated close to the node referenced by 'near_ref'.
+           If 'node_ref' is given, the node is created there instead of allocating it.
            Returns the information of the created node.'''
+        self.checkCopyOnWrite()
         buffer_number = self.btree_buffer.getBuffer()
         currentArray = self.btree_buffer.BufferList[buffer_number]
         self.clearArray(currentArray)
-        currentArray[self.cEntIndex] = 0
         if level == 0:
-            currentArray[self.cEntMaxIndex] = self.leafMaxEntries
-            currentArray[self.cbEntMaxIndex] = self.leafEntrySize
-            currentArray[self.cLevelIndex] = 0
+            self.layout.writeMetadata(currentArray, 0, self.leafMaxEntries, self.leafEntrySize, 0)
         else:
-            currentArray[self.cEntMaxIndex] = self.maxEntries
-            currentArray[self.cbEntMaxIndex] = self.entrySize
-            currentArray[self.cLevelIndex] = level
-        node_ref = self.allocateNode()
+            self.layout.writeMetadata(currentArray, 0, self.maxEntries, self.entrySize, level)
+        if node_ref == None:
+            node_ref = self.node_allocator.allocate(near_ref)
+            if self.stats != None:
+                self.stats['allocations'] = self.stats['allocations'] + 1
+        if self.cowPrivate != None:
+            self.cowPrivate.add(node_ref)
+        self.btree_buffer.markChanged(buffer_number)
         return NodeLocationInfo(buffer_number, node_ref)
 
+    def markChanged(self, currentNode):
+        '''Marks the given buffered node as modified, so that commitNode writes it back.'''
+        self.btree_buffer.markChanged(self.btree_buffer.bufferNumberOf(currentNode))
+
+    def commitNode(self, buffer_number, node_ref):
+        '''Writes the node held by the given buffer to the PST file through writeNodeFromBuffer, but only if it was modified.
+           In copy-on-write mode, a published node written in place is moved to a new node when the batch ends (see relocateChanges).'''
+        if self.btree_buffer.isChanged(buffer_number):
+            self.checkCopyOnWrite()
+            if self.cowPrivate != None and node_ref not in self.cowPrivate:
+                self.cowChanged.add(node_ref)
+            self.writeNodeFromBuffer(buffer_number, node_ref)
+            self.btree_buffer.clearChanged(buffer_number)
+            if self.upperLevels != None:
+                self.pinNode(self.btree_buffer.BufferList[buffer_number], node_ref)
+
+    def freeNode(self, node_ref):
+        '''Deletes a node through the node allocator and forgets it in the pinned intermediate nodes.
+           Its cached copy is dropped first, so that a stale copy is never written back over the deleted or reused node.
+           In copy-on-write mode, a published node is only deleted once no snapshot can reach it (see reclaimNodes).'''
+        self.checkCopyOnWrite()
+        if self.cowPrivate != None and node_ref not in self.cowPrivate:
+            self.cowChanged.discard(node_ref)
+            self.cowRetired.append(node_ref)
+        else:
+            self.btree_buffer.discardNode(node_ref)
+            self.node_allocator.free(node_ref)
+            if self.stats != None:
+                self.stats['frees'] = self.stats['frees'] + 1
+        if self.upperLevels != None:
+            self.upperLevels.pop(node_ref, None)
+
+    def buildUpperLevels(self):
+        '''Reads every intermediate node of the BTree once, from the root down, and pins its keys and child references in upperLevels.
+           Leaf nodes are not read. Afterwards upperLevels is kept up to date by commitNode and freeNode.'''
+        self.upperLevels = {}
+        if self.root_ref == None:
+            return
+        node_refs = [self.root_ref]
+        while node_refs:
+            node_ref = node_refs.pop()
+            buffer_number = self.readNodeIntoBuffer(node_ref)
+            currentNode = self.btree_buffer.BufferList[buffer_number]
+            self.pinNode(currentNode, node_ref)
+            if currentNode[self.cLevelIndex] > 1:
+                node_refs.extend(self.upperLevels[node_ref][1])
+            self.btree_buffer.returnBuffer(buffer_number)
+        self.btree_buffer.resetBuffer()
+
+    def resetUpperLevels(self):
+        '''Drops the pinned intermediate nodes. They are built again from root_ref on the next search.
+           Must be called if root_ref or the nodes of the BTree are changed other than through this object.'''
+        self.upperLevels = None
+
+    def pinNode(self, currentNode, node_ref):
+        '''Updates the pinned keys and child references of the given node. Leaf nodes are not pinned.'''
+        if currentNode[self.cLevelIndex] == 0:
+            self.upperLevels.pop(node_ref, None)
+        else:
+            child_refs = [self.nodeChildRef(currentNode, position) for position in range(currentNode[self.cEntIndex])]
+            self.upperLevels[node_ref] = (list(self.getNodeKeys(currentNode, self.nbind)), child_refs)
+
+    def findLeafRef(self, key):
+        '''Returns the reference of the leaf node where 'key' is or would be stored, using only the pinned intermediate nodes.'''
+        if self.upperLevels == None:
+            self.buildUpperLevels()
+        node_ref = self.root_ref
+        while node_ref in self.upperLevels:
+            keys, child_refs = self.upperLevels[node_ref]
+            position = bisect.bisect_left(keys, key)
+            if position == len(keys) or keys[position] != key:
+                # The key is in the child before the tentative position, or in the first child if the key is below the first key.
+                position = max(position - 1, 0)
+            node_ref = child_refs[position]
+        return node_ref
+
+    def enableStats(self):
+        '''Starts counting the splits, merges and borrows of nodes and the nodes allocated and freed, from zero,
+           and timing each call of the operations in timedOperations, including the calls made by other operations.
+           The counting of the BTreeBuffer is started as well (see BTreeBuffer.enableStats).
+           While disabled, counting costs a single test per counted event and the operations are not wrapped at all.'''
+        self.stats = dict.fromkeys(BTREE_STATS, 0)
+        self.stats['operations'] = {}
+        for name in self.timedOperations:
+            setattr(self, name, self.timedOperation(name, getattr(type(self), name)))
+        self.btree_buffer.enableStats()
+
+    def disableStats(self):
+        '''Stops counting and timing, and stops the counting of the BTreeBuffer.'''
+        self.stats = None
+        self.removeTimers()
+        self.btree_buffer.disableStats()
+
+    def resetStats(self):
+        '''Sets all counters and timings back to zero, if counting is enabled.'''
+        if self.stats != None:
+            self.enableStats()
+
+    def getStats(self):
+        '''Returns a snapshot of the counters as a dictionary, or None if counting is disabled.
+           'operations' maps the name of each operation called to its 'count', total 'seconds' and 'max_seconds',
+           and 'buffer' holds the counters of the BTreeBuffer.'''
+        if self.stats == None:
+            return None
+        snapshot = dict(self.stats)
+        snapshot['operations'] = dict((name, dict(timing)) for name, timing in self.stats['operations'].items())
+        snapshot['buffer'] = self.btree_buffer.getStats()
+        return snapshot
+
+    def timedOperation(self, name, function):
+        '''Returns a wrapper of the unbound method 'function' which adds the wall time of each call to the timings of operation 'name'.'''
+        def timed(*args, **kwargs):
+            start = timeit.default_timer()
+            try:
+                return function(self, *args, **kwargs)
+            finally:
+                seconds = timeit.default_timer() - start
+                if self.stats != None:
+                    timing = self.stats['operations'].setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+                    timing['count'] = timing['count'] + 1
+                    timing['seconds'] = timing['seconds'] + seconds
+                    timing['max_seconds'] = max(timing['max_seconds'], seconds)
+        return timed
+
+    def removeTimers(self):
+        '''Removes the wrappers installed by enableStats, so that the operations are called directly again.'''
+        for name in self.timedOperations:
+            self.__dict__.pop(name, None)
+
+    def setTracer(self, tracer):
+        '''Reports each call of the methods in traceOperations to 'tracer', or stops reporting if 'tracer' is None.
+           After each call, tracer.traceEvent(operation, node_ref, level, seconds) is called with the name of the method,
+           the reference and BTree level of the node it worked on, and its wall time. The level is -1 for allocateNode and delNodeAllocation,
+           which do not know it. The methods are only wrapped while a tracer is set, and the tracer must be thread safe
+           if the BTree is used by many threads. See BTreeTrace.BTreeTraceRecorder for a tracer writing the events to a trace file.'''
+        self.tracer = tracer
+        for name in self.traceOperations:
+            self.__dict__.pop(name, None)
+        if tracer != None:
+            for name in self.traceOperations:
+                setattr(self, name, self.tracedOperation(name, getattr(type(self), name)))
+
+    def tracedOperation(self, name, function):
+        '''Returns a wrapper of the unbound method 'function' which reports each call to the tracer as operation 'name'.'''
+        def traced(*args):
+            start = timeit.default_timer()
+            result = function(self, *args)
+            seconds = timeit.default_timer() - start
+            node_ref, level = self.traceTarget(name, args, result)
+            self.tracer.traceEvent(name, node_ref, level, seconds)
+            return result
+        return traced
+
+    def traceTarget(self, name, args, result):
+        '''Returns the (node reference, level) of the node a call of the traced method 'name' with 'args' returning 'result' worked on.'''
+        if name == 'readNodeIntoBuffer':
+            return args[0], self.btree_buffer.BufferList[result][self.cLevelIndex]
+        if name == 'writeNodeFromBuffer':
+            return args[1], self.btree_buffer.BufferList[args[0]][self.cLevelIndex]
+        if name == 'allocateNode':
+            return result, -1
+        if name == 'delNodeAllocation':
+            return args[0], -1
+        if name == 'splitNode':
+            return args[5], args[4]
+        return args[1], args[5] - 1 # restoreNode restores the child node of the node at level args[5].
+
     def nbind(self, position):
         '''Returns the actual index (Node Bytearray Index) of the non-leaf entry.
            The 'position' parameter indicates the position of the entry in the node.'''
@@ -150,6 +405,8 @@ class BTree(object):
 
     def getKey(self, currentNode, key_index):
         '''Returns a key present in the given location.'''
+        if self.layout.keyStruct != None:
+            return self.layout.keyStruct.unpack_from(currentNode, key_index)[0]
         key_bytearray = currentNode[key_index:(key_index + self.keySize)]
         return self.toBigEndian(key_bytearray)
 
@@ -164,6 +421,8 @@ class BTree(object):
 
     def toBigEndian(self, bytelist):
         '''Converts a given bytearray in Little-Endian format to an int in Big-Endian format.'''
+        if isinstance(bytelist, bytearray) and len(bytelist) in BTreeLayout.INT_STRUCTS:
+            return BTreeLayout.INT_STRUCTS[len(bytelist)].unpack_from(bytelist)[0]
         result = 0
         shift = 0
         for byte in bytelist:
@@ -173,6 +432,9 @@ class BTree(object):
 
     def toLitteEndian(self, number, size):
         '''Converts an int in Big-Endian to a bytearray in Litte-Endian format.'''
+        if size in BTreeLayout.INT_STRUCTS:
+            # Bits above 'size' bytes are dropped, as below.
+            return bytearray(BTreeLayout.INT_STRUCTS[size].pack(number & ((1 << (8 * size)) - 1)))
         result_array = bytearray(size)
         count = 0
         while count < size:
@@ -183,71 +445,742 @@ class BTree(object):
 
     def clearArray(self, currentArray):
         '''Utility fuction to clear an array, i.e. fill all array entries with 0.'''
-        count = 0
-        while count < len(currentArray):
-            currentArray[count] = 0
-            count = count + 1
+        currentArray[:] = bytearray(len(currentArray))
 
     def BTreeCreate(self):
         '''Returns the root reference of a new BTree with an empty root node.'''
         node_loc = self.createNode(0)
         self.root_ref = node_loc.location_infile
-        self.writeNodeFromBuffer(node_loc.buffer_number, node_loc.location_infile)
+        self.commitNode(node_loc.buffer_number, node_loc.location_infile)
+        self.btree_buffer.resetBuffer()
+        return self.root_ref
+
+    @contextlib.contextmanager
+    def batch(self, wal_path = None, root_writer = None):
+        '''Context manager grouping the BTree operations run inside it into a single commit, e.g.
+               with btree.batch():
+                   btree.BTreeInsertEntry(new_entry)
+                   btree.BTreeRemoveEntry(key)
+           Modified nodes are kept in memory and written together through the write-ahead log at 'wal_path' when the block ends
+           (see BTreeBuffer.commitBatch). If the block raises an exception nothing is written and the root reference is restored.
+           'root_writer' is called with the final root_ref just before the commit, to store the root reference wherever the file keeps it
+           through the BTreeBuffer. The write is then part of the commit, so a crash never leaves the stored root reference
+           pointing at a tree which a split or collapse of the root changed in the batch. Without it, storing the root reference
+           after the block is left to the caller and is not covered by the commit.
+           In copy-on-write mode the changed nodes are moved to new nodes before the commit and the new root is published after it.'''
+        root_ref = self.root_ref
+        self.btree_buffer.beginBatch(wal_path)
+        if self.copyOnWrite:
+            self.cowPrivate = set()
+            self.cowChanged = set()
+            self.cowRetired = []
+            reclaimed = self.reclaimNodes()
+        try:
+            yield self
+            if self.copyOnWrite:
+                retired = self.relocateChanges()
+            if root_writer != None:
+                root_writer(self.root_ref)
+        except:
+            self.btree_buffer.abortBatch()
+            self.root_ref = root_ref
+            self.node_allocator.reset()
+            self.resetUpperLevels()
+            if self.copyOnWrite:
+                self.retiredNodes[:0] = reclaimed
+                self.cowPrivate = self.cowChanged = self.cowRetired = None
+            raise
+        self.btree_buffer.commitBatch()
+        if self.copyOnWrite:
+            self.cowPrivate = self.cowChanged = self.cowRetired = None
+            self.publishRoot(retired)
+
+    def checkCopyOnWrite(self):
+        '''Raises BTreeError if a node is about to be changed in copy-on-write mode outside of a batch.
+           Nodes changed in the buffers so far are thrown away first.'''
+        if self.copyOnWrite and self.cowPrivate == None:
+            self.btree_buffer.dropCache()
+            raise BTreeError, 'copy-on-write btree can only be changed in a batch'
+
+    @contextlib.contextmanager
+    def snapshot(self):
+        '''Context manager giving a view of the BTree as published by the last copy-on-write batch, e.g.
+               with btree.snapshot() as view:
+                   value = view.BTreeSearch(key)
+           The nodes reachable from the view are not deleted until the block ends, so a batch can run at the same time.
+           The view must only be searched and scanned, by one thread. Threads sharing the PST file need a BTreeBufferPool
+           whose buffers do not cache nodes, as deleted nodes are reused by later batches.'''
+        if not self.copyOnWrite:
+            raise BTreeError, 'snapshots need a copy-on-write btree'
+        view = copy.copy(self)
+        view.removeTimers()
+        view.stats = None
+        view.setTracer(self.tracer)
+        view.pinUpperLevels = False
+        view.upperLevels = None
+        with self.snapshotLock:
+            generation = self.generation
+            view.generation = generation
+            view.root_ref = self.publishedRoot
+            self.snapshotPins[generation] = self.snapshotPins.get(generation, 0) + 1
+        try:
+            yield view
+        finally:
+            with self.snapshotLock:
+                self.snapshotPins[generation] = self.snapshotPins[generation] - 1
+                if self.snapshotPins[generation] == 0:
+                    del self.snapshotPins[generation]
+
+    def publishRoot(self, retired):
+        '''Makes root_ref the root seen by new snapshots, starting a new generation.
+           The given node references, which only older generations reach, are deleted once their snapshots are closed.'''
+        with self.snapshotLock:
+            self.publishedRoot = self.root_ref
+            self.generation = self.generation + 1
+        if retired:
+            self.retiredNodes.append((self.generation, retired))
+
+    def reclaimNodes(self):
+        '''Deletes the retired nodes which no open snapshot can reach. Returns the list of entries removed from retiredNodes.'''
+        with self.snapshotLock:
+            oldest = min(self.snapshotPins) if self.snapshotPins else self.generation
+        reclaimed = []
+        while self.retiredNodes and self.retiredNodes[0][0] <= oldest:
+            reclaimed.append(self.retiredNodes.pop(0))
+            for node_ref in reclaimed[-1][1]:
+                self.btree_buffer.discardNode(node_ref)
+                self.node_allocator.free(node_ref)
+                if self.stats != None:
+                    self.stats['frees'] = self.stats['frees'] + 1
+        return reclaimed
+
+    def relocateChanges(self):
+        '''Moves every published node changed in the current copy-on-write batch, and every node above it, to a newly allocated node,
+           so that the published nodes are left as they are in the PST file. Each changed node is found by descending from the root with its first key.
+           Returns the references of the published nodes which are no longer part of the BTree.'''
+        self.btree_buffer.resetBuffer()
+        node_levels = {} # Level of each node on a path from the root to a changed node.
+        for node_ref in self.cowChanged:
+            buffer_number = self.readNodeIntoBuffer(node_ref)
+            currentNode = self.btree_buffer.BufferList[buffer_number]
+            level = currentNode[self.cLevelIndex]
+            ent_count = currentNode[self.cEntIndex]
+            first_key = self.getKey(currentNode, 0)
+            self.btree_buffer.returnBuffer(buffer_number)
+            node_levels[node_ref] = level
+            if node_ref == self.root_ref:
+                continue
+            if ent_count == 0:
+                raise BTreeError, 'changed node is not reachable from the root'
+            path = self.descendPath(self.root_ref, first_key)
+            if len(path) <= level or path[len(path) - level - 1][0] != node_ref:
+                raise BTreeError, 'changed node is not reachable from the root'
+            for depth in range(len(path) - level - 1):
+                node_levels[path[depth][0]] = len(path) - depth - 1
+            self.releasePath(path)
+
+        moved = {}
+        for node_ref in node_levels:
+            if node_ref not in self.cowPrivate:
+                moved[node_ref] = self.node_allocator.allocate(node_ref)
+                if self.stats != None:
+                    self.stats['allocations'] = self.stats['allocations'] + 1
+                self.cowPrivate.add(moved[node_ref])
+        for node_ref, level in node_levels.items():
+            buffer_number = self.readNodeIntoBuffer(node_ref)
+            currentNode = self.btree_buffer.BufferList[buffer_number]
+            for position in range(currentNode[self.cEntIndex] if level > 0 else 0):
+                entryIndex = self.nbind(position)
+                child_ref = self.nodeChildRef(currentNode, position)
+                if child_ref in moved:
+                    self.updateChildEntry(currentNode, position, self.getKey(currentNode, entryIndex), moved[child_ref])
+            if node_ref in moved:
+                self.btree_buffer.markChanged(buffer_number)
+            self.commitNode(buffer_number, moved.get(node_ref, node_ref))
+            self.btree_buffer.returnBuffer(buffer_number)
+        self.btree_buffer.resetBuffer()
+
+        retired = moved.keys() + self.cowRetired
+        for node_ref in retired:
+            self.btree_buffer.discardNode(node_ref)
+            self.btree_buffer.unstageWrite(node_ref, self.nodeSize)
+            if self.upperLevels != None:
+                self.upperLevels.pop(node_ref, None)
+        self.root_ref = moved.get(self.root_ref, self.root_ref)
+        return retired
+
+    def BTreeBulkLoad(self, entries, fill_factor = 1.0):
+        '''Builds a new BTree bottom-up from leaf entries given in strictly increasing key order.
+           'entries' can be any iterable of leaf entries (bytearrays of leaf entry size) and is consumed as a stream.
+           Nodes are filled to 'fill_factor' times the recommended maximum number of entries and every node is written exactly once.
+           The existing tree, if any, is left untouched. Returns the root reference of the new BTree.'''
+        if fill_factor <= 0 or fill_factor > 1:
+            raise BTreeError, 'Fill factor must be greater than 0 and at most 1.'
+
+        pending = []        # Entries waiting to be written into a node, for each level.
+        node_counts = []    # Number of nodes written so far, for each level.
+        last_entry = []     # Intermediate entry generated for the last node written, for each level.
+        prev_key = None
+
+        for new_entry in entries:
+            new_entry = bytearray(new_entry)
+            if len(new_entry) != self.leafEntrySize:
+                raise BTreeError, 'Size of new entry does not match expected entry size.'
+            key = self.getKey(new_entry, 0)
+            if prev_key != None and key <= prev_key:
+                raise BTreeError, 'Entries for bulk load are not in strictly increasing key order.'
+            prev_key = key
+            self.bulkAddEntry(pending, node_counts, last_entry, 0, new_entry, fill_factor)
+
+        if prev_key == None:
+            return self.BTreeCreate()
+
+        # Every level keeps up to two nodes worth of entries so that the last two nodes of a level can share its remaining entries.
+        # They are written as one node if they fit into it, as halves of more than the recommended maximum are never below the minimum.
+        level = 0
+        while True:
+            max_ents = self.recMaxEntries
+            if level == 0:
+                max_ents = self.recLeafMaxEntries
+            remaining = pending[level]
+            pending[level] = []
+            if len(remaining) > max_ents:
+                left_ents = len(remaining) - len(remaining)/2
+                self.bulkWriteNode(pending, node_counts, last_entry, level, remaining[:left_ents], fill_factor)
+                self.bulkWriteNode(pending, node_counts, last_entry, level, remaining[left_ents:], fill_factor)
+            elif remaining:
+                self.bulkWriteNode(pending, node_counts, last_entry, level, remaining, fill_factor)
+            if node_counts[level] == 1:
+                break
+            level = level + 1
+
+        self.root_ref = self.getChildRef(last_entry[level])
+        self.resetUpperLevels()
         self.btree_buffer.resetBuffer()
         return self.root_ref
 
+    def bulkCapacity(self, level, fill_factor):
+        '''Returns the number of entries BTreeBulkLoad puts into a node of the given level.
+           This is never below the minimum number of entries maintained by BTreeRemoveEntry.'''
+        max_ents = self.recMaxEntries
+        if level == 0:
+            max_ents = self.recLeafMaxEntries
+        return max(2, (max_ents - 1)/2 + 1, int(max_ents * fill_factor))
+
+    def bulkAddEntry(self, pending, node_counts, last_entry, level, new_entry, fill_factor):
+        '''Adds an entry to the given level of a bulk load, writing a node once two nodes worth of entries are pending.'''
+        if level == len(pending):
+            pending.append([])
+            node_counts.append(0)
+            last_entry.append(None)
+        pending[level].append(new_entry)
+        capacity = self.bulkCapacity(level, fill_factor)
+        if len(pending[level]) == 2 * capacity:
+            node_entries = pending[level][:capacity]
+            pending[level] = pending[level][capacity:]
+            self.bulkWriteNode(pending, node_counts, last_entry, level, node_entries, fill_factor)
+
+    def bulkWriteNode(self, pending, node_counts, last_entry, level, node_entries, fill_factor):
+        '''Writes a new node of the given level holding 'node_entries' and passes its intermediate entry to the level above.'''
+        near_ref = None
+        if last_entry[level] != None:
+            near_ref = self.getChildRef(last_entry[level])
+        node_ref = self.writeNewNode(level, node_entries, near_ref)
+
+        node_counts[level] = node_counts[level] + 1
+        last_entry[level] = self.genIntermediateEntry(self.getKey(node_entries[0], 0), node_ref)
+        # If this turns out to be the only node of its level, it becomes the root and the entry is left unused.
+        self.bulkAddEntry(pending, node_counts, last_entry, level + 1, last_entry[level], fill_factor)
+
+    def writeNewNode(self, level, node_entries, near_ref = None, node_ref = None):
+        '''Creates a new node of the given level holding 'node_entries', in order, and writes it.
+           'near_ref' and 'node_ref' are passed to createNode. Returns the reference of the new node.'''
+        node_loc = self.createNode(level, near_ref, node_ref)
+        currentNode = self.btree_buffer.BufferList[node_loc.buffer_number]
+        index = 0
+        for entry in node_entries:
+            currentNode[index : index + len(entry)] = entry
+            index = index + len(entry)
+        currentNode[self.cEntIndex] = len(node_entries)
+        self.commitNode(node_loc.buffer_number, node_loc.location_infile)
+        self.btree_buffer.returnBuffer(node_loc.buffer_number)
+        return node_loc.location_infile
+
+    def BTreeCompact(self, fill_factor = 1.0):
+        '''Rewrites the BTree into new nodes laid out in breadth-first order, i.e. the root node first and the leaf nodes last in key order.
+           The leaf entries are streamed twice in key order: once to count them and once to pack them into nodes filled
+           to 'fill_factor' times the recommended maximum number of entries, as in BTreeBulkLoad, but never below the minimum (see compactNodeCount).
+           The new nodes are taken from allocateNode rather than from the node allocator, so that they form one contiguous region
+           when allocateNode hands out consecutive references. Once the new BTree is written, root_ref is switched to it
+           and the nodes of the old BTree are deleted. Run it inside 'batch' to switch atomically in the PST file.
+           Returns the root reference of the new BTree.'''
+        if self.root_ref == None:
+            raise BTreeError, 'btree does not exist'
+        if fill_factor <= 0 or fill_factor > 1:
+            raise BTreeError, 'Fill factor must be greater than 0 and at most 1.'
+
+        ent_count = 0
+        for key, value in self.BTreeScan():
+            ent_count = ent_count + 1
+
+        # The number of nodes of each level, from the leaf nodes up to the root node.
+        node_counts = [self.compactNodeCount(0, ent_count, fill_factor)]
+        while node_counts[-1] > 1:
+            node_counts.append(self.compactNodeCount(len(node_counts), node_counts[-1], fill_factor))
+
+        node_refs = [None] * len(node_counts)
+        for level in reversed(range(len(node_counts))):
+            node_refs[level] = [self.allocateNode() for count in range(node_counts[level])]
+        if self.stats != None:
+            self.stats['allocations'] = self.stats['allocations'] + sum(node_counts)
+
+        # Entries are spread evenly over the nodes of each level.
+        first_keys = []
+        entries = self.BTreeScan()
+        try:
+            for position in range(node_counts[0]):
+                node_entries = []
+                for count in range(self.compactNodeSize(ent_count, node_counts[0], position)):
+                    key, value = entries.next()
+                    node_entries.append(self.toLitteEndian(key, self.keySize) + value)
+                self.writeNewNode(0, node_entries, None, node_refs[0][position])
+                if node_entries:
+                    first_keys.append(self.getKey(node_entries[0], 0))
+        finally:
+            entries.close()
+
+        for level in range(1, len(node_counts)):
+            child_entries = [self.genIntermediateEntry(key, child_ref) for key, child_ref in zip(first_keys, node_refs[level - 1])]
+            first_keys = []
+            index = 0
+            for position in range(node_counts[level]):
+                node_entries = child_entries[index : index + self.compactNodeSize(len(child_entries), node_counts[level], position)]
+                index = index + len(node_entries)
+                self.writeNewNode(level, node_entries, None, node_refs[level][position])
+                first_keys.append(self.getKey(node_entries[0], 0))
+
+        old_root_ref = self.root_ref
+        buffer_number = self.readNodeIntoBuffer(old_root_ref)
+        old_root_level = self.btree_buffer.BufferList[buffer_number][self.cLevelIndex]
+        self.btree_buffer.returnBuffer(buffer_number)
+        self.root_ref = node_refs[-1][0]
+        self.freeSubtree(old_root_ref, old_root_level)
+        self.resetUpperLevels()
+        self.btree_buffer.resetBuffer()
+        return self.root_ref
+
+    def compactNodeCount(self, level, ent_count, fill_factor):
+        '''Returns the number of nodes BTreeCompact spreads 'ent_count' entries of the given level over.
+           The nodes are filled to bulkCapacity as far as possible, but every node gets at least the minimum number of entries
+           maintained by BTreeRemoveEntry and at most the recommended maximum. A single node, the root node, may hold fewer.'''
+        max_ents = self.recMaxEntries
+        if level == 0:
+            max_ents = self.recLeafMaxEntries
+        node_count = min(-(-ent_count // self.bulkCapacity(level, fill_factor)), ent_count // ((max_ents - 1)/2 + 1))
+        return max(1, -(-ent_count // max_ents), node_count)
+
+    def compactNodeSize(self, ent_count, node_count, position):
+        '''Returns the number of entries BTreeCompact puts into the node at the given position of a level,
+           when 'ent_count' entries are spread evenly over 'node_count' nodes.'''
+        return ent_count // node_count + (1 if position < ent_count % node_count else 0)
+
+    def BTreeVerify(self, check_occupancy = True, threads = 0, max_problems = 100):
+        '''Checks the invariants of the BTree and returns the list of problems found, which is empty if the BTree is sound.
+           See BTreeStats for how the BTree is walked and for 'threads'. At most 'max_problems' problems are returned.
+           Nodes left with fewer entries than BTreeRemoveEntry maintains are only reported if 'check_occupancy' is True.'''
+        return self.BTreeStats(check_occupancy, threads, max_problems)['problems']
+
+    def BTreeStats(self, check_occupancy = True, threads = 0, max_problems = 100):
+        '''Walks the BTree once, one level at a time with the nodes of each level read in file-offset order, checks its invariants
+           and returns a dictionary of statistics:
+           'height', the number of leaf 'entries', the 'node_counts' of each level from the leaf level up,
+           the 'fill_histogram' of each level, counting the nodes whose entries fill 0-10%, 10-20%, ... 90-100% of nodeEntriesSize,
+           and the average 'fill_factors' of each level. Fragmentation is given by 'leaf_breaks', the number of leaf nodes
+           not followed in key order by the node right after them in the file, 'fragmentation', the fraction of leaf nodes which are,
+           and 'density', the share of the file region spanned by the nodes which is taken by them.
+           'problems' lists up to 'max_problems' invariant violations, 'problem_count' counts all of them, and 'underfull_nodes'
+           counts the nodes with fewer entries than BTreeRemoveEntry maintains. A node which cannot be read is reported as a problem
+           and the walk carries on without its subtree.
+           Every node is read once and returned to the BTreeBuffer straight away, so only a few buffers are used at a time.
+           If 'threads' is given, the subtrees below the root node are walked by that many threads at once.
+           The BTree must then be buffered by a BTreeBufferPool, as for BTreeAsync.'''
+        if self.root_ref == None:
+            raise BTreeError, 'btree does not exist'
+        if threads and not isinstance(self.btree_buffer, BTreeBuffer.BTreeBufferPool):
+            raise BTreeError, 'walking subtrees in parallel needs a btree buffered by a BTreeBufferPool'
+        report = self.newTreeReport()
+        # The root node is checked on its own, as it is the only node which may be empty or below the minimum number of entries.
+        children = []
+        height = self.checkNode((self.root_ref, None, None, None, None, False), report, children, check_occupancy, max_problems)
+        self.btree_buffer.resetBuffer()
+        if height == None:
+            self.finishTreeReport(report)
+            return report
+        report['height'] = height + 1
+        if threads and len(children) > 1:
+            # Each thread walks a run of subtrees which are next to each other in key order.
+            run_size = -(-len(children) // (threads * 4))
+            runs = [children[index : index + run_size] for index in range(0, len(children), run_size)]
+            pool = multiprocessing.pool.ThreadPool(threads)
+            try:
+                subtree_reports = pool.map(lambda run: self.walkLevels(run, check_occupancy, max_problems), runs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            subtree_reports = [self.walkLevels(children, check_occupancy, max_problems)]
+        for subtree_report in subtree_reports:
+            self.mergeTreeReports(report, subtree_report, max_problems)
+        self.finishTreeReport(report)
+        return report
+
+    def newTreeReport(self):
+        '''Returns an empty report of BTreeStats.'''
+        return {'height': 0, 'entries': 0, 'node_counts': [], 'fill_histogram': [], 'fill_factors': [], 'underfull_nodes': 0,
+                'problems': [], 'problem_count': 0, 'leaf_breaks': 0, 'fragmentation': 0.0, 'density': 1.0,
+                'first_leaf': None, 'last_leaf': None, 'lowest_ref': None, 'highest_ref': None}
+
+    def walkLevels(self, tasks, check_occupancy, max_problems):
+        '''Checks the nodes of the given tasks and all nodes below them, one level at a time, and returns their report.
+           A task is (node_ref, level, first_key, low_key, high_key, has_siblings), as made by checkNode for each child of a node.
+           The nodes of a level are sorted by key to follow the leaf nodes in key order, and by reference to read them in file order.'''
+        report = self.newTreeReport()
+        while tasks:
+            tasks.sort(key = lambda task: task[2])
+            if tasks[0][1] == 0:
+                self.countLeafBreaks(report, [task[0] for task in tasks])
+            tasks.sort()
+            next_tasks = []
+            previous_ref = None
+            for task in tasks:
+                if task[0] == previous_ref:
+                    self.addProblem(report, task[0], 'is referenced more than once', max_problems)
+                else:
+                    self.checkNode(task, report, next_tasks, check_occupancy, max_problems)
+                    self.btree_buffer.resetBuffer()
+                previous_ref = task[0]
+            tasks = next_tasks
+        return report
+
+    def checkNode(self, task, report, children, check_occupancy, max_problems):
+        '''Reads the node of a task of walkLevels, checks it, adds it to the report and appends the tasks of its children to 'children'.
+           Returns the level of the node, or None if the node could not be checked.
+           A node which cannot be read, e.g. as it lies beyond the end of the PST file, is reported as a problem.'''
+        node_ref, level, first_key, low_key, high_key, has_siblings = task
+        try:
+            buffer_number = self.readNodeIntoBuffer(node_ref)
+        except BTreeBuffer.BTreeBufferException, error:
+            self.addProblem(report, node_ref, 'cannot be read: %s' % error, max_problems)
+            return None
+        currentNode = self.btree_buffer.BufferList[buffer_number]
+        try:
+            if self.isDeletedNode(currentNode):
+                self.addProblem(report, node_ref, 'is a deleted node', max_problems)
+                return None
+            node_level = currentNode[self.cLevelIndex]
+            if level == None:
+                level = node_level
+            elif node_level != level:
+                self.addProblem(report, node_ref, 'has cLevel %d instead of %d, so the leaf nodes are not all at the same depth' % (node_level, level), max_problems)
+                return None
+
+            ent_size, max_ents, rec_max_ents, bind = self.entrySize, self.maxEntries, self.recMaxEntries, self.nbind
+            if level == 0:
+                ent_size, max_ents, rec_max_ents, bind = self.leafEntrySize, self.leafMaxEntries, self.recLeafMaxEntries, self.lnbind
+            if currentNode[self.cEntMaxIndex] != max_ents:
+                self.addProblem(report, node_ref, 'has cEntMax %d instead of %d' % (currentNode[self.cEntMaxIndex], max_ents), max_problems)
+            if currentNode[self.cbEntMaxIndex] != ent_size:
+                self.addProblem(report, node_ref, 'has cbEntMax %d instead of %d' % (currentNode[self.cbEntMaxIndex], ent_size), max_problems)
+            ent_count = currentNode[self.cEntIndex]
+            if ent_count > max_ents:
+                self.addProblem(report, node_ref, 'has cEnt %d above the maximum of %d' % (ent_count, max_ents), max_problems)
+                return None
+            if ent_count == 0 and (first_key != None or level > 0):
+                self.addProblem(report, node_ref, 'has no entries', max_problems)
+            elif has_siblings and ent_count <= (rec_max_ents - 1)/2:
+                report['underfull_nodes'] = report['underfull_nodes'] + 1
+                if check_occupancy:
+                    self.addProblem(report, node_ref, 'has %d entries, below the minimum of %d' % (ent_count, (rec_max_ents - 1)/2 + 1), max_problems)
+
+            keys = self.getNodeKeys(currentNode, bind)
+            if first_key != None and keys and keys[0] != first_key:
+                self.addProblem(report, node_ref, 'starts with key 0x%x but its parent entry has key 0x%x' % (keys[0], first_key), max_problems)
+            for position in range(1, len(keys)):
+                if keys[position] <= keys[position - 1]:
+                    self.addProblem(report, node_ref, 'has keys out of order at position %d' % position, max_problems)
+                    break
+            if keys and ((low_key != None and keys[0] < low_key) or (high_key != None and keys[-1] >= high_key)):
+                self.addProblem(report, node_ref, 'has keys outside of the range of its parent entry', max_problems)
+
+            self.countNode(report, node_ref, level, ent_count * ent_size)
+            if level == 0:
+                report['entries'] = report['entries'] + ent_count
+            else:
+                for position in range(ent_count):
+                    child_ref = self.nodeChildRef(currentNode, position)
+                    next_key = high_key
+                    if position + 1 < ent_count:
+                        next_key = keys[position + 1]
+                    children.append((child_ref, level - 1, keys[position], keys[position], next_key, ent_count > 1))
+            return level
+        finally:
+            self.btree_buffer.returnBuffer(buffer_number)
+
+    def countNode(self, report, node_ref, level, used_bytes):
+        '''Adds a node of the given level, whose entries take 'used_bytes', to the node counts and fill histogram of the report.'''
+        self.addReportLevels(report, level + 1)
+        fill = float(used_bytes) / self.nodeEntriesSize
+        report['node_counts'][level] = report['node_counts'][level] + 1
+        bucket = min(int(fill * 10), 9)
+        report['fill_histogram'][level][bucket] = report['fill_histogram'][level][bucket] + 1
+        # fill_factors holds the sum of the fills until finishTreeReport turns it into the average.
+        report['fill_factors'][level] = report['fill_factors'][level] + fill
+        self.countNodeRef(report, node_ref)
+
+    def addReportLevels(self, report, levels):
+        '''Extends the node counts, fill histogram and fill factors of the report to the given number of levels.'''
+        while len(report['node_counts']) < levels:
+            report['node_counts'].append(0)
+            report['fill_histogram'].append([0] * 10)
+            report['fill_factors'].append(0.0)
+
+    def countNodeRef(self, report, node_ref):
+        '''Widens the range of node references of the report to include 'node_ref'.'''
+        if report['lowest_ref'] == None or node_ref < report['lowest_ref']:
+            report['lowest_ref'] = node_ref
+        if report['highest_ref'] == None or node_ref > report['highest_ref']:
+            report['highest_ref'] = node_ref
+
+    def countLeafBreaks(self, report, leaf_refs):
+        '''Counts the leaf nodes, given in key order, which are not followed by the node right after them in the file.'''
+        for position in range(1, len(leaf_refs)):
+            if leaf_refs[position] != leaf_refs[position - 1] + self.nodeSize:
+                report['leaf_breaks'] = report['leaf_breaks'] + 1
+        report['first_leaf'] = leaf_refs[0]
+        report['last_leaf'] = leaf_refs[-1]
+
+    def addProblem(self, report, node_ref, message, max_problems):
+        '''Adds a problem found in the node at 'node_ref' to the report.'''
+        report['problem_count'] = report['problem_count'] + 1
+        if len(report['problems']) < max_problems:
+            report['problems'].append('node 0x%x %s' % (node_ref, message))
+
+    def mergeTreeReports(self, report, subtree_report, max_problems):
+        '''Adds the report of subtrees to the report of the BTree. Subtree reports must be merged in key order.'''
+        self.addReportLevels(report, len(subtree_report['node_counts']))
+        for level in range(len(subtree_report['node_counts'])):
+            report['node_counts'][level] = report['node_counts'][level] + subtree_report['node_counts'][level]
+            for bucket in range(10):
+                report['fill_histogram'][level][bucket] = report['fill_histogram'][level][bucket] + subtree_report['fill_histogram'][level][bucket]
+            report['fill_factors'][level] = report['fill_factors'][level] + subtree_report['fill_factors'][level]
+        for counter in ('entries', 'underfull_nodes', 'problem_count', 'leaf_breaks'):
+            report[counter] = report[counter] + subtree_report[counter]
+        report['problems'].extend(subtree_report['problems'][:max_problems - len(report['problems'])])
+        if subtree_report['first_leaf'] != None:
+            if report['last_leaf'] != None and subtree_report['first_leaf'] != report['last_leaf'] + self.nodeSize:
+                report['leaf_breaks'] = report['leaf_breaks'] + 1
+            if report['first_leaf'] == None:
+                report['first_leaf'] = subtree_report['first_leaf']
+            report['last_leaf'] = subtree_report['last_leaf']
+        for node_ref in (subtree_report['lowest_ref'], subtree_report['highest_ref']):
+            if node_ref != None:
+                self.countNodeRef(report, node_ref)
+
+    def finishTreeReport(self, report):
+        '''Turns the sums of the report into averages and ratios, and drops the values only needed while merging.'''
+        for level in range(len(report['node_counts'])):
+            report['fill_factors'][level] = report['fill_factors'][level] / report['node_counts'][level]
+        if report['node_counts'] and report['node_counts'][0] > 1:
+            report['fragmentation'] = float(report['leaf_breaks']) / (report['node_counts'][0] - 1)
+        if report['lowest_ref'] != None:
+            span = report['highest_ref'] - report['lowest_ref'] + self.nodeSize
+            report['density'] = float(sum(report['node_counts']) * self.nodeSize) / span
+        for name in ('first_leaf', 'last_leaf', 'lowest_ref', 'highest_ref'):
+            del report[name]
+
     def BTreeSearch(self, key):
         '''Wrapper funtion to search for an entry in the BTree.
            Returns the value associated with the key if search is a success otherwise it returns None.'''
-        if self.root_ref != None:
-            result = self.BTreeSearch_t(self.root_ref, key)
-            self.btree_buffer.resetBuffer()
-        else:
+        if self.root_ref == None:
             raise BTreeError, 'btree does not exist'
-        return result
-
-    def BTreeSearch_t(self, node_ref, key):
-        '''The recursive search function called by BTreeSearch.
-           Return value is same as BTreeSearch.'''
         btree_searchRes = None
+        path = self.leafPath(key)
+        node_ref, buffer_number, searchRes = path[-1]
+        if searchRes.outcome == True:
+            entryValIdx = self.lnbind(searchRes.position) + self.keySize # Extracting the value part of the leaf entry.
+            btree_searchRes = self.btree_buffer.BufferList[buffer_number][entryValIdx : entryValIdx + self.leafEntrySize - self.keySize]
+        self.releasePath(path)
+        self.btree_buffer.resetBuffer()
+        return btree_searchRes
+
+    def leafPath(self, key):
+        '''Returns the path produced by descendPath for 'key' when only the leaf node has to be read or changed.
+           If the intermediate levels are pinned, the path starts at the leaf node, otherwise at the root node.'''
+        if self.pinUpperLevels:
+            return self.descendPath(self.findLeafRef(key), key)
+        return self.descendPath(self.root_ref, key)
+
+    def descendPath(self, node_ref, key):
+        '''Descends from the node at 'node_ref' to the leaf node where 'key' is or would be stored, using a loop instead of recursion.
+           Returns the path as a list of [node_ref, buffer_number, searchRes] from the given node down to the leaf node,
+           where 'searchRes' is the NodeSearchResult of 'key' in that node.
+           The buffers of the path are left allocated so that the path can be modified bottom-up. They are returned by releasePath.'''
+        path = []
+        while True:
+            buffer_number = self.readNodeIntoBuffer(node_ref)
+            currentNode = self.btree_buffer.BufferList[buffer_number]
+            if currentNode[self.cLevelIndex] == 0:
+                path.append([node_ref, buffer_number, self.findInNode(currentNode, key, self.lnbind)])
+                return path
+            searchRes = self.findInNode(currentNode, key, self.nbind)
+            path.append([node_ref, buffer_number, searchRes])
+            child_pos = self.childPosition(searchRes)
+            node_ref = self.nodeChildRef(currentNode, child_pos)
+
+    def childPosition(self, searchRes):
+        '''Returns the position of the entry, in an intermediate node, of the child whose subtree holds the key of the given NodeSearchResult.'''
+        if searchRes.outcome == False and searchRes.position > 0:
+            return searchRes.position - 1
+        # A key below the first key of the node goes to the first child, assuming that the first entry is not consistent.
+        return searchRes.position
+
+    def releasePath(self, path):
+        '''Returns the buffers of a path produced by descendPath.'''
+        for node_ref, buffer_number, searchRes in path:
+            self.btree_buffer.returnBuffer(buffer_number)
+
+    def BTreeSearchMany(self, keys):
+        '''Searches for many keys at once.
+           The keys are sorted and partitioned among the children of each node, so every node on the union of the search paths is read only once.
+           Returns a list holding the value associated with each key, or None if the key is not present, in the order of 'keys'.'''
+        if self.root_ref == None:
+            raise BTreeError, 'btree does not exist'
+        results = [None] * len(keys)
+        order = sorted(range(len(keys)), key = lambda index: keys[index])
+        if order:
+            self.searchManyInNode(self.root_ref, keys, order, lambda node_ref, currentNode, order: self.searchManyInLeaf(currentNode, keys, order, results))
+        self.btree_buffer.resetBuffer()
+        return results
+
+    def searchManyInLeaf(self, currentNode, keys, order, results):
+        '''Fills in 'results' with the values of the keys of 'order' found in the given leaf node, for BTreeSearchMany.'''
+        for index in order:
+            searchRes = self.findInNode(currentNode, keys[index], self.lnbind)
+            if searchRes.outcome == True:
+                entryValIdx = self.lnbind(searchRes.position) + self.keySize
+                results[index] = currentNode[entryValIdx : entryValIdx + self.leafEntrySize - self.keySize]
+
+    def searchManyInNode(self,
+                         node_ref,          # The reference to the current node.
+                         keys,              # The list of keys being searched for.
+                         order,             # Indices into 'keys' of the keys to be searched for in this subtree, in increasing key order.
+                         leaf_function):    # Function called as leaf_function(node_ref, currentNode, order) for every leaf node reached.
+        '''The recursive function used by BTreeSearchMany and BTreeUpdateMany to partition sorted keys among the leaf nodes holding them.'''
         buffer_number = self.readNodeIntoBuffer(node_ref)
         currentNode = self.btree_buffer.BufferList[buffer_number]
 
-        # bind converts the logical index of the BTree Node Entry to Buffer Bytearray index.
-        # It assumes the nbind funtion or lbind funtion depending if it is a non-leaf or not.
-        isLeaf = False
-        bind = self.nbind
         if currentNode[self.cLevelIndex] == 0:
-            isLeaf = True
-            bind = self.lnbind
-
-        searchRes = self.findInNode(currentNode, key, bind)
-
-        if searchRes.outcome == False and not isLeaf:
-            if searchRes.position == 0:
-                entryIndex = bind(searchRes.position)
-                # Assuming that the first entry is not consistent.
-                # Otherwise btree_searchRes = None
-            else:
-                entryIndex = bind(searchRes.position - 1)
-            child_ref = self.getChildRef(currentNode[entryIndex : entryIndex + self.entrySize])
-            btree_searchRes = self.BTreeSearch_t(child_ref, key)
+            leaf_function(node_ref, currentNode, order)
+        else:
+            for child_ref, child_order in self.partitionKeys(currentNode, keys, order):
+                self.searchManyInNode(child_ref, keys, child_order, leaf_function)
 
-        elif searchRes.outcome == True and not isLeaf:
-            entryIndex = bind(searchRes.position)
-            child_ref = self.getChildRef(currentNode[entryIndex : entryIndex + self.entrySize])
-            btree_searchRes = self.BTreeSearch_t(child_ref, key)
+        self.btree_buffer.returnBuffer(buffer_number)
 
-        elif searchRes.outcome == False: # and isLeaf
-            btree_searchRes = None
+    def partitionKeys(self, currentNode, keys, order):
+        '''Partitions the keys of 'order', indices into 'keys' in increasing key order, among the children of the given intermediate node.
+           Returns a list of (child_ref, child_order) for each child which has keys going to it, in the order of the children.'''
+        children = []
+        # Keys are in increasing order, so the keys going to the same child are consecutive.
+        child_pos = None
+        child_order = []
+        for index in order:
+            position = self.childPosition(self.findInNode(currentNode, keys[index], self.nbind))
+            if position != child_pos and child_order:
+                children.append((self.nodeChildRef(currentNode, child_pos), child_order))
+                child_order = []
+            child_pos = position
+            child_order.append(index)
+        children.append((self.nodeChildRef(currentNode, child_pos), child_order))
+        return children
+
+    def BTreeScan(self, low_key = None, high_key = None):
+        '''Generator that yields (key, value) pairs of the leaf entries with keys from 'low_key' to 'high_key', both inclusive, in key order.
+           A bound of None leaves that end of the range open.
+           The tree is descended once and the leaves are then visited through the stack of their parent nodes,
+           so only one buffer per BTree level is held while scanning. The BTree must not be modified during a scan.'''
+        if self.root_ref == None:
+            raise BTreeError, 'btree does not exist'
 
-        else: # searchRes.outcome == True and isLeaf
-            entryValIdx = bind(searchRes.position) + self.keySize # Extracting the value part of the leaf entry.
-            btree_searchRes = currentNode[entryValIdx : entryValIdx + self.leafEntrySize - self.keySize]
-
-        self.btree_buffer.returnBuffer(buffer_number)
-        return btree_searchRes
+        path = [] # [node_ref, buffer_number, position] of the nodes from the root to the current node.
+        try:
+            node_ref = self.root_ref
+            while True:
+                buffer_number = self.readNodeIntoBuffer(node_ref)
+                self.btree_buffer.holdBuffer(buffer_number)
+                currentNode = self.btree_buffer.BufferList[buffer_number]
+                position = 0
+                if currentNode[self.cLevelIndex] == 0:
+                    if low_key != None:
+                        position = self.findInNode(currentNode, low_key, self.lnbind).position
+                    path.append([node_ref, buffer_number, position])
+                    break
+                if low_key != None:
+                    searchRes = self.findInNode(currentNode, low_key, self.nbind)
+                    position = searchRes.position
+                    if searchRes.outcome == False and position > 0:
+                        position = position - 1
+                path.append([node_ref, buffer_number, position])
+                node_ref = self.nodeChildRef(currentNode, position)
+                self.readAhead(currentNode, position, node_ref)
+
+            while path:
+                node_ref, buffer_number, position = path[-1]
+                currentNode = self.btree_buffer.BufferList[buffer_number]
+
+                if currentNode[self.cLevelIndex] == 0:
+                    while position < currentNode[self.cEntIndex]:
+                        entryIndex = self.lnbind(position)
+                        key = self.getKey(currentNode, entryIndex)
+                        if high_key != None and key > high_key:
+                            return
+                        yield key, currentNode[entryIndex + self.keySize : entryIndex + self.leafEntrySize]
+                        position = position + 1
+                    path.pop()
+                    self.btree_buffer.releaseBuffer(buffer_number)
 
+                else:
+                    position = position + 1
+                    entryIndex = self.nbind(position)
+                    if position >= currentNode[self.cEntIndex]:
+                        path.pop()
+                        self.btree_buffer.releaseBuffer(buffer_number)
+                    elif high_key != None and self.getKey(currentNode, entryIndex) > high_key:
+                        return
+                    else:
+                        path[-1][2] = position
+                        child_ref = self.nodeChildRef(currentNode, position)
+                        self.readAhead(currentNode, position, child_ref)
+                        child_buffer_number = self.readNodeIntoBuffer(child_ref)
+                        self.btree_buffer.holdBuffer(child_buffer_number)
+                        # Position -1 makes the first child of an intermediate node the next one to be visited.
+                        child_position = -1
+                        if self.btree_buffer.BufferList[child_buffer_number][self.cLevelIndex] == 0:
+                            child_position = 0
+                        path.append([child_ref, child_buffer_number, child_position])
+        finally:
+            for node_ref, buffer_number, position in path:
+                self.btree_buffer.releaseBuffer(buffer_number)
+
+    def readAhead(self, currentNode, position, child_ref):
+        '''Called by BTreeScan before it reads the child at 'position' of the given intermediate node, whose reference is 'child_ref'.
+           If the child is a leaf node which is not cached, it is prefetched together with the following btree_buffer.readAhead leaf nodes of the parent,
+           so that a scan reads each run of adjacent sibling nodes with a single read (see BTreeBuffer.prefetchNodes).
+           Assumes that readNodeIntoBuffer reads nodes of nodeSize bytes at their reference through BTreeBuffer.getNodeBuffer.'''
+        if self.btree_buffer.readAhead > 0 and currentNode[self.cLevelIndex] == 1 and not self.btree_buffer.isCached(child_ref):
+            last_position = min(position + self.btree_buffer.readAhead, currentNode[self.cEntIndex] - 1)
+            child_refs = [self.nodeChildRef(currentNode, sibling) for sibling in range(position, last_position + 1)]
+            self.btree_buffer.prefetchNodes(child_refs, self.nodeSize)
 
     def findInNode(self,
                    currentNode, # Reference to current bytearray.
@@ -257,26 +1190,31 @@ class BTree(object):
             This returns a value of type NodeSearchResult.
             If the search result is unsuccessful it will return the tentative position of the given key in node if it were present in this node.'''
 
-        low = 0
-        high = currentNode[self.cEntIndex] - 1
-        mid = 0
-
-        while(low<=high):
-            mid = (low + high)/2
-            bufferedKey = self.getKey(currentNode, bind(mid))
-            if key > bufferedKey:
-                low = mid + 1
-            elif key < bufferedKey:
-                high = mid - 1
-            else:
-                break
+        keys = self.getNodeKeys(currentNode, bind)
+        position = bisect.bisect_left(keys, key)
+        if position < len(keys) and keys[position] == key:
+            return NodeSearchResult(True, position)
+        return NodeSearchResult(False, position)
 
-        if low>high:
-            return NodeSearchResult(False, low)
-            # Returns the tentative position of the search key if it were present inside this node.
-            # The code was written carefully to ensure that the position of low falls at the tentative positon mentioned above.
+    def getNodeKeys(self,
+                    currentNode,    # Reference to current bytearray.
+                    bind):          # The function lnbind or nbind is passed as a parameter if the given node's level is 0 or more respecively.
+        '''Returns the list of keys of all entries in the node, in order.
+           The keys of a buffered node are decoded once and kept in the BTreeBuffer until the node is read again or changed (see markChanged).'''
+        buffer_number = self.btree_buffer.bufferNumbers.get(id(currentNode))
+        if buffer_number != None and self.btree_buffer.nodeKeys[buffer_number] != None:
+            return self.btree_buffer.nodeKeys[buffer_number]
+
+        count = currentNode[self.cEntIndex]
+        key_struct = self.layout.keysStruct(bind(1), count)
+        if key_struct != None:
+            keys = list(key_struct.unpack_from(currentNode, 0))
         else:
-            return NodeSearchResult(True, mid)
+            keys = [self.getKey(currentNode, bind(position)) for position in range(count)]
+
+        if buffer_number != None:
+            self.btree_buffer.nodeKeys[buffer_number] = keys
+        return keys
 
     def shiftNodeEntsRight(self,
                            currentArray,    # Reference to current bytearray.
@@ -286,11 +1224,8 @@ class BTree(object):
         '''Shifts a given bytearray towards right by 'shiftBy' bytes from the given 'index' parameter.
            This does not change the values in bytearray from 'index' to 'index + shiftBy - 1', both inclusive.'''
 
-        fromIndex = toIndex - shiftBy
-        while fromIndex >= index:
-            currentArray[toIndex] = currentArray[fromIndex]
-            toIndex = toIndex - 1
-            fromIndex = fromIndex - 1
+        if toIndex - shiftBy >= index:
+            currentArray[index + shiftBy : toIndex + 1] = currentArray[index : toIndex + 1 - shiftBy]
 
     def shiftNodeEntsLeft(self,
                           currentArray,    # Reference to current bytearray.
@@ -299,173 +1234,178 @@ class BTree(object):
         '''Shifts a given bytearray towards left by 'shiftBy' bytes from the given 'index' parameter.
            This consumes bytearray values from 'index' to 'index + shiftBy - 1', both inclusive.'''
 
-        fromIndex = index + shiftBy
         toIndex = index
-        while fromIndex < self.nodeBucketSize:
-            currentArray[toIndex] = currentArray[fromIndex]
-            toIndex = toIndex + 1
-            fromIndex = fromIndex + 1
-        while toIndex <= self.nodeBucketSize: # Fills the rest of the bytearray values from 'nodeBucketSize - shiftBy' to 'nodeBucketSize - 1' to 0.
-            currentArray[toIndex] = 0
-            toIndex = toIndex + 1
+        if index + shiftBy < self.nodeBucketSize:
+            toIndex = self.nodeBucketSize - shiftBy
+            currentArray[index : toIndex] = currentArray[index + shiftBy : self.nodeBucketSize]
+        if toIndex <= self.nodeBucketSize: # Fills the rest of the bytearray values from 'nodeBucketSize - shiftBy' to 'nodeBucketSize' to 0.
+            currentArray[toIndex : self.nodeBucketSize + 1] = bytearray(self.nodeBucketSize + 1 - toIndex)
+
+    def moveEntries(self,
+                    fromNode,       # Reference to the bytearray from where the entries are to be moved.
+                    from_index,     # Index of the first byte to be moved.
+                    toNode,         # Reference to the bytearray to where the entries are to be moved.
+                    to_index,       # Index where the first byte is to be moved into.
+                    size):          # Number of bytes to be moved, i.e. the number of entries times the entry size.
+        '''Moves consecutive entries from one node to another in a single slice assignment and fills their old place with 0.
+           The nodes must be different bytearrays. The number of entries of the nodes is not changed.'''
+
+        toNode[to_index : to_index + size] = fromNode[from_index : from_index + size]
+        fromNode[from_index : from_index + size] = bytearray(size)
 
     def BTreeInsertEntry(self, new_entry): # new_entry is the entry to be inserted into the BTree. It MUST be of type bytearray and of leaf entry size.
         '''This function inserts the given new entry into the BTree.
-           This returns a BTreeOpCode value depending on the outcome of the insert operation.'''
-        op_result = BTreeOpCode.SUCCESS
-        gen_entry = EntryInfo()
-        level = 0
-        new_first_ent = EntryInfo(True)
-
-        if len(new_entry) == self.leafEntrySize:
-            key = self.getKey(new_entry, 0)
-            child_ref = self.root_ref
-            child_buffer_number = self.readNodeIntoBuffer(self.root_ref)
-            childNode = self.btree_buffer.BufferList[child_buffer_number]
-            child_level = childNode[self.cLevelIndex]
-            op_result = self.pushEntryDown(self.root_ref, childNode, child_buffer_number, key, new_entry, gen_entry, child_level, new_first_ent)
-
-            if op_result == BTreeOpCode.OVERFLOW: # if overflow create new root.
-                level = child_level + 1
-                new_root = self.createNode(level)
-                newRootArray = self.btree_buffer.BufferList[new_root.buffer_number]
-                present_first_ent = self.genIntermediateEntry(self.getKey(childNode, 0), child_ref)
-                self.pushEntryIn(newRootArray, present_first_ent, nbind(0))
-                self.pushEntryIn(newRootArray, gen_entry.entry, self.entrySize)
-                self.root_ref = new_root.location_infile
-                self.writeNodeFromBuffer(new_root.buffer_number, new_root.location_infile)
-                self.btree_buffer.returnBuffer(new_root.buffer_number)
-
-            self.writeNodeFromBuffer(child_buffer_number, child_ref)
-            self.btree_buffer.returnBuffer(child_buffer_number)
-        else:
+           The path to the leaf node is found by descendPath and the changes are then applied to the nodes of the path from the bottom up.
+           Returns the root reference of the BTree, which changes when the root node is split.'''
+        if len(new_entry) != self.leafEntrySize:
             raise BTreeError, 'Size of new entry does not match expected entry size.'
-        self.btree_buffer.resetBuffer()
-        return self.root_ref
 
-    def pushEntryIn(self,
-                    currentNode,    # Reference to current bytearray.
-                    new_entry,      # new_entry is the entry to be inserted into the Node. It MUST be of type bytearray and of appropriate entry size for the Node.
-                    index):         # Index where the entry is to be inserted into.
-        '''This function inserts the new entry in the current node at the given index.
-           It assumes that there is enough space in the node to accomodate the entry and 'new_entry' size is correct.'''
-
-        self.shiftNodeEntsRight(currentNode, index, len(new_entry), self.nodeBucketSize - 1)
-        count = 0
-        while count < len(new_entry):
-            currentNode[index + count] = new_entry[count]
-            count = count + 1
-        currentNode[self.cEntIndex] = currentNode[self.cEntIndex] + 1
-
-    def pushEntryDown(self,
-                      node_ref,         # The reference to the current node. readNodeIntoBuffer MUST be able to fetch the node with this reference from the PST file.
-                      currentNode,      # Reference to the buffered bytearray containing the node represented in node_ref.
-                      buffer_number,    # The buffer number of 'currentNode' bytearray in self.btree_buffer.
-                      key,              # The key to be inserted into the BTree.
-                      new_entry,        # new_entry is the entry to be inserted into the BTree. It MUST be of type bytearray and of appropriate entry size for the node.
-                      gen_entry,        # This parameter is a return value: Generated intermediate entry (EntryInfo type) produced for parent node to allow node splits.
-                      level,            # The BTree level of 'currentNode'.
-                      new_first_ent):   # This parameter is a return value: Generated intermediate entry (EntryInfo type) produced for parent node when the first entry of it's child node changes.
-        '''This fuction is for recursively accessing the nodes in BTree for insert operation and to control the logic of BTree insertion.
-           This returns a BTreeOpcode value depending on the result of BTree insert operation on its sub-tree.'''
-
-        op_result = BTreeOpCode.SUCCESS
-
-        # bind converts the logical index of the BTree Node Entry to Buffer Bytearray index.
-        # It assumes the nbind funtion or lbind funtion depending if it is a non-leaf or not.
-        bind = self.nbind
-        isLeaf = False
-        if level == 0:
-            bind = self.lnbind
-            isLeaf = True
-
-        searchRes = self.findInNode(currentNode, key, bind)
-
-        # The following section of code is responsible to track whether or not the first entry of the BTree is to be changed.
-        if searchRes.position == 0 and new_first_ent.isValid == True :
-            new_first_ent.isValid = True
-        else:
-            new_first_ent.isValid = False
-        # End of section with respect to previous comment.
-
-        if isLeaf:
-            if searchRes.outcome == True:
-                op_result = BTreeOpCode.DUPLICATE
-            else:
-                if currentNode[self.cEntIndex] < self.recLeafMaxEntries:
-                    insert_pos = bind(searchRes.position)
-                    self.pushEntryIn(currentNode, new_entry, insert_pos)
-                    # gen_entry = EntryInfo()
-                    op_result = BTreeOpCode.SUCCESS
-                else:
-                    self.splitNode(currentNode, new_entry, gen_entry, searchRes.position, 0)
-                    op_result = BTreeOpCode.OVERFLOW
-
-            # This section of the code generates a new intermediate entry containing the key of the changed first entry and the reference of the 'currentNode'.
-            if new_first_ent.isValid == True:
-                new_first_ent.key = self.getKey(currentNode, 0)
-                new_first_ent.entry = self.genIntermediateEntry(new_first_ent.key, node_ref)
-            # End of section with respect to previous comment.
+        key = self.getKey(new_entry, 0)
+        gen_entry = EntryInfo() # Generated intermediate entry produced for the parent node when a node is split.
+        path = self.descendPath(self.root_ref, key)
+        # The first entry of the nodes on the path can only change if the new entry goes before the first entry of every node.
+        first_changed = all(searchRes.position == 0 for node_ref, buffer_number, searchRes in path)
 
+        node_ref, buffer_number, searchRes = path[-1]
+        currentNode = self.btree_buffer.BufferList[buffer_number]
+        if searchRes.outcome == True:
+            op_result = BTreeOpCode.DUPLICATE
+        elif currentNode[self.cEntIndex] < self.recLeafMaxEntries:
+            self.pushEntryIn(currentNode, new_entry, self.lnbind(searchRes.position))
+            op_result = BTreeOpCode.SUCCESS
         else:
-            child_ref = 0
-            if searchRes.outcome == True:
-                child_ref = self.getChildRef(currentNode[bind(searchRes.position): bind(searchRes.position) + self.entrySize])
-                # Just for consistency. Otherwise its an obvious duplicate.
-                # Plus we may need duplicates to be replaced with a new value.
-            else:
-                if searchRes.position == 0:
-                    child_ref = self.getChildRef(currentNode[bind(searchRes.position): bind(searchRes.position) + self.entrySize])
-                else:
-                    child_ref = self.getChildRef(currentNode[bind(searchRes.position - 1): bind(searchRes.position - 1) + self.entrySize])
-
-            child_buffer_number = self.readNodeIntoBuffer(child_ref)
-            childNode = self.btree_buffer.BufferList[child_buffer_number]
-            child_level = childNode[self.cLevelIndex]
-            op_result = self.pushEntryDown(child_ref, childNode, child_buffer_number, key, new_entry, gen_entry, child_level, new_first_ent)
-            self.writeNodeFromBuffer(child_buffer_number, child_ref)
-            self.btree_buffer.returnBuffer(child_buffer_number)
-
-            # This section of code generates a new intermediate entry containing the key of the changed first entry and the reference of the 'currentNode'.
-            if new_first_ent.isValid == True:
-                count = 0
-                while count < self.entrySize:
-                    currentNode[count] = new_first_ent.entry[count]
-                    # new_first_ent's position in currentNode will always be 0.
-                    count = count + 1
-
-                new_first_ent.key = self.getKey(currentNode, 0)
-                new_first_ent.entry = self.genIntermediateEntry(new_first_ent.key, node_ref)
-            # End of section with respect to previous comment.
+            self.splitNode(currentNode, new_entry, gen_entry, searchRes.position, 0, node_ref)
+            op_result = BTreeOpCode.OVERFLOW
+
+        level_index = len(path) - 1
+        while level_index > 0:
+            # This section of the code generates a new intermediate entry containing the key of the changed first entry and the reference of the child node.
+            first_ent = None
+            if first_changed:
+                first_ent = self.genIntermediateEntry(self.getKey(currentNode, 0), node_ref)
+            self.commitNode(buffer_number, node_ref)
+            self.btree_buffer.returnBuffer(buffer_number)
+
+            level_index = level_index - 1
+            node_ref, buffer_number, searchRes = path[level_index]
+            currentNode = self.btree_buffer.BufferList[buffer_number]
+
+            # The entry of the child node is replaced when its first entry changed. Its position in currentNode will always be 0.
+            if first_ent != None and currentNode[0 : self.entrySize] != first_ent:
+                currentNode[0 : self.entrySize] = first_ent
+                self.markChanged(currentNode)
 
             # The following section of code inserts the entry generated in the child node, in the currentNode.
             # This generated entry is a consequence of splitting in child node.
             if op_result == BTreeOpCode.OVERFLOW:
-                genSearchRes = self.findInNode(currentNode, gen_entry.key, bind)
+                genSearchRes = self.findInNode(currentNode, gen_entry.key, self.nbind)
                 if currentNode[self.cEntIndex] < self.recMaxEntries:
-                    insert_pos = bind(genSearchRes.position)
-                    self.pushEntryIn(currentNode, gen_entry.entry, insert_pos)
+                    self.pushEntryIn(currentNode, gen_entry.entry, self.nbind(genSearchRes.position))
                     gen_entry.reset()
                     op_result = BTreeOpCode.SUCCESS
                 else:
-                    self.splitNode(currentNode, gen_entry.entry, gen_entry, genSearchRes.position, level)
-                    op_result = BTreeOpCode.OVERFLOW
+                    self.splitNode(currentNode, gen_entry.entry, gen_entry, genSearchRes.position, currentNode[self.cLevelIndex], node_ref)
             # End of section with respect to previous comment.
 
+        if op_result == BTreeOpCode.OVERFLOW: # if overflow create new root.
+            new_root = self.createNode(currentNode[self.cLevelIndex] + 1, node_ref)
+            newRootArray = self.btree_buffer.BufferList[new_root.buffer_number]
+            present_first_ent = self.genIntermediateEntry(self.getKey(currentNode, 0), node_ref)
+            self.pushEntryIn(newRootArray, present_first_ent, self.nbind(0))
+            self.pushEntryIn(newRootArray, gen_entry.entry, self.entrySize)
+            self.root_ref = new_root.location_infile
+            self.commitNode(new_root.buffer_number, new_root.location_infile)
+            self.btree_buffer.returnBuffer(new_root.buffer_number)
+
+        self.commitNode(buffer_number, node_ref)
+        self.btree_buffer.returnBuffer(buffer_number)
+        self.btree_buffer.resetBuffer()
+        return self.root_ref
+
+    def BTreeUpdateEntry(self, new_entry): # new_entry is the entry with the new value. It MUST be of type bytearray and of leaf entry size.
+        '''This function replaces the value of the entry with the same key as 'new_entry' in place.
+           Only the leaf node holding the entry is written, and only if the value changed.
+           This returns BTreeOpCode.SUCCESS, or BTreeOpCode.NOTPRESENT if there is no entry with the key.'''
+        if len(new_entry) != self.leafEntrySize:
+            raise BTreeError, 'Size of new entry does not match expected entry size.'
+        path = self.leafPath(self.getKey(new_entry, 0))
+        node_ref, buffer_number, searchRes = path[-1]
+        op_result = BTreeOpCode.NOTPRESENT
+        if searchRes.outcome == True:
+            self.updateLeafEntry(self.btree_buffer.BufferList[buffer_number], searchRes.position, new_entry)
+            self.commitNode(buffer_number, node_ref)
+            op_result = BTreeOpCode.SUCCESS
+        self.releasePath(path)
+        self.btree_buffer.resetBuffer()
         return op_result
 
+    def BTreeUpsertEntry(self, new_entry): # new_entry is the entry to be stored in the BTree. It MUST be of type bytearray and of leaf entry size.
+        '''This function replaces the value of the entry with the same key as 'new_entry' in place, or inserts 'new_entry' if there is none.
+           Returns the root reference of the BTree, like BTreeInsertEntry.'''
+        if self.BTreeUpdateEntry(new_entry) == BTreeOpCode.NOTPRESENT:
+            self.BTreeInsertEntry(new_entry)
+        return self.root_ref
+
+    def BTreeUpdateMany(self, new_entries):
+        '''Replaces the values of many entries in place at once, like BTreeUpdateEntry.
+           The keys are partitioned among the nodes as in BTreeSearchMany, so every node is read once and every changed leaf node is written once.
+           Returns a list holding BTreeOpCode.SUCCESS or BTreeOpCode.NOTPRESENT for each entry, in the order of 'new_entries'.'''
+        if self.root_ref == None:
+            raise BTreeError, 'btree does not exist'
+        keys = []
+        for new_entry in new_entries:
+            if len(new_entry) != self.leafEntrySize:
+                raise BTreeError, 'Size of new entry does not match expected entry size.'
+            keys.append(self.getKey(new_entry, 0))
+        results = [BTreeOpCode.NOTPRESENT] * len(keys)
+        order = sorted(range(len(keys)), key = lambda index: keys[index])
+        if order:
+            self.searchManyInNode(self.root_ref, keys, order, lambda node_ref, currentNode, order: self.updateManyInLeaf(node_ref, currentNode, keys, order, new_entries, results))
+        self.btree_buffer.resetBuffer()
+        return results
+
+    def updateManyInLeaf(self, node_ref, currentNode, keys, order, new_entries, results):
+        '''Replaces the values of the entries of 'order' found in the given leaf node and writes it, for BTreeUpdateMany.'''
+        for index in order:
+            searchRes = self.findInNode(currentNode, keys[index], self.lnbind)
+            if searchRes.outcome == True:
+                self.updateLeafEntry(currentNode, searchRes.position, new_entries[index])
+                results[index] = BTreeOpCode.SUCCESS
+        self.commitNode(self.btree_buffer.bufferNumberOf(currentNode), node_ref)
+
+    def updateLeafEntry(self, currentNode, position, new_entry):
+        '''Overwrites the value of the leaf entry at the given position with the value of 'new_entry'. The key is left unchanged.'''
+        entryValIdx = self.lnbind(position) + self.keySize
+        if currentNode[entryValIdx : entryValIdx + self.leafEntrySize - self.keySize] != new_entry[self.keySize:]:
+            currentNode[entryValIdx : entryValIdx + self.leafEntrySize - self.keySize] = new_entry[self.keySize:]
+            self.markChanged(currentNode)
+
+    def pushEntryIn(self,
+                    currentNode,    # Reference to current bytearray.
+                    new_entry,      # new_entry is the entry to be inserted into the Node. It MUST be of type bytearray and of appropriate entry size for the Node.
+                    index):         # Index where the entry is to be inserted into.
+        '''This function inserts the new entry in the current node at the given index.
+           It assumes that there is enough space in the node to accomodate the entry and 'new_entry' size is correct.'''
+
+        self.shiftNodeEntsRight(currentNode, index, len(new_entry), self.nodeBucketSize - 1)
+        currentNode[index : index + len(new_entry)] = new_entry
+        currentNode[self.cEntIndex] = currentNode[self.cEntIndex] + 1
+        self.markChanged(currentNode)
 
     def splitNode(self,
                   currentNode,  # Reference to the buffered bytearray of the node to be split.
                   new_entry,    # new_entry is the entry to be inserted into the node. It MUST be of type bytearray and of appropriate entry size for the node.
                   gen_entry,    # This parameter is a return value: Generated intermediate entry (EntryInfo type) produced for parent node to allow node splits.
                   position,     # This is the tentative position where the new entry can be inserted into the node.
-                  level):       # The BTree level of 'currentNode'.
+                  level,        # The BTree level of 'currentNode'.
+                  node_ref):    # The reference to 'currentNode'. The new node is preferably allocated close to it.
 
         '''This fuction splits 'currentNode' into two.
            Returns a generated new entry for its parent node which contains the reference to the new node created after split.'''
 
-        right_half = self.createNode(level)
+        if self.stats != None:
+            self.stats['splits'] = self.stats['splits'] + 1
+        right_half = self.createNode(level, node_ref)
         rightHalfNode = self.btree_buffer.BufferList[right_half.buffer_number]
         max_ents = self.recMaxEntries
         ent_size = self.entrySize
@@ -479,168 +1419,293 @@ class BTree(object):
             mid = self.recLeafMaxEntries/2
 
         if position <= mid:
-            count = bind(mid)
-            right_count = 0
             right_half_ents = max_ents - mid
-            copy_till = count + right_half_ents * ent_size
-            while count < copy_till:
-                rightHalfNode[right_count] = currentNode[count]
-                currentNode[count] = 0
-                count = count + 1
-                right_count = right_count + 1
-
+            self.moveEntries(currentNode, bind(mid), rightHalfNode, 0, right_half_ents * ent_size)
             rightHalfNode[self.cEntIndex] = right_half_ents
             self.pushEntryIn(currentNode, new_entry, bind(position))
             currentNode[self.cEntIndex] = mid + 1
         else:
             mid = mid + 1
-            count = bind(mid)
-            right_count = 0
             right_half_ents = max_ents - mid
-            copy_till = count + right_half_ents * ent_size
-            while count < copy_till:
-                rightHalfNode[right_count] = currentNode[count]
-                currentNode[count] = 0
-                count = count + 1
-                right_count = right_count + 1
+            self.moveEntries(currentNode, bind(mid), rightHalfNode, 0, right_half_ents * ent_size)
             currentNode[self.cEntIndex] = mid
             self.pushEntryIn(rightHalfNode, new_entry, bind(position - mid))
             rightHalfNode[self.cEntIndex] = right_half_ents + 1
+            self.markChanged(currentNode)
 
         gen_entry.isValid = True
         gen_entry.key = self.getKey(rightHalfNode, 0)
         gen_entry.entry = self.genIntermediateEntry(gen_entry.key, right_half.location_infile)
-        self.writeNodeFromBuffer(right_half.buffer_number, right_half.location_infile)
+        self.commitNode(right_half.buffer_number, right_half.location_infile)
         self.btree_buffer.returnBuffer(right_half.buffer_number)
 
     def BTreeRemoveEntry(self, key): # 'key' represents the entry, with the same key value, which is to be deleted.
         '''This function removes an entry with the matching key from the BTree.
-           This returns a BTreeOpCode value depending on the outcome of the delete operation.'''
-
-        op_result = BTreeOpCode.SUCCESS
-        new_first_ent = EntryInfo()
-
-        root_buffer_number = self.readNodeIntoBuffer(self.root_ref)
-        rootNode = self.btree_buffer.BufferList[root_buffer_number]
-        root_level = rootNode[self.cLevelIndex]
+           The path to the leaf node is found by descendPath and the changes are then applied to the nodes of the path from the bottom up.
+           Returns the root reference of the BTree, which changes when the root node is left with a single child.'''
+        path = self.descendPath(self.root_ref, key)
 
-        if rootNode[self.cEntIndex] >= 1:
-            op_result = self.recursiveRemove(self.root_ref, rootNode, root_buffer_number, key, root_level, new_first_ent)
-            if rootNode[self.cEntIndex] == 1 and root_level != 0:
-                old_root_ref = self.root_ref
-                self.root_ref = self.getChildRef(rootNode[self.nbind(0) : self.nbind(0) + self.entrySize])
-                self.delNodeAllocation(old_root_ref)
-            else:
-                self.writeNodeFromBuffer(root_buffer_number, self.root_ref)
-        else:
-            op_result = BTreeOpCode.NOTPRESENT
+        node_ref, buffer_number, searchRes = path[-1]
+        currentNode = self.btree_buffer.BufferList[buffer_number]
+        first_ent = None # Generated intermediate entry for the parent node when the first entry of its child node changes.
+        if searchRes.outcome == True:
+            self.removeNodeEntry(currentNode, self.lnbind(searchRes.position), self.leafEntrySize)
+            if searchRes.position == 0:
+                first_ent = self.genIntermediateEntry(self.getKey(currentNode, 0), node_ref)
 
-        self.btree_buffer.returnBuffer(root_buffer_number)
+        self.restorePath(path, first_ent)
         self.btree_buffer.resetBuffer()
         return self.root_ref
 
-    def recursiveRemove(self,
-                        node_ref,       # The reference to the current node.
-                        currentNode,    # Reference to the buffered bytearray containing the node represented in node_ref.
-                        buffer_number,  # The buffer number of 'childNode' bytearray in self.btree_buffer.
-                        key,            # 'key' represents the entry, with the same key value, which is to be deleted.
-                        level,          # The BTree level of 'currentNode'.
-                        new_first_ent): # This parameter is a return value: Generated intermediate entry (EntryInfo type) produced for parent node when the first entry of it's child node changes.
-        '''This fuction is for recursively accessing the nodes in BTree for remove operation and to control the logic of BTree deletion.
-           This returns a BTreeOpcode value depending on the result of BTree remove operation on its sub-tree.'''
-
-        op_result = BTreeOpCode.SUCCESS
-
-        # bind converts the logical index of the BTree Node Entry to Buffer Bytearray index.
-        # It assumes the nbind funtion or lbind funtion depending if it is a non-leaf or not.
-        bind = self.nbind
-        isLeaf = False
-        if level == 0:
-            bind = self.lnbind
-            isLeaf = True
-
-        searchRes = self.findInNode(currentNode, key, bind)
-
-        if isLeaf:
-            if searchRes.outcome == True:
-                self.removeNodeEntry(currentNode, bind(searchRes.position), self.leafEntrySize)
-
-                # The following section of code tracks the change of first entry in the leaf node and sets 'new_first_ent' accordingly.
-                if searchRes.position == 0:
-                    new_first_ent.isValid = True
-                    new_first_ent.key = self.getKey(currentNode, 0)
-                    new_first_ent.entry = self.genIntermediateEntry(new_first_ent.key, node_ref)
-                else:
-                    new_first_ent.reset()
-                # End of section with respect to previous comment.
-
-                op_result = BTreeOpCode.SUCCESS
-            else:
-                op_result = BTreeOpCode.NOTPRESENT
-
-        else:
-            child_ref = 0
-            child_pos = 0
-            if searchRes.outcome == True:
-                child_pos = searchRes.position
-            else:
-                if searchRes.position == 0:
-                    child_pos = 0
-                    # Assuming that the first entry is not consistent.
-                    # Otherwise op_result == BTreeOpCode.NOTPRESENT
-                else:
-                    child_pos = searchRes.position - 1
-
-            child_ref = self.getChildRef(currentNode[bind(child_pos): bind(child_pos) + self.entrySize])
+    def restorePath(self,
+                    path,           # The path from the root node to a leaf node produced by descendPath.
+                    first_ent):     # Generated intermediate entry for the parent of the leaf node if the first entry of the leaf node changed, otherwise None.
+        '''Applies the removal of entries below the nodes of the path from the bottom up, and writes and returns the nodes of the path.
+           Every node of the path left with too few entries is restored with restoreNode, unless it is the only child of its parent.
+           The root node is replaced by its child if it is left with a single child.
+           Returns True if any node was restored or the root node was replaced.'''
+        node_ref, buffer_number, searchRes = path[-1]
+        currentNode = self.btree_buffer.BufferList[buffer_number]
+        restored = False
 
+        level_index = len(path) - 1
+        while level_index > 0:
+            child_ref = node_ref
+            child_buffer_number = buffer_number
+            childNode = currentNode
 
-            child_buffer_number = self.readNodeIntoBuffer(child_ref)
-            childNode = self.btree_buffer.BufferList[child_buffer_number]
-            child_level = childNode[self.cLevelIndex]
-            op_result = self.recursiveRemove(child_ref, childNode, child_buffer_number, key, child_level, new_first_ent)
+            level_index = level_index - 1
+            node_ref, buffer_number, searchRes = path[level_index]
+            currentNode = self.btree_buffer.BufferList[buffer_number]
+            level = currentNode[self.cLevelIndex]
+            child_pos = self.childPosition(searchRes)
 
             # The following section of code checks for first entry change in child node and re-adjusts the entry containing to the child node accordingly.
-            if new_first_ent.isValid == True:
-                count = bind(searchRes.position)
-                from_count = 0
-                end_count = count + self.entrySize
-                while count < end_count:
-                    currentNode[count] = new_first_ent.entry[from_count]
-                    from_count = from_count + 1
-                    count = count + 1
-            # End of section with respect to previous comment.
-
-                # The following section of code tracks the change of first entry in the intermediate node and sets 'new_first_ent' accordingly.
+            if first_ent != None:
+                entryIndex = self.nbind(searchRes.position)
+                if currentNode[entryIndex : entryIndex + self.entrySize] != first_ent:
+                    currentNode[entryIndex : entryIndex + self.entrySize] = first_ent
+                    self.markChanged(currentNode)
+
+                # The first entry of currentNode has changed as well if the child node is its first child.
+                first_ent = None
                 if searchRes.position == 0:
-                    new_first_ent.key = self.getKey(currentNode, 0)
-                    new_first_ent.entry = self.genIntermediateEntry(new_first_ent.key, node_ref)
-                else:
-                    new_first_ent.reset()
-                # End of section with respect to previous comment.
+                    first_ent = self.genIntermediateEntry(self.getKey(currentNode, 0), node_ref)
+            # End of section with respect to previous comment.
 
-            ent_size = self.entrySize
             max_ents = self.recMaxEntries
             if level == 1:
-                ent_size = self.leafEntrySize
                 max_ents = self.recLeafMaxEntries
 
             # This section of code restores the number of minimum entries in the 'childNode' of BTree
-            if childNode[self.cEntIndex] <= (max_ents - 1)/2:
+            # A child without siblings is left as it is. It is restored once its parent has been restored.
+            if childNode[self.cEntIndex] <= (max_ents - 1)/2 and currentNode[self.cEntIndex] > 1:
                 restore_first_ent = EntryInfo()
                 self.restoreNode(currentNode, child_ref, childNode, child_buffer_number, child_pos, level, restore_first_ent)
-                # End of section with respect to previous comment.
+                restored = True
 
                 # Change of first entry in any child node is reflected in 'currentNode', which is the parent.
                 if restore_first_ent.isValid == True:
-                    resFirstEntRes = self.findInNode(currentNode, restore_first_ent.key, bind)
-                    self.pushEntryIn(currentNode, restore_first_ent.entry, bind(resFirstEntRes.position))
-
+                    resFirstEntRes = self.findInNode(currentNode, restore_first_ent.key, self.nbind)
+                    self.pushEntryIn(currentNode, restore_first_ent.entry, self.nbind(resFirstEntRes.position))
             else:
-                self.writeNodeFromBuffer(child_buffer_number, child_ref)
+                self.commitNode(child_buffer_number, child_ref)
+            # End of section with respect to previous comment.
 
             self.btree_buffer.returnBuffer(child_buffer_number)
 
-        return op_result
+        if currentNode[self.cEntIndex] == 1 and currentNode[self.cLevelIndex] != 0:
+            self.root_ref = self.nodeChildRef(currentNode, 0)
+            self.freeNode(node_ref)
+            restored = True
+        else:
+            self.commitNode(buffer_number, node_ref)
+
+        self.btree_buffer.returnBuffer(buffer_number)
+        return restored
+
+    def BTreeRemoveRange(self, low_key = None, high_key = None):
+        '''This function removes all entries with keys from 'low_key' to 'high_key', both inclusive. A bound of None leaves that end of the range open.
+           Subtrees lying completely inside the range are deleted without reading their leaf nodes, and only the nodes
+           at the two edges of the range are trimmed. The trimmed nodes are restored once all entries have been removed.
+           Returns the root reference of the BTree.'''
+        if self.root_ref == None:
+            raise BTreeError, 'btree does not exist'
+        if low_key != None and high_key != None and low_key > high_key:
+            return self.root_ref
+        edge_keys = set()
+        ent_count, first_key = self.removeRangeInNode(self.root_ref, low_key, high_key, None, edge_keys)
+        return self.finishRemoval(ent_count, edge_keys)
+
+    def removeRangeInNode(self,
+                          node_ref,     # The reference to the current node.
+                          low_key,      # The lowest key to be removed, or None.
+                          high_key,     # The highest key to be removed, or None.
+                          upper_key,    # The first key after the subtree of the current node, or None if there is no such key.
+                          edge_keys):   # This parameter is a return value: The set of first keys of the nodes which were trimmed.
+        '''The recursive function called by BTreeRemoveRange. The current node is deleted if no entries are left in it.
+           Returns the number of entries left in the current node and its first key.'''
+        buffer_number = self.readNodeIntoBuffer(node_ref)
+        currentNode = self.btree_buffer.BufferList[buffer_number]
+        level = currentNode[self.cLevelIndex]
+
+        if level == 0:
+            keys = self.getNodeKeys(currentNode, self.lnbind)
+            first = 0
+            last = len(keys)
+            if low_key != None:
+                first = bisect.bisect_left(keys, low_key)
+            if high_key != None:
+                last = bisect.bisect_right(keys, high_key)
+            self.removeNodeEntries(currentNode, range(first, last), self.lnbind, self.leafEntrySize)
+
+        else:
+            keys = self.getNodeKeys(currentNode, self.nbind)
+            first = 0
+            last = len(keys) - 1
+            if low_key != None:
+                first = max(bisect.bisect_right(keys, low_key) - 1, 0)
+            if high_key != None:
+                last = bisect.bisect_right(keys, high_key) - 1
+
+            removed = [] # Positions of the entries of the deleted child nodes.
+            for position in range(first, last + 1):
+                child_ref = self.nodeChildRef(currentNode, position)
+                child_upper_key = upper_key
+                if position + 1 < len(keys):
+                    child_upper_key = keys[position + 1]
+                if (low_key == None or keys[position] >= low_key) and (high_key == None or (child_upper_key != None and child_upper_key - 1 <= high_key)):
+                    self.freeSubtree(child_ref, level - 1)
+                    removed.append(position)
+                else:
+                    child_count, child_first_key = self.removeRangeInNode(child_ref, low_key, high_key, child_upper_key, edge_keys)
+                    if child_count == 0:
+                        removed.append(position)
+                    else:
+                        self.updateChildEntry(currentNode, position, child_first_key, child_ref)
+            self.removeNodeEntries(currentNode, removed, self.nbind, self.entrySize)
+
+        return self.finishNodeRemoval(node_ref, buffer_number, edge_keys)
+
+    def BTreeRemoveMany(self, keys):
+        '''This function removes the entries with the given keys from the BTree. Keys which are not present are ignored.
+           The keys are sorted and partitioned among the children of each node as in BTreeSearchMany, so every node is read and written once,
+           and nodes left without entries are deleted. The nodes which lost entries are restored once all entries have been removed.
+           Returns the root reference of the BTree.'''
+        if self.root_ref == None:
+            raise BTreeError, 'btree does not exist'
+        keys = sorted(set(keys))
+        if not keys:
+            return self.root_ref
+        edge_keys = set()
+        ent_count, first_key = self.removeManyInNode(self.root_ref, keys, edge_keys)
+        return self.finishRemoval(ent_count, edge_keys)
+
+    def removeManyInNode(self,
+                         node_ref,      # The reference to the current node.
+                         keys,          # The keys to be removed from the subtree of the current node, in increasing order.
+                         edge_keys):    # This parameter is a return value: The set of first keys of the nodes which lost entries.
+        '''The recursive function called by BTreeRemoveMany. The current node is deleted if no entries are left in it.
+           Returns the number of entries left in the current node and its first key.'''
+        buffer_number = self.readNodeIntoBuffer(node_ref)
+        currentNode = self.btree_buffer.BufferList[buffer_number]
+
+        if currentNode[self.cLevelIndex] == 0:
+            positions = []
+            for key in keys:
+                searchRes = self.findInNode(currentNode, key, self.lnbind)
+                if searchRes.outcome == True:
+                    positions.append(searchRes.position)
+            self.removeNodeEntries(currentNode, positions, self.lnbind, self.leafEntrySize)
+
+        else:
+            # Keys are in increasing order, so the keys going to the same child are consecutive.
+            child_keys = {}
+            for key in keys:
+                child_keys.setdefault(self.childPosition(self.findInNode(currentNode, key, self.nbind)), []).append(key)
+
+            removed = [] # Positions of the entries of the deleted child nodes.
+            for position in sorted(child_keys):
+                child_ref = self.nodeChildRef(currentNode, position)
+                child_count, child_first_key = self.removeManyInNode(child_ref, child_keys[position], edge_keys)
+                if child_count == 0:
+                    removed.append(position)
+                else:
+                    self.updateChildEntry(currentNode, position, child_first_key, child_ref)
+            self.removeNodeEntries(currentNode, removed, self.nbind, self.entrySize)
+
+        return self.finishNodeRemoval(node_ref, buffer_number, edge_keys)
+
+    def finishNodeRemoval(self, node_ref, buffer_number, edge_keys):
+        '''Writes and returns a node visited by BTreeRemoveRange or BTreeRemoveMany, or deletes it if no entries are left in it.
+           The first key of the node is added to 'edge_keys' if the node changed.
+           Returns the number of entries left in the node and its first key, which is None if the node was deleted.'''
+        currentNode = self.btree_buffer.BufferList[buffer_number]
+        ent_count = currentNode[self.cEntIndex]
+        first_key = None
+        if ent_count == 0:
+            self.freeNode(node_ref)
+        else:
+            first_key = self.getKey(currentNode, 0)
+            if self.btree_buffer.isChanged(buffer_number):
+                edge_keys.add(first_key)
+            self.commitNode(buffer_number, node_ref)
+        self.btree_buffer.returnBuffer(buffer_number)
+        return ent_count, first_key
+
+    def finishRemoval(self, ent_count, edge_keys):
+        '''Restores the nodes changed by BTreeRemoveRange or BTreeRemoveMany, given the number of entries left in the root node.
+           Each path to a changed node is restored until restorePath finds nothing left to restore. Returns the root reference of the BTree.'''
+        self.btree_buffer.resetBuffer()
+        if ent_count == 0:
+            # The root node has been deleted, so the BTree starts again from an empty root node.
+            return self.BTreeCreate()
+        for key in sorted(edge_keys):
+            while self.restorePath(self.descendPath(self.root_ref, key), None):
+                self.btree_buffer.resetBuffer()
+        self.btree_buffer.resetBuffer()
+        return self.root_ref
+
+    def freeSubtree(self, node_ref, level):
+        '''Deletes the node at 'node_ref', of the given level, and all nodes below it. Only the intermediate nodes are read.'''
+        if level > 0:
+            buffer_number = self.readNodeIntoBuffer(node_ref)
+            currentNode = self.btree_buffer.BufferList[buffer_number]
+            child_refs = [self.nodeChildRef(currentNode, position) for position in range(currentNode[self.cEntIndex])]
+            self.btree_buffer.returnBuffer(buffer_number)
+            for child_ref in child_refs:
+                self.freeSubtree(child_ref, level - 1)
+        self.freeNode(node_ref)
+
+    def updateChildEntry(self, currentNode, position, key, child_ref):
+        '''Replaces the entry at the given position of an intermediate node with one holding the given first key of the child node, if it differs.'''
+        if self.layoutEntries:
+            if self.layout.key(currentNode, self.nbind(position)) != key or self.layout.childRef(currentNode, position) != child_ref:
+                self.layout.writeEntry(currentNode, position, key, child_ref)
+                self.markChanged(currentNode)
+            return
+        entry = self.genIntermediateEntry(key, child_ref)
+        entryIndex = self.nbind(position)
+        if currentNode[entryIndex : entryIndex + self.entrySize] != entry:
+            currentNode[entryIndex : entryIndex + self.entrySize] = entry
+            self.markChanged(currentNode)
+
+    def removeNodeEntries(self,
+                          currentNode,  # Reference to current bytearray.
+                          positions,    # The positions of the entries to be removed, in increasing order.
+                          bind,         # The function lnbind or nbind is passed as a parameter if the given node's level is 0 or more respecively.
+                          entry_size):  # The size of the entries in bytes.
+        '''This function removes the entries at the given positions from the current node, shifting each run of consecutive entries at once.'''
+        index = len(positions) - 1
+        while index >= 0:
+            run_end = positions[index]
+            while index > 0 and positions[index - 1] == positions[index] - 1:
+                index = index - 1
+            self.shiftNodeEntsLeft(currentNode, bind(positions[index]), (run_end - positions[index] + 1) * entry_size)
+            index = index - 1
+        if positions:
+            currentNode[self.cEntIndex] = currentNode[self.cEntIndex] - len(positions)
+            self.markChanged(currentNode)
 
     def removeNodeEntry(self,
                         currentNode,    # Reference to current bytearray.
@@ -650,9 +1715,10 @@ class BTree(object):
 
         self.shiftNodeEntsLeft(currentNode, index, entry_size)
         currentNode[self.cEntIndex] = currentNode[self.cEntIndex] - 1
+        self.markChanged(currentNode)
 
     def restoreNode(self,
-                    currentNode,            # Reference to the buffered bytearray containing the node represented in 'node_ref' in recursiveRemove.
+                    currentNode,            # Reference to the buffered bytearray containing the parent node of the child node, as visited by BTreeRemoveEntry.
                     child_ref,              # The reference to the current node's child node. readNodeIntoBuffer MUST be able to fetch the node with this reference from the PST file.
                     childNode,              # Reference to the buffered bytearray containing the node represented in child_ref.
                     child_buffer_number,    # The buffer number of 'childNode' bytearray in self.btree_buffer.
@@ -672,7 +1738,7 @@ class BTree(object):
 
         if position == currentNode[self.cEntIndex] - 1: # if the the child node is the last node in its parent node
 
-            left_node_ref = self.getChildRef(currentNode[self.nbind(position - 1) : self.nbind(position - 1) + self.entrySize])
+            left_node_ref = self.nodeChildRef(currentNode, position - 1)
             left_buffer_number = self.readNodeIntoBuffer(left_node_ref)
             leftNode = self.btree_buffer.BufferList[left_buffer_number]
 
@@ -684,19 +1750,19 @@ class BTree(object):
                 restore_first_ent.key = self.getKey(childNode, 0)
                 restore_first_ent.entry = self.genIntermediateEntry(restore_first_ent.key, child_ref)
 
-                self.writeNodeFromBuffer(child_buffer_number, child_ref)
+                self.commitNode(child_buffer_number, child_ref)
 
             else:
                 self.combineSiblings(currentNode, position, leftNode, childNode, bind)
-                self.delNodeAllocation(child_ref)
+                self.freeNode(child_ref)
                 restore_first_ent.reset()
 
-            self.writeNodeFromBuffer(left_buffer_number, left_node_ref)
+            self.commitNode(left_buffer_number, left_node_ref)
             self.btree_buffer.returnBuffer(left_buffer_number)
 
         elif position == 0: # if the child node is the first node in its parent node
 
-            right_node_ref = self.getChildRef(currentNode[self.nbind(position + 1) : self.nbind(position + 1) + self.entrySize])
+            right_node_ref = self.nodeChildRef(currentNode, position + 1)
             right_buffer_number = self.readNodeIntoBuffer(right_node_ref)
             rightNode = self.btree_buffer.BufferList[right_buffer_number]
 
@@ -708,19 +1774,19 @@ class BTree(object):
                 restore_first_ent.key = self.getKey(rightNode, 0)
                 restore_first_ent.entry = self.genIntermediateEntry(restore_first_ent.key, right_node_ref)
 
-                self.writeNodeFromBuffer(right_buffer_number, right_node_ref)
+                self.commitNode(right_buffer_number, right_node_ref)
 
             else:
                 self.combineSiblings(currentNode, position + 1, childNode, rightNode, bind)
-                self.delNodeAllocation(right_node_ref)
+                self.freeNode(right_node_ref)
                 restore_first_ent.reset()
 
-            self.writeNodeFromBuffer(child_buffer_number, child_ref)
+            self.commitNode(child_buffer_number, child_ref)
             self.btree_buffer.returnBuffer(right_buffer_number)
 
         else:
 
-            left_node_ref = self.getChildRef(currentNode[self.nbind(position - 1) : self.nbind(position - 1) + self.entrySize])
+            left_node_ref = self.nodeChildRef(currentNode, position - 1)
             left_buffer_number = self.readNodeIntoBuffer(left_node_ref)
             leftNode = self.btree_buffer.BufferList[left_buffer_number]
 
@@ -732,35 +1798,35 @@ class BTree(object):
                 restore_first_ent.key = self.getKey(childNode, 0)
                 restore_first_ent.entry = self.genIntermediateEntry(restore_first_ent.key, child_ref)
 
-                self.writeNodeFromBuffer(left_buffer_number, left_node_ref)
+                self.commitNode(left_buffer_number, left_node_ref)
                 self.btree_buffer.returnBuffer(left_buffer_number)
 
             else:
 
                 self.btree_buffer.returnBuffer(left_buffer_number)
 
-                right_node_ref = self.getChildRef(currentNode[self.nbind(position + 1) : self.nbind(position + 1) + self.entrySize])
+                right_node_ref = self.nodeChildRef(currentNode, position + 1)
                 right_buffer_number = self.readNodeIntoBuffer(right_node_ref)
                 rightNode = self.btree_buffer.BufferList[right_buffer_number]
 
                 if rightNode[self.cEntIndex] > (max_ents + 1)/2:
                     # moveLeft()
-                    self.moveEntryInSiblings(rightNode, bind(0), childNode, bind(childNode[self.cEntIndex]), ent_size)
+                    self.moveEntryBetweenNodes(rightNode, bind(0), childNode, bind(childNode[self.cEntIndex]), ent_size)
                     self.removeNodeEntry(currentNode, self.nbind(position + 1), self.entrySize)
                     restore_first_ent.isValid = True
                     restore_first_ent.key = self.getKey(rightNode, 0)
                     restore_first_ent.entry = self.genIntermediateEntry(restore_first_ent.key, right_node_ref)
 
-                    self.writeNodeFromBuffer(right_buffer_number, right_node_ref)
+                    self.commitNode(right_buffer_number, right_node_ref)
 
                 else:
                     self.combineSiblings(currentNode, position + 1, childNode, rightNode, bind)
-                    self.delNodeAllocation(right_node_ref)
+                    self.freeNode(right_node_ref)
                     restore_first_ent.reset()
 
                 self.btree_buffer.returnBuffer(right_buffer_number)
 
-            self.writeNodeFromBuffer(child_buffer_number, child_ref)
+            self.commitNode(child_buffer_number, child_ref)
 
 
     def moveEntryBetweenNodes(self,
@@ -771,24 +1837,23 @@ class BTree(object):
                                  ent_size):     # Size of entry to be moved in bytes.
         '''This function moves an entry between nodes of similar entry type and size.'''
 
+        if self.stats != None:
+            self.stats['borrows'] = self.stats['borrows'] + 1
         entry = fromNode[from_index : from_index + ent_size]
         self.pushEntryIn(toNode, entry, to_index)
         self.removeNodeEntry(fromNode, from_index, ent_size)
 
     def combineSiblings(self,
-                        currentNode,        # Reference to the buffered bytearray containing the node represented in 'node_ref' in recursiveRemove.
+                        currentNode,        # Reference to the buffered bytearray containing the parent node of the child node, as visited by BTreeRemoveEntry.
                         right_child_pos,    # Position of the entry contained in 'currentNode' which contains the reference to right child node used here.
                         leftChildNode,      # Reference to the buffered bytearray containing the left child node to be combined.
                         rightChildNode,     # Reference to the buffered bytearray containing the right child node to be combined.
                         bind):              # The function lnbind or nbind is passed as a parameter if the given children nodes' level is 0 or more respecively.
         '''This function combines two neighbouring sibling nodes and deletes the reference of the right sibling in the parent node.'''
 
-        count = bind(leftChildNode[self.cEntIndex])
-        from_count = 0
-        end_pos = count + bind(rightChildNode[self.cEntIndex])
-        while from_count < end_pos:
-            leftChildNode[count] = rightChildNode[from_count]
-            count = count + 1
-            from_count = from_count + 1
+        if self.stats != None:
+            self.stats['merges'] = self.stats['merges'] + 1
+        self.moveEntries(rightChildNode, 0, leftChildNode, bind(leftChildNode[self.cEntIndex]), bind(rightChildNode[self.cEntIndex]))
         leftChildNode[self.cEntIndex] = leftChildNode[self.cEntIndex] + rightChildNode[self.cEntIndex]
+        self.markChanged(leftChildNode)
         self.removeNodeEntry(currentNode, self.nbind(right_child_pos), self.entrySize)
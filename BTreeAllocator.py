@@ -0,0 +1,93 @@
+#-------------------------------------------------------------------------------
+# Name:        BTreeAllocator
+# Purpose:     Node allocation policies for BTree
+#
+# Created:     16/10/2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+import bisect
+
+class BTreeAllocator(object):
+    '''BTreeAllocator is the node allocation layer used by BTree to create and delete nodes.
+       It simply forwards to the allocateNode and delNodeAllocation functions of the BTree, so deleted nodes are never reused.
+       Other allocation policies can be plugged into a BTree by inheriting this class.'''
+
+    btree = None    # The BTree whose nodes are allocated.
+
+    def attach(self, btree):
+        '''Binds the allocator to the BTree whose nodes it allocates.'''
+        self.btree = btree
+
+    def allocate(self, near_ref = None):
+        '''Returns a reference where a new node can be written to.
+           'near_ref' is the reference of a related node (e.g. the parent or a sibling) which the new node should preferably be placed close to.'''
+        return self.btree.allocateNode()
+
+    def free(self, node_ref):
+        '''Deletes a given node and its allocation.'''
+        self.btree.delNodeAllocation(node_ref)
+
+    def reset(self):
+        '''Forgets any state kept about the allocation of nodes.'''
+        pass
+
+
+class FreeListAllocator(BTreeAllocator):
+    '''FreeListAllocator reuses the slots of deleted nodes before asking the BTree for new ones.
+       Free slots are kept in an in-memory free list which is built lazily on the first allocation,
+       by scanning the nodes from 'first_ref' to the end of the PST file for the deletion marker (see BTree.isDeletedNode).
+       Nodes are assumed to be laid out in slots of the node size from 'first_ref' onwards.
+       The free slot closest to the given 'near_ref' is reused first, which keeps related nodes close together in the file.'''
+
+    first_ref = 0       # Reference of the first node slot in the PST file.
+    scan_nodes = 256    # Number of node slots read at a time while scanning for deleted nodes.
+    freeRefs = None     # Sorted list of references of deleted nodes which can be reused. None until the PST file is scanned.
+
+    def __init__(self, first_ref, scan_nodes = 256):
+        self.first_ref = first_ref
+        self.scan_nodes = scan_nodes
+        self.freeRefs = None
+
+    def allocate(self, near_ref = None):
+        '''Returns the reference of the free slot closest to 'near_ref', or a new reference if there are no free slots.'''
+        if self.freeRefs == None:
+            self.scanFreeNodes()
+        if not self.freeRefs:
+            return self.btree.allocateNode()
+
+        index = 0
+        if near_ref != None:
+            index = bisect.bisect_left(self.freeRefs, near_ref)
+            if index == len(self.freeRefs) or (index > 0 and near_ref - self.freeRefs[index - 1] <= self.freeRefs[index] - near_ref):
+                index = index - 1
+        return self.freeRefs.pop(index)
+
+    def free(self, node_ref):
+        '''Deletes a given node and adds its slot to the free list.'''
+        self.btree.delNodeAllocation(node_ref)
+        if self.freeRefs != None:
+            bisect.insort(self.freeRefs, node_ref)
+
+    def reset(self):
+        '''Drops the free list. It is rebuilt from the PST file on the next allocation.'''
+        self.freeRefs = None
+
+    def scanFreeNodes(self):
+        '''Builds the free list by scanning the PST file for deleted nodes.'''
+        btree_buffer = self.btree.btree_buffer
+        nodeSize = self.btree.nodeSize
+        btree_buffer.flush()
+        file_size = btree_buffer.fileSize()
+
+        self.freeRefs = []
+        node_ref = self.first_ref
+        while node_ref + nodeSize <= file_size:
+            read_nodes = min(self.scan_nodes, (file_size - node_ref) / nodeSize)
+            chunk = btree_buffer.readBytes(node_ref, read_nodes * nodeSize)
+            index = 0
+            while index < len(chunk):
+                if self.btree.isDeletedNode(chunk[index : index + nodeSize]):
+                    self.freeRefs.append(node_ref + index)
+                index = index + nodeSize
+            node_ref = node_ref + read_nodes * nodeSize
@@ -0,0 +1,85 @@
+#-------------------------------------------------------------------------------
+# Name:        BTreeAsync
+# Purpose:     Asynchronous BTree searches and scans with overlapping node reads
+#
+# Created:     16/10/2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+import multiprocessing.pool
+import BTree
+import BTreeBuffer
+
+class BTreeAsync(object):
+    '''BTreeAsync runs searches and scans of a BTree on a pool of threads, so that the node reads of many of them are in flight at the same time.
+       The BTree must be buffered by a BTreeBufferPool, so that every thread has its own buffers,
+       and should read the PST file through a PositionalFileIO so that the reads do not wait for each other.
+       searchAsync and scanAsync return multiprocessing AsyncResult objects whose get method waits for the result.
+       searchMany reads all nodes of one level of the BTree at the same time, for all keys, before going down to the next level.
+       The BTree must not be modified while it is used through BTreeAsync.'''
+
+    btree = None    # The BTree which is searched.
+    pool = None     # The thread pool running the searches and node reads.
+
+    def __init__(self, btree, threads = 8):
+        if not isinstance(btree.btree_buffer, BTreeBuffer.BTreeBufferPool):
+            raise BTree.BTreeError, 'asynchronous searches need a btree buffered by a BTreeBufferPool'
+        self.btree = btree
+        self.pool = multiprocessing.pool.ThreadPool(threads)
+
+    def searchAsync(self, key, callback = None):
+        '''Starts BTreeSearch for 'key'. 'callback', if given, is called with the value when the search is done.'''
+        return self.pool.apply_async(self.btree.BTreeSearch, (key,), callback = callback)
+
+    def scanAsync(self, low_key = None, high_key = None, callback = None):
+        '''Starts a scan of the keys from 'low_key' to 'high_key'. Its result is the list of (key, value) pairs yielded by BTreeScan.'''
+        return self.pool.apply_async(self.scanList, (low_key, high_key), callback = callback)
+
+    def scanList(self, low_key, high_key):
+        '''Returns the list of (key, value) pairs yielded by BTreeScan.'''
+        return list(self.btree.BTreeScan(low_key, high_key))
+
+    def searchMany(self, keys):
+        '''Searches for many keys at once, like BTreeSearchMany, and returns the list of their values or None for the keys not present.
+           The keys are partitioned level by level and the nodes of each level are read by the threads of the pool at the same time.'''
+        if self.btree.root_ref == None:
+            raise BTree.BTreeError, 'btree does not exist'
+        results = [None] * len(keys)
+        order = sorted(range(len(keys)), key = lambda index: keys[index])
+        tasks = []
+        if order:
+            tasks.append((self.btree.root_ref, keys, order))
+        while tasks:
+            next_tasks = []
+            for children, values in self.pool.map(self.searchNode, tasks):
+                next_tasks.extend((child_ref, keys, child_order) for child_ref, child_order in children)
+                for index, value in values:
+                    results[index] = value
+            tasks = next_tasks
+        return results
+
+    def searchNode(self, task):
+        '''Reads the node of a searchMany task, given as (node_ref, keys, order).
+           Returns (children, values), where 'children' are the (child_ref, child_order) of an intermediate node
+           and 'values' the (index, value) of the keys found in a leaf node.'''
+        node_ref, keys, order = task
+        btree = self.btree
+        buffer_number = btree.readNodeIntoBuffer(node_ref)
+        currentNode = btree.btree_buffer.BufferList[buffer_number]
+        children = []
+        values = []
+        if currentNode[btree.cLevelIndex] == 0:
+            for index in order:
+                searchRes = btree.findInNode(currentNode, keys[index], btree.lnbind)
+                if searchRes.outcome == True:
+                    entryValIdx = btree.lnbind(searchRes.position) + btree.keySize
+                    values.append((index, currentNode[entryValIdx : entryValIdx + btree.leafEntrySize - btree.keySize]))
+        else:
+            children = btree.partitionKeys(currentNode, keys, order)
+        btree.btree_buffer.returnBuffer(buffer_number)
+        return children, values
+
+    def close(self):
+        '''Waits for the searches started so far and stops the threads.'''
+        self.pool.close()
+        self.pool.join()
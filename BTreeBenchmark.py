@@ -0,0 +1,299 @@
+#-------------------------------------------------------------------------------
+# Name:        BTreeBenchmark
+# Purpose:     Reproducible benchmarks of the BTree module on synthetic trees
+#
+# Created:     16/10/2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+import argparse
+import json
+import os
+import random
+import shutil
+import struct
+import tempfile
+import timeit
+from BTreeBuffer import BTreeBuffer
+from BTreeFileIO import BTreeFileIO
+from BTreeDriver import OwnBTree, readRootRef
+
+HEADER_SIZE = 8         # The allocation counter and the root reference stored before the nodes, as in test.pst.
+NODE_METADATA_SIZE = 4  # cEnt, cEntMax, cbEntMax and cLevel stored at the end of every node.
+DISTRIBUTIONS = ('sequential', 'uniform', 'clustered')
+WORKLOADS = ('search', 'insert_sequential', 'insert_random', 'remove', 'mixed', 'scan', 'export')
+
+class CountingFileIO(BTreeFileIO):
+    '''BTreeFileIO counting the reads and writes of the PST file.'''
+
+    fileReads = 0   # Number of reads of the PST file.
+    fileWrites = 0  # Number of writes to the PST file.
+
+    def read(self, seek_pos, read_size):
+        self.fileReads = self.fileReads + 1
+        return BTreeFileIO.read(self, seek_pos, read_size)
+
+    def write(self, seek_pos, data):
+        self.fileWrites = self.fileWrites + 1
+        BTreeFileIO.write(self, seek_pos, data)
+
+
+class CountingBTree(OwnBTree):
+    '''OwnBTree counting the nodes read and written through readNodeIntoBuffer and writeNodeFromBuffer, including cache hits.'''
+
+    nodeReads = 0   # Number of calls of readNodeIntoBuffer.
+    nodeWrites = 0  # Number of calls of writeNodeFromBuffer.
+
+    def readNodeIntoBuffer(self, node_ref):
+        self.nodeReads = self.nodeReads + 1
+        return OwnBTree.readNodeIntoBuffer(self, node_ref)
+
+    def writeNodeFromBuffer(self, buffer_number, node_ref):
+        self.nodeWrites = self.nodeWrites + 1
+        return OwnBTree.writeNodeFromBuffer(self, buffer_number, node_ref)
+
+
+def treeGeometry(node_size, key_size, value_size):
+    '''Returns the nodeEntriesSize, nodeMetaData, nodeSize, entrySize, leafEntrySize and keySize of a synthetic BTree, in this order.
+       Intermediate entries hold a key and the 4 byte child reference written by OwnBTree.'''
+    entries_size = node_size - NODE_METADATA_SIZE
+    if entries_size / (key_size + value_size) > 255 or entries_size / (key_size + 4) < 3:
+        raise ValueError, 'node size does not fit between 3 and 255 entries per node'
+    return (entries_size, entries_size, node_size, key_size + 4, key_size + value_size, key_size)
+
+def generateKeys(count, distribution, key_size, rng):
+    '''Returns 'count' distinct keys in increasing order, drawn from the given distribution.
+       Sequential and clustered keys are even, so that odd keys next to them are known to be missing.
+       Keys are drawn from the lower half of the key space, leaving room for sequential inserts above them.
+       Raises ValueError if that half is too small to hold 'count' keys of the distribution.'''
+    max_key = (1 << (8 * key_size - 1)) - 1
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError, 'unknown key distribution %s' % distribution
+    if count < 1:
+        raise ValueError, 'a synthetic tree needs at least one entry'
+    if (distribution == 'uniform' and count > max_key) or (distribution != 'uniform' and 2 * count > max_key) or \
+       (distribution == 'clustered' and max_key / 2 - 64 < 1):
+        raise ValueError, '%d %s keys do not fit into the lower half of the %d byte key space' % (count, distribution, key_size)
+    if distribution == 'sequential':
+        return range(2, 2 * count + 1, 2)
+    keys = set()
+    while len(keys) < count:
+        if distribution == 'uniform':
+            keys.add(rng.randint(1, max_key))
+        elif distribution == 'clustered':
+            start = rng.randint(1, max_key / 2 - 64) * 2
+            keys.update(range(start, start + 2 * min(64, count - len(keys)), 2))
+    return sorted(keys)
+
+def leafEntry(key, key_size, value_size):
+    '''Returns the leaf entry of a synthetic BTree for 'key'. Its value repeats the key, so that values can be checked.'''
+    if key >= 1 << (8 * key_size):
+        raise ValueError, 'key 0x%x does not fit into %d bytes' % (key, key_size)
+    return bytearray(struct.pack('<Q', key)[:key_size] + (struct.pack('<Q', key) * (value_size / 8 + 1))[:value_size])
+
+def generateTree(path, keys, geometry, bulk_load = True, rng = None):
+    '''Writes a PST file at 'path' holding a BTree with a leaf entry for each of the sorted 'keys', and its root reference after the allocation counter.
+       The BTree is built with BTreeBulkLoad, or by inserting the keys in random order if 'bulk_load' is False.'''
+    pst_file = open(path, 'wb')
+    pst_file.write(struct.pack('<II', HEADER_SIZE, 0))
+    pst_file.close()
+
+    pst_file = open(path, 'rb+')
+    btree_buffer = BTreeBuffer(pst_file, 256, geometry[2], True)
+    btree = OwnBTree(btree_buffer, *geometry)
+    key_size = geometry[5]
+    value_size = geometry[4] - key_size
+    if bulk_load:
+        btree.BTreeBulkLoad(leafEntry(key, key_size, value_size) for key in keys)
+    else:
+        btree.BTreeCreate()
+        insert_keys = list(keys)
+        (rng or random.Random(0)).shuffle(insert_keys)
+        for key in insert_keys:
+            btree.BTreeInsertEntry(leafEntry(key, key_size, value_size))
+    btree_buffer.writeBytes(4, btree.toLitteEndian(btree.root_ref, 4))
+    btree_buffer.close()
+    pst_file.close()
+
+def searchOp(btree, key):
+    btree.BTreeSearch(key)
+
+def insertOp(btree, key):
+    btree.BTreeInsertEntry(leafEntry(key, btree.keySize, btree.leafEntrySize - btree.keySize))
+
+def removeOp(btree, key):
+    btree.BTreeRemoveEntry(key)
+
+def scanOp(btree, bounds):
+    for key, value in btree.BTreeScan(bounds[0], bounds[1]):
+        pass
+
+def newKeys(keys, count, key_size, rng):
+    '''Returns 'count' distinct random keys which are not in the sorted 'keys'.'''
+    present = set(keys)
+    max_key = (1 << (8 * key_size)) - 1
+    new_keys = []
+    while len(new_keys) < count:
+        key = rng.randint(1, max_key)
+        if key not in present:
+            present.add(key)
+            new_keys.append(key)
+    return new_keys
+
+def checkWorkloads(keys, op_count, key_size, workloads):
+    '''Raises ValueError if the inserts of the named workloads on a BTree holding the sorted 'keys' do not fit into the key space.'''
+    max_key = (1 << (8 * key_size)) - 1
+    if 'insert_sequential' in workloads and keys[-1] + op_count > max_key:
+        raise ValueError, '%d sequential inserts after key 0x%x do not fit into the %d byte key space' % (op_count, keys[-1], key_size)
+    if ('insert_random' in workloads or 'mixed' in workloads) and op_count > max_key - len(keys):
+        raise ValueError, '%d new keys do not fit into the %d byte key space next to %d present keys' % (op_count, key_size, len(keys))
+
+def workloadOps(workload, keys, op_count, key_size, rng, scan_length = 100):
+    '''Returns the list of (function, argument) operations of the named workload on a BTree holding the sorted 'keys'.'''
+    if workload == 'search':
+        # One search in ten is for a key which is not present.
+        return [(searchOp, rng.choice(keys) if rng.random() < 0.9 else rng.choice(keys) + 1) for count in range(op_count)]
+    if workload == 'insert_sequential':
+        return [(insertOp, keys[-1] + count + 1) for count in range(op_count)]
+    if workload == 'insert_random':
+        return [(insertOp, key) for key in newKeys(keys, op_count, key_size, rng)]
+    if workload == 'remove':
+        return [(removeOp, key) for key in rng.sample(keys, min(op_count, len(keys)))]
+    if workload == 'mixed':
+        # Half searches, a quarter inserts of new keys and a quarter removes of keys present at the start.
+        inserts = iter(newKeys(keys, op_count, key_size, rng))
+        removes = iter(rng.sample(keys, min(op_count, len(keys))))
+        ops = []
+        for count in range(op_count):
+            choice = rng.random()
+            if choice < 0.5:
+                ops.append((searchOp, rng.choice(keys)))
+            elif choice < 0.75:
+                ops.append((insertOp, next(inserts)))
+            else:
+                ops.append((removeOp, next(removes, keys[0])))
+        return ops
+    if workload == 'scan':
+        ops = []
+        for count in range(op_count):
+            position = rng.randrange(len(keys))
+            ops.append((scanOp, (keys[position], keys[min(position + scan_length - 1, len(keys) - 1)])))
+        return ops
+    if workload == 'export':
+        return [(scanOp, (None, None))]
+    raise ValueError, 'unknown workload %s' % workload
+
+def runWorkload(tree_path, geometry, ops, sections, caching, read_ahead):
+    '''Runs the given operations on a copy of the PST file at 'tree_path' and returns the statistics of the run.'''
+    handle, path = tempfile.mkstemp(suffix = '.pst')
+    os.close(handle)
+    shutil.copyfile(tree_path, path)
+    try:
+        pst_file = open(path, 'rb+')
+        file_io = CountingFileIO(pst_file)
+        btree_buffer = BTreeBuffer(pst_file, sections, geometry[2], caching, False, file_io, read_ahead)
+        btree = CountingBTree(btree_buffer, *(geometry + (readRootRef(btree_buffer),)))
+        file_io.fileReads = 0
+
+        latencies = []
+        timer = timeit.default_timer
+        start = timer()
+        for function, argument in ops:
+            op_start = timer()
+            function(btree, argument)
+            latencies.append(timer() - op_start)
+        btree_buffer.close()
+        seconds = timer() - start
+        pst_file.close()
+    finally:
+        os.remove(path)
+
+    latencies.sort()
+    op_count = len(ops)
+    return {'ops': op_count,
+            'seconds': seconds,
+            'ops_per_sec': op_count / seconds if seconds > 0 else None,
+            'p50_us': latencies[int(0.50 * (op_count - 1))] * 1e6,
+            'p99_us': latencies[int(0.99 * (op_count - 1))] * 1e6,
+            'node_reads_per_op': float(btree.nodeReads) / op_count,
+            'node_writes_per_op': float(btree.nodeWrites) / op_count,
+            'file_reads_per_op': float(file_io.fileReads) / op_count,
+            'file_writes_per_op': float(file_io.fileWrites) / op_count}
+
+def runBenchmark(entries = 20000, op_count = 2000, node_size = 512, key_size = 8, value_size = 16, distribution = 'uniform', seed = 0,
+                 sections = 64, caching = True, read_ahead = 0, bulk_load = True, workloads = WORKLOADS):
+    '''Generates a synthetic BTree and runs the named workloads on copies of it. Returns the report as a dictionary.
+       Runs with the same parameters and seed generate the same tree and the same operations.'''
+    rng = random.Random(seed)
+    geometry = treeGeometry(node_size, key_size, value_size)
+    keys = generateKeys(entries, distribution, key_size, rng)
+    checkWorkloads(keys, op_count, key_size, workloads)
+    handle, tree_path = tempfile.mkstemp(suffix = '.pst')
+    os.close(handle)
+    report = {'config': {'entries': entries, 'ops': op_count, 'node_size': node_size, 'key_size': key_size, 'value_size': value_size,
+                         'distribution': distribution, 'seed': seed, 'sections': sections, 'caching': caching,
+                         'read_ahead': read_ahead, 'bulk_load': bulk_load},
+              'results': {}}
+    try:
+        start = timeit.default_timer()
+        generateTree(tree_path, keys, geometry, bulk_load, rng)
+        report['generate_seconds'] = timeit.default_timer() - start
+        report['file_size'] = os.path.getsize(tree_path)
+        for workload in workloads:
+            ops = workloadOps(workload, keys, op_count, key_size, random.Random(seed * len(WORKLOADS) + WORKLOADS.index(workload)))
+            report['results'][workload] = runWorkload(tree_path, geometry, ops, sections, caching, read_ahead)
+    finally:
+        os.remove(tree_path)
+    return report
+
+def compareReports(old_report, new_report):
+    '''Returns lines comparing the ops per second and p99 latency of the workloads of two reports.'''
+    lines = []
+    for workload in sorted(new_report['results']):
+        if workload not in old_report['results']:
+            continue
+        old = old_report['results'][workload]
+        new = new_report['results'][workload]
+        lines.append('%-18s ops/sec %10.1f -> %10.1f (x%.2f)   p99 %9.1fus -> %9.1fus' %
+                     (workload, old['ops_per_sec'], new['ops_per_sec'], new['ops_per_sec'] / old['ops_per_sec'], old['p99_us'], new['p99_us']))
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Benchmarks the BTree module on a synthetic PST file.')
+    parser.add_argument('--entries', type = int, default = 20000, help = 'number of leaf entries of the generated tree')
+    parser.add_argument('--ops', type = int, default = 2000, help = 'number of operations of each workload')
+    parser.add_argument('--node-size', type = int, default = 512)
+    parser.add_argument('--key-size', type = int, default = 8, choices = (1, 2, 4, 8))
+    parser.add_argument('--value-size', type = int, default = 16)
+    parser.add_argument('--distribution', default = 'uniform', choices = DISTRIBUTIONS)
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--sections', type = int, default = 64, help = 'number of buffers of the BTreeBuffer')
+    parser.add_argument('--no-caching', action = 'store_true')
+    parser.add_argument('--read-ahead', type = int, default = 0)
+    parser.add_argument('--insert-built', action = 'store_true', help = 'build the tree by inserts instead of BTreeBulkLoad')
+    parser.add_argument('--workloads', nargs = '+', default = list(WORKLOADS), choices = WORKLOADS)
+    parser.add_argument('--output', help = 'path of the JSON report to write')
+    parser.add_argument('--compare', help = 'path of an earlier JSON report to compare with')
+    args = parser.parse_args()
+
+    try:
+        report = runBenchmark(args.entries, args.ops, args.node_size, args.key_size, args.value_size, args.distribution, args.seed,
+                              args.sections, not args.no_caching, args.read_ahead, not args.insert_built, args.workloads)
+    except ValueError, error:
+        parser.error(str(error))
+    for workload in args.workloads:
+        result = report['results'][workload]
+        print '%-18s %10.1f ops/sec  p50 %8.1fus  p99 %8.1fus  node reads/op %6.2f  node writes/op %6.2f' % \
+              (workload, result['ops_per_sec'], result['p50_us'], result['p99_us'], result['node_reads_per_op'], result['node_writes_per_op'])
+    if args.output:
+        report_file = open(args.output, 'w')
+        json.dump(report, report_file, indent = 2, sort_keys = True)
+        report_file.close()
+    if args.compare:
+        report_file = open(args.compare)
+        for line in compareReports(json.load(report_file), report):
+            print line
+        report_file.close()
+
+if __name__ == '__main__':
+    main()
@@ -9,6 +9,22 @@
 # Licence:     <your licence>
 #-------------------------------------------------------------------------------
 
+import bisect
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+import BTreeFileIO
+
+WAL_MAGIC = 'BTREEWAL'         # Marks the start of a write-ahead log written by commitBatch.
+WAL_COMMIT = 'BTWALEND'        # Marks the end of a complete write-ahead log. It is followed by the record count and checksum.
+WAL_RECORD = struct.Struct('<QI')   # Position in the PST file and length of the data of a write-ahead log record.
+WAL_TRAILER = struct.Struct('<II')  # Number of records and CRC-32 of the records of a write-ahead log.
+BUFFER_STATS = ('node_reads', 'node_writes', 'cache_hits', 'cache_misses', 'evictions', 'file_reads', 'file_writes',
+                'bytes_read', 'bytes_written', 'buffers_high_water') # Counters kept by BTreeBuffer.enableStats.
+
 class BTreeBufferException(RuntimeError):
     '''Class to raise BTreeBuffer Errors.'''
     "problem in bufferfile"
@@ -16,15 +32,38 @@ class BTreeBufferException(RuntimeError):
 
 class BTreeBuffer(object):
     '''BTreeBuffer implements a buffer for BTree module.
-       It implements getBuffer, resetBuffer, returnBuffer, readIntoBuffer and writeFromBuffer functions.'''
+       It implements getBuffer, resetBuffer, returnBuffer, holdBuffer, releaseBuffer, readIntoBuffer and writeFromBuffer functions.
+       If 'caching' is enabled the buffers also act as a write-back LRU cache of nodes keyed by their position in the PST file.
+       Cached nodes stay resident across BTree operations and dirty nodes are only written on eviction or flush.
+       If 'memory_map' is enabled the PST file is accessed through a shared memory map, otherwise through the BTreeFileIO object 'file_io'.
+       Between beginBatch and commitBatch all writes are kept in memory and are applied together through a write-ahead log.
+       If 'read_ahead' is more than 0 and caching is enabled, scans prefetch that many following sibling nodes (see prefetchNodes).'''
 
-    BufferList = []     # List containing bytearrays which act as buffers to BTree Nodes.
-    freeBufferQ = []    # Queue of buffers which are free to be alloted to BTree Nodes.
-    sections = 0        # Maximum Number of bytearray buffers which can be alloted.
-    buffersize = 0      # Size of the bytearray buffers.
-    pstfile = None      # The complete file path of the pst file to be buffered.
+    BufferList = []         # List containing bytearrays which act as buffers to BTree Nodes.
+    freeBufferQ = []        # Queue of buffers which are free to be alloted to BTree Nodes.
+    sections = 0            # Maximum Number of bytearray buffers which can be alloted.
+    buffersize = 0          # Size of the bytearray buffers.
+    pstfile = None          # The complete file path of the pst file to be buffered.
+    caching = False         # True if buffers keep their nodes cached after being returned.
+    cachedNodes = {}        # Maps the position of a cached node in the PST file to the buffer number holding it.
+    bufferPositions = []    # Position in the PST file of the node held by each buffer. None if the buffer holds no cached node.
+    bufferSizes = []        # Number of bytes of the cached node held by each buffer.
+    pinCounts = []          # Number of users of each cached buffer. Only buffers with no users can be evicted.
+    lruQ = None             # Cached buffers with no users, in least recently used first order.
+    dirtyBuffers = set()    # Cached buffers whose contents have not been written to the PST file yet.
+    heldBuffers = set()     # Buffers held across BTree operations (e.g. by a scan). They are not freed by resetBuffer.
+    changedBuffers = set()  # Buffers whose node was modified by the BTree since it was read or last written.
+    bufferNumbers = {}      # Maps the id of each bytearray in BufferList to its buffer number.
+    nodeKeys = []           # Decoded keys of the node held by each buffer (see BTree.getNodeKeys). None if not decoded since the node was read or changed.
+    fileIO = None           # The BTreeFileIO object used to read and write the PST file.
+    pstmap = None           # Shared memory map of the PST file. None if the file is accessed through fileIO.
+    batchWrites = None      # Maps the position of each write of the current batch to its data. None if no batch is in progress.
+    batchPositions = []     # Sorted positions of the writes in batchWrites. Writes never overlap each other.
+    walPath = None          # Path of the write-ahead log of the current batch.
+    readAhead = 0           # Number of sibling nodes following the current one which are prefetched into the cache by scans.
+    stats = None            # Counters of BUFFER_STATS, see enableStats. None while counting is disabled.
 
-    def __init__(self, pstfile, sections = 10, buffersize = 3850):
+    def __init__(self, pstfile, sections = 10, buffersize = 3850, caching = False, memory_map = False, file_io = None, read_ahead = 0):
         self.pstfile = pstfile
         self.sections = sections
         self.buffersize = buffersize
@@ -32,34 +71,593 @@ class BTreeBuffer(object):
         self.freeBufferQ = range(sections)
         for count in range(sections):
             self.BufferList[count] = bytearray(buffersize)
+        self.caching = caching
+        self.cachedNodes = {}
+        self.bufferPositions = [None] * sections
+        self.bufferSizes = [0] * sections
+        self.pinCounts = [0] * sections
+        self.lruQ = OrderedDict()
+        self.dirtyBuffers = set()
+        self.heldBuffers = set()
+        self.changedBuffers = set()
+        self.bufferNumbers = dict((id(self.BufferList[count]), count) for count in range(sections))
+        self.nodeKeys = [None] * sections
+        if file_io == None:
+            file_io = BTreeFileIO.BTreeFileIO(pstfile)
+        self.fileIO = file_io
+        self.pstmap = None
+        self.batchWrites = None
+        self.batchPositions = []
+        self.walPath = None
+        self.readAhead = read_ahead
+        self.stats = None
+        if memory_map:
+            self.fileIO.flush()
+            self.pstmap = mmap.mmap(self.pstfile.fileno(), 0)
 
     def getBuffer(self):
-        '''Returns an unallocated buffer.'''
+        '''Returns an unallocated buffer.
+           When caching, the least recently used cached node is evicted if no buffer is free.'''
         if self.freeBufferQ:
-            return self.freeBufferQ.pop(0)
-        raise BTreeBufferException, 'Too many buffers used'
+            buffer_number = self.freeBufferQ.pop(0)
+        elif self.caching and self.lruQ:
+            buffer_number = self.lruQ.popitem(False)[0]
+            self.uncacheBuffer(buffer_number, True)
+            if self.stats != None:
+                self.stats['evictions'] = self.stats['evictions'] + 1
+        else:
+            raise BTreeBufferException, 'Too many buffers used'
+        self.pinCounts[buffer_number] = 1
+        if self.stats != None:
+            self.countBuffersInUse()
+        self.changedBuffers.discard(buffer_number)
+        self.nodeKeys[buffer_number] = None
+        return buffer_number
+
+    def getNodeBuffer(self, seek_pos, read_size):
+        '''Returns a buffer holding 'read_size' bytes of the PST file from 'seek_pos'.
+           When caching, a cached copy of the node is reused and the PST file is only read on a cache miss.
+           If the read fails the buffer is returned before the error is raised.'''
+        if self.caching and seek_pos in self.cachedNodes:
+            buffer_number = self.cachedNodes[seek_pos]
+            if self.pinCounts[buffer_number] == 0:
+                del self.lruQ[buffer_number]
+            self.pinCounts[buffer_number] = self.pinCounts[buffer_number] + 1
+            if self.stats != None:
+                self.stats['node_reads'] = self.stats['node_reads'] + 1
+                self.stats['cache_hits'] = self.stats['cache_hits'] + 1
+                self.countBuffersInUse()
+            return buffer_number
+        buffer_number = self.getBuffer()
+        try:
+            self.readIntoBuffer(buffer_number, seek_pos, read_size)
+        except:
+            self.returnBuffer(buffer_number)
+            raise
+        if self.stats != None:
+            self.stats['node_reads'] = self.stats['node_reads'] + 1
+            self.stats['cache_misses'] = self.stats['cache_misses'] + 1
+        return buffer_number
 
     def resetBuffer(self):
-        '''Frees all buffers, i.e. sets all buffers as unallocated.'''
-        self.freeBufferQ = range(self.sections)
+        '''Frees all buffers, i.e. sets all buffers as unallocated.
+           When caching, the cached nodes are kept and only become evictable.
+           Held buffers are left allocated.'''
+        if self.caching:
+            self.freeBufferQ = []
+            for buffer_number in range(self.sections):
+                if buffer_number in self.heldBuffers:
+                    continue
+                self.pinCounts[buffer_number] = 0
+                if self.bufferPositions[buffer_number] == None:
+                    self.freeBufferQ.append(buffer_number)
+                elif buffer_number not in self.lruQ:
+                    self.lruQ[buffer_number] = None
+        else:
+            self.freeBufferQ = [buffer_number for buffer_number in range(self.sections) if buffer_number not in self.heldBuffers]
+
+    def holdBuffer(self, buffer_number):
+        '''Keeps the given allocated buffer allocated across resetBuffer calls until it is released.'''
+        self.heldBuffers.add(buffer_number)
+
+    def releaseBuffer(self, buffer_number):
+        '''Releases a held buffer and returns it.'''
+        self.heldBuffers.discard(buffer_number)
+        self.returnBuffer(buffer_number)
 
     def returnBuffer(self, buffer_number):
-        '''Returns given buffer to unallocated buffer queue.'''
-        self.freeBufferQ.append(buffer_number)
+        '''Returns given buffer to unallocated buffer queue.
+           When caching, a buffer holding a cached node is kept as the most recently used node instead.'''
+        if self.caching:
+            if self.pinCounts[buffer_number] > 0:
+                self.pinCounts[buffer_number] = self.pinCounts[buffer_number] - 1
+            if self.pinCounts[buffer_number] > 0:
+                return
+            if self.bufferPositions[buffer_number] != None:
+                self.lruQ[buffer_number] = None
+            elif buffer_number not in self.freeBufferQ:
+                self.freeBufferQ.append(buffer_number)
+        else:
+            self.freeBufferQ.append(buffer_number)
 
     def readIntoBuffer(self, buffer_number, seek_pos, read_size):
-        '''Reads bytes into given buffer from the PST file from 'seek_pos' till the given 'read_size'.'''
+        '''Reads bytes into given buffer from the PST file from 'seek_pos' till the given 'read_size'.
+           When caching, the buffer is only kept as the cached copy of the node if the read succeeds.'''
         if(read_size <= self.buffersize):
-            self.pstfile.seek(seek_pos)
-            byte_string = self.pstfile.read(read_size)
-            count = 0
-            while count < read_size:
-                self.BufferList[buffer_number][count] = byte_string[count]
-                count = count + 1
+            if self.caching:
+                if self.bufferPositions[buffer_number] != None:
+                    self.uncacheBuffer(buffer_number, True)
+                self.cacheBuffer(buffer_number, seek_pos, read_size)
+                try:
+                    self.readFromFile(buffer_number, seek_pos, read_size)
+                except:
+                    # A buffer which could not be read must not stay cached as a copy of the node.
+                    self.uncacheBuffer(buffer_number, False)
+                    raise
+            else:
+                self.readFromFile(buffer_number, seek_pos, read_size)
         else:
             raise BTreeBufferException, 'Too big to read into Buffer'
+        self.changedBuffers.discard(buffer_number)
+        self.nodeKeys[buffer_number] = None
+
+    def bufferNumberOf(self, buffer_array):
+        '''Returns the buffer number of the given bytearray from BufferList.'''
+        return self.bufferNumbers[id(buffer_array)]
+
+    def markChanged(self, buffer_number):
+        '''Marks the node held by the given buffer as modified since it was read or last written.
+           Its decoded keys are dropped, so this must be called after every change to the entries of a node.'''
+        self.changedBuffers.add(buffer_number)
+        self.nodeKeys[buffer_number] = None
+
+    def clearChanged(self, buffer_number):
+        '''Marks the node held by the given buffer as unmodified, e.g. after writing it.'''
+        self.changedBuffers.discard(buffer_number)
+
+    def isChanged(self, buffer_number):
+        '''Returns True if the node held by the given buffer was modified since it was read or last written.'''
+        return buffer_number in self.changedBuffers
 
     def writeFromBuffer(self, buffer_number, seek_pos, write_till):
-        '''Writes bytes from given buffer into the PST file from 'seek_pos' to 'write_till'.'''
-        self.pstfile.seek(seek_pos)
-        self.pstfile.write(self.BufferList[buffer_number][:write_till])
+        '''Writes bytes from given buffer into the PST file from 'seek_pos' to 'write_till'.
+           When caching, the buffer is only marked dirty and is written on eviction or flush.'''
+        if self.stats != None:
+            self.stats['node_writes'] = self.stats['node_writes'] + 1
+        if self.caching:
+            self.cacheBuffer(buffer_number, seek_pos, write_till)
+            self.dirtyBuffers.add(buffer_number)
+        else:
+            self.writeToFile(buffer_number, seek_pos, write_till)
+
+    def readFromFile(self, buffer_number, seek_pos, read_size):
+        '''Copies 'read_size' bytes of the PST file from 'seek_pos' into the given buffer in a single slice assignment.'''
+        if self.stats != None:
+            self.countTransfer('file_reads', 'bytes_read', read_size)
+        if self.batchWrites != None:
+            self.BufferList[buffer_number][:read_size] = self.readBatch(seek_pos, read_size)
+        elif self.pstmap != None:
+            self.mapForRead(seek_pos, read_size)
+            self.BufferList[buffer_number][:read_size] = self.pstmap[seek_pos : seek_pos + read_size]
+        else:
+            byte_string = self.fileIO.read(seek_pos, read_size)
+            if len(byte_string) != read_size:
+                raise BTreeBufferException, 'Read beyond the end of PST file'
+            self.BufferList[buffer_number][:read_size] = byte_string
+
+    def writeToFile(self, buffer_number, seek_pos, write_till):
+        '''Writes the first 'write_till' bytes of the given buffer into the PST file at 'seek_pos' without copying them.
+           During a batch the bytes are copied into the batch instead.'''
+        if self.batchWrites != None:
+            self.stageWrite(seek_pos, self.BufferList[buffer_number][:write_till])
+            return
+        if self.stats != None:
+            self.countTransfer('file_writes', 'bytes_written', write_till)
+        if self.pstmap != None:
+            if seek_pos + write_till > len(self.pstmap):
+                self.remapFile(seek_pos + write_till)
+            self.pstmap.seek(seek_pos)
+            self.pstmap.write(buffer(self.BufferList[buffer_number], 0, write_till))
+        else:
+            self.fileIO.write(seek_pos, memoryview(self.BufferList[buffer_number])[:write_till])
+
+    def readBytes(self, seek_pos, read_size):
+        '''Returns 'read_size' bytes of the PST file from 'seek_pos' as a bytearray, bypassing the buffers.
+           Used for data outside of nodes, e.g. allocation counters and deletion markers.'''
+        if self.stats != None:
+            self.countTransfer('file_reads', 'bytes_read', read_size)
+        if self.batchWrites != None:
+            return self.readBatch(seek_pos, read_size)
+        if self.pstmap != None:
+            self.mapForRead(seek_pos, read_size)
+            return bytearray(self.pstmap[seek_pos : seek_pos + read_size])
+        return bytearray(self.fileIO.read(seek_pos, read_size))
+
+    def writeBytes(self, seek_pos, data):
+        '''Writes the given bytes into the PST file at 'seek_pos', bypassing the buffers.'''
+        if self.batchWrites != None:
+            self.stageWrite(seek_pos, bytearray(data))
+        else:
+            self.writeAt(seek_pos, data)
+
+    def writeAt(self, seek_pos, data):
+        '''Writes the given bytes into the PST file at 'seek_pos', even during a batch.'''
+        if self.stats != None:
+            self.countTransfer('file_writes', 'bytes_written', len(data))
+        if self.pstmap != None:
+            if seek_pos + len(data) > len(self.pstmap):
+                self.remapFile(seek_pos + len(data))
+            self.pstmap.seek(seek_pos)
+            self.pstmap.write(buffer(data))
+        else:
+            self.fileIO.write(seek_pos, data)
+
+    def fileSize(self):
+        '''Returns the current size of the PST file in bytes, including the writes of the current batch.'''
+        if self.batchWrites != None and self.batchPositions:
+            last_pos = self.batchPositions[-1]
+            return max(self.rawFileSize(), last_pos + len(self.batchWrites[last_pos]))
+        return self.rawFileSize()
+
+    def rawFileSize(self):
+        '''Returns the current size of the PST file in bytes, leaving out the writes of the current batch.'''
+        if self.pstmap != None:
+            self.fileIO.flush()
+            return max(len(self.pstmap), self.fileIO.size())
+        return self.fileIO.size()
+
+    def remapFile(self, min_size):
+        '''Grows the memory map to cover at least 'min_size' bytes, extending the PST file if needed. Only used by writes, see mapForRead.'''
+        self.fileIO.flush()
+        self.pstmap.resize(max(min_size, self.fileIO.size()))
+
+    def mapForRead(self, seek_pos, read_size):
+        '''Makes sure the memory map covers 'read_size' bytes from 'seek_pos' before they are read.
+           The map is only grown up to the size of the PST file. Reading beyond its end raises an error instead of extending it.'''
+        if seek_pos + read_size > len(self.pstmap):
+            if seek_pos + read_size > self.rawFileSize():
+                raise BTreeBufferException, 'Read beyond the end of PST file'
+            self.remapFile(seek_pos + read_size)
+
+    def cacheBuffer(self, buffer_number, seek_pos, size):
+        '''Makes the given buffer the cached copy of the node at 'seek_pos'.
+           Any other cached copy of the node is dropped after writing it back if it is dirty.'''
+        if self.bufferPositions[buffer_number] != seek_pos:
+            if self.bufferPositions[buffer_number] != None:
+                self.uncacheBuffer(buffer_number, True)
+            if seek_pos in self.cachedNodes:
+                self.discardNode(seek_pos, True)
+            self.cachedNodes[seek_pos] = buffer_number
+            self.bufferPositions[buffer_number] = seek_pos
+        self.bufferSizes[buffer_number] = size
+
+    def uncacheBuffer(self, buffer_number, write_back):
+        '''Removes the node held by the given buffer from the cache.
+           The node is written to the PST file first if it is dirty and 'write_back' is True.'''
+        if buffer_number in self.dirtyBuffers:
+            if write_back:
+                self.writeToFile(buffer_number, self.bufferPositions[buffer_number], self.bufferSizes[buffer_number])
+            self.dirtyBuffers.discard(buffer_number)
+        del self.cachedNodes[self.bufferPositions[buffer_number]]
+        self.bufferPositions[buffer_number] = None
+
+    def enableStats(self):
+        '''Starts counting, from zero, the nodes read through getNodeBuffer and written through writeFromBuffer, the cache hits, misses and evictions,
+           the reads and writes of the PST file with the bytes they transfer, and the highest number of buffers in use at once.
+           Writes kept in a batch are counted when the batch is applied. While disabled, counting costs a single test per counted event.'''
+        self.stats = dict.fromkeys(BUFFER_STATS, 0)
+
+    def disableStats(self):
+        '''Stops counting.'''
+        self.stats = None
+
+    def resetStats(self):
+        '''Sets all counters back to zero, if counting is enabled.'''
+        if self.stats != None:
+            self.enableStats()
+
+    def getStats(self):
+        '''Returns a snapshot of the counters as a dictionary, or None if counting is disabled.'''
+        if self.stats == None:
+            return None
+        return dict(self.stats)
+
+    def countTransfer(self, counter, byte_counter, size):
+        '''Counts a read or write of the PST file transferring 'size' bytes.'''
+        self.stats[counter] = self.stats[counter] + 1
+        self.stats[byte_counter] = self.stats[byte_counter] + size
+
+    def countBuffersInUse(self):
+        '''Updates the highest number of buffers in use at once, i.e. neither free nor holding an evictable cached node.'''
+        self.stats['buffers_high_water'] = max(self.stats['buffers_high_water'], self.sections - len(self.freeBufferQ) - len(self.lruQ))
+
+    def isCached(self, seek_pos):
+        '''Returns True if the node at 'seek_pos' is in the cache.'''
+        return seek_pos in self.cachedNodes
+
+    def prefetchNodes(self, node_positions, read_size):
+        '''Reads the nodes of 'read_size' bytes at the given positions of the PST file into the cache ahead of their use.
+           Nodes which are already cached are skipped, and runs of nodes which are adjacent in the file are read with a single read.
+           At most as many nodes are read as there are free or evictable buffers, so prefetched nodes never evict each other.
+           Nothing is read if caching is disabled.'''
+        if not self.caching:
+            return
+        positions = [seek_pos for seek_pos in node_positions if seek_pos not in self.cachedNodes]
+        positions = sorted(set(positions[: len(self.freeBufferQ) + len(self.lruQ)]))
+        index = 0
+        while index < len(positions):
+            run_end = index + 1
+            while run_end < len(positions) and positions[run_end] == positions[run_end - 1] + read_size:
+                run_end = run_end + 1
+            data = self.readBytes(positions[index], (run_end - index) * read_size)
+            for number in range(index, min(run_end, index + len(data) // read_size)):
+                buffer_number = self.getBuffer()
+                self.cacheBuffer(buffer_number, positions[number], read_size)
+                offset = (number - index) * read_size
+                self.BufferList[buffer_number][:read_size] = data[offset : offset + read_size]
+                self.returnBuffer(buffer_number)
+            index = run_end
+
+    def discardNode(self, seek_pos, write_back = False):
+        '''Drops the cached copy of the node at 'seek_pos', if any.
+           BTree.freeNode calls this when a node is deleted so that a stale dirty copy is never written back.'''
+        if self.caching and seek_pos in self.cachedNodes:
+            buffer_number = self.cachedNodes[seek_pos]
+            self.uncacheBuffer(buffer_number, write_back)
+            if self.pinCounts[buffer_number] == 0:
+                del self.lruQ[buffer_number]
+                self.freeBufferQ.append(buffer_number)
+
+    def flush(self):
+        '''Writes all dirty cached nodes to the PST file in the order of their position in the file.
+           During a batch the nodes are only added to the batch.'''
+        self.writeBackDirty()
+        if self.batchWrites != None:
+            return
+        if self.pstmap != None:
+            self.pstmap.flush()
+        self.fileIO.flush()
+
+    def writeBackDirty(self):
+        '''Writes all dirty cached nodes in the order of their position in the file and marks them clean.'''
+        for buffer_number in sorted(self.dirtyBuffers, key = lambda number: self.bufferPositions[number]):
+            self.writeToFile(buffer_number, self.bufferPositions[buffer_number], self.bufferSizes[buffer_number])
+        self.dirtyBuffers.clear()
+
+    def dropCache(self):
+        '''Forgets all cached nodes without writing them back and frees every buffer which is not held.'''
+        self.cachedNodes = {}
+        self.bufferPositions = [None] * self.sections
+        self.bufferSizes = [0] * self.sections
+        self.pinCounts = [0] * self.sections
+        self.lruQ = OrderedDict()
+        self.dirtyBuffers = set()
+        self.changedBuffers = set()
+        self.nodeKeys = [None] * self.sections
+        self.freeBufferQ = [buffer_number for buffer_number in range(self.sections) if buffer_number not in self.heldBuffers]
+
+    def beginBatch(self, wal_path = None):
+        '''Starts a batch. Until commitBatch or abortBatch, writes are kept in memory and reads see the written data.
+           Dirty cached nodes written before the batch are written back first, so that abortBatch only throws away the writes of the batch.
+           'wal_path' is the path of the write-ahead log used to commit the batch. It defaults to the PST file path followed by '.wal'.'''
+        if self.batchWrites != None:
+            raise BTreeBufferException, 'A batch is already in progress'
+        self.writeBackDirty()
+        if wal_path == None:
+            wal_path = self.pstfile.name + '.wal'
+        self.batchWrites = {}
+        self.batchPositions = []
+        self.walPath = wal_path
+
+    def commitBatch(self):
+        '''Ends the batch and applies its writes to the PST file.
+           The final data of all writes is first appended to the write-ahead log in one sequential write and synced.
+           The writes are then applied to the PST file in the order of their position, the PST file is synced once and the log is removed.
+           If the process dies after the log is synced, recoverBatch applies the writes again.'''
+        if self.batchWrites == None:
+            raise BTreeBufferException, 'No batch in progress'
+        self.writeBackDirty()
+        records = []
+        for seek_pos in self.batchPositions:
+            data = self.batchWrites[seek_pos]
+            records.append(WAL_RECORD.pack(seek_pos, len(data)))
+            records.append(str(data))
+        records = ''.join(records)
+
+        wal_file = open(self.walPath, 'wb')
+        try:
+            wal_file.write(WAL_MAGIC + records + WAL_COMMIT + WAL_TRAILER.pack(len(self.batchPositions), zlib.crc32(records) & 0xFFFFFFFF))
+            wal_file.flush()
+            os.fsync(wal_file.fileno())
+        finally:
+            wal_file.close()
+
+        batch_writes = self.batchWrites
+        batch_positions = self.batchPositions
+        self.batchWrites = None
+        self.batchPositions = []
+        for seek_pos in batch_positions:
+            self.writeAt(seek_pos, batch_writes[seek_pos])
+        self.syncFile()
+        os.remove(self.walPath)
+        self.walPath = None
+
+    def abortBatch(self):
+        '''Ends the batch and throws its writes away. Cached nodes are dropped as they may hold data written in the batch.
+           Nodes written before the batch are not lost, as beginBatch has written them back.'''
+        if self.batchWrites == None:
+            raise BTreeBufferException, 'No batch in progress'
+        self.batchWrites = None
+        self.batchPositions = []
+        self.walPath = None
+        self.dropCache()
+
+    def recoverBatch(self, wal_path = None):
+        '''Applies the write-ahead log of a batch whose commit was interrupted, then removes the log.
+           A log which is incomplete was never applied and is only removed. Returns True if writes were applied.
+           'wal_path' defaults to the PST file path followed by '.wal'. It must be called before the PST file is used.'''
+        if wal_path == None:
+            wal_path = self.pstfile.name + '.wal'
+        if not os.path.exists(wal_path):
+            return False
+        wal_file = open(wal_path, 'rb')
+        try:
+            log = wal_file.read()
+        finally:
+            wal_file.close()
+
+        writes = []
+        trailer_pos = len(log) - len(WAL_COMMIT) - WAL_TRAILER.size
+        complete = log.startswith(WAL_MAGIC) and trailer_pos >= len(WAL_MAGIC) and log[trailer_pos : trailer_pos + len(WAL_COMMIT)] == WAL_COMMIT
+        if complete:
+            records = log[len(WAL_MAGIC) : trailer_pos]
+            count, checksum = WAL_TRAILER.unpack_from(log, trailer_pos + len(WAL_COMMIT))
+            complete = zlib.crc32(records) & 0xFFFFFFFF == checksum
+            index = 0
+            while complete and index < len(records):
+                seek_pos, size = WAL_RECORD.unpack_from(records, index)
+                index = index + WAL_RECORD.size
+                writes.append((seek_pos, records[index : index + size]))
+                index = index + size
+            complete = complete and len(writes) == count
+
+        if complete:
+            for seek_pos, data in writes:
+                self.writeAt(seek_pos, data)
+            self.syncFile()
+        os.remove(wal_path)
+        return complete
+
+    def syncFile(self):
+        '''Flushes the PST file, or its memory map, to disk.'''
+        if self.pstmap != None:
+            self.pstmap.flush()
+        self.fileIO.sync()
+
+    def stageWrite(self, seek_pos, data):
+        '''Adds a write of the given bytearray at 'seek_pos' to the batch.
+           Writes overlapping earlier writes of the batch are merged with them, the later data taking precedence.'''
+        end_pos = seek_pos + len(data)
+        first = bisect.bisect_right(self.batchPositions, seek_pos)
+        if first > 0 and self.batchPositions[first - 1] + len(self.batchWrites[self.batchPositions[first - 1]]) > seek_pos:
+            first = first - 1
+        last = bisect.bisect_left(self.batchPositions, end_pos)
+
+        if first < last:
+            merge_pos = min(seek_pos, self.batchPositions[first])
+            last_pos = self.batchPositions[last - 1]
+            merged = bytearray(max(end_pos, last_pos + len(self.batchWrites[last_pos])) - merge_pos)
+            for old_pos in self.batchPositions[first : last]:
+                old_data = self.batchWrites.pop(old_pos)
+                merged[old_pos - merge_pos : old_pos - merge_pos + len(old_data)] = old_data
+            merged[seek_pos - merge_pos : end_pos - merge_pos] = data
+            del self.batchPositions[first : last]
+            seek_pos = merge_pos
+            data = merged
+        self.batchPositions.insert(first, seek_pos)
+        self.batchWrites[seek_pos] = data
+
+    def unstageWrite(self, seek_pos, size):
+        '''Removes the 'size' bytes from 'seek_pos' from the writes of the batch, so that the PST file keeps its data there.'''
+        end_pos = seek_pos + size
+        first = bisect.bisect_right(self.batchPositions, seek_pos)
+        if first > 0 and self.batchPositions[first - 1] + len(self.batchWrites[self.batchPositions[first - 1]]) > seek_pos:
+            first = first - 1
+        last = bisect.bisect_left(self.batchPositions, end_pos)
+
+        kept_positions = []
+        for write_pos in self.batchPositions[first : last]:
+            data = self.batchWrites.pop(write_pos)
+            if write_pos < seek_pos:
+                self.batchWrites[write_pos] = data[: seek_pos - write_pos]
+                kept_positions.append(write_pos)
+            if write_pos + len(data) > end_pos:
+                self.batchWrites[end_pos] = data[end_pos - write_pos :]
+                kept_positions.append(end_pos)
+        self.batchPositions[first : last] = kept_positions
+
+    def readBatch(self, seek_pos, read_size):
+        '''Returns 'read_size' bytes from 'seek_pos' as a bytearray, as they will be after the writes of the batch.'''
+        file_size = self.rawFileSize()
+        if seek_pos + read_size > self.fileSize():
+            raise BTreeBufferException, 'Read beyond the end of PST file'
+        result = bytearray(read_size)
+        if seek_pos < file_size:
+            file_read = min(read_size, file_size - seek_pos)
+            if self.pstmap != None:
+                self.mapForRead(seek_pos, file_read)
+                result[:file_read] = self.pstmap[seek_pos : seek_pos + file_read]
+            else:
+                result[:file_read] = self.fileIO.read(seek_pos, file_read)
+
+        end_pos = seek_pos + read_size
+        index = bisect.bisect_right(self.batchPositions, seek_pos)
+        if index > 0:
+            index = index - 1
+        while index < len(self.batchPositions) and self.batchPositions[index] < end_pos:
+            write_pos = self.batchPositions[index]
+            data = self.batchWrites[write_pos]
+            start = max(seek_pos, write_pos)
+            end = min(end_pos, write_pos + len(data))
+            if start < end:
+                result[start - seek_pos : end - seek_pos] = data[start - write_pos : end - write_pos]
+            index = index + 1
+        return result
+
+    def close(self):
+        '''Flushes the buffer, releases the memory map of the PST file, if any, and closes the BTreeFileIO.
+           The PST file itself is left open.'''
+        if self.batchWrites != None:
+            raise BTreeBufferException, 'A batch is still in progress'
+        self.flush()
+        if self.pstmap != None:
+            self.pstmap.close()
+            self.pstmap = None
+        self.fileIO.close()
+
+
+class BTreeBufferPool(object):
+    '''BTreeBufferPool gives every thread its own BTreeBuffer, created on first use, over one shared PST file.
+       Attribute access is forwarded to the BTreeBuffer of the calling thread, so a pool can be passed to a BTree in place of a BTreeBuffer.
+       All buffers read the PST file through one BTreeFileIO object, by default a PositionalFileIO,
+       so many threads can run BTreeSearch, BTreeSearchMany and BTreeScan on the same BTree at the same time.
+       The buffers do not share cached nodes. While a thread modifies the BTree no other thread may use it,
+       and the other threads must not cache nodes or must drop their caches afterwards.'''
+
+    pstfile = None          # The PST file to be buffered.
+    sections = 0            # Number of buffers of the BTreeBuffer of each thread.
+    buffersize = 0          # Size of the buffers of the BTreeBuffer of each thread.
+    caching = False         # True if the BTreeBuffer of each thread caches nodes.
+    fileIO = None           # The BTreeFileIO object shared by the BTreeBuffers of all threads.
+    threadBuffers = None    # Thread local storage holding the BTreeBuffer of each thread.
+    buffers = []            # The BTreeBuffers created so far, for all threads.
+    readAhead = 0           # Number of sibling nodes prefetched by scans in the BTreeBuffer of each thread.
+
+    def __init__(self, pstfile, sections = 10, buffersize = 3850, caching = False, file_io = None, read_ahead = 0):
+        self.pstfile = pstfile
+        self.sections = sections
+        self.buffersize = buffersize
+        self.caching = caching
+        self.readAhead = read_ahead
+        if file_io == None:
+            file_io = BTreeFileIO.PositionalFileIO(pstfile)
+        self.fileIO = file_io
+        self.threadBuffers = threading.local()
+        self.buffers = []
+
+    def threadBuffer(self):
+        '''Returns the BTreeBuffer of the calling thread, creating it on first use.'''
+        thread_buffer = getattr(self.threadBuffers, 'btree_buffer', None)
+        if thread_buffer == None:
+            thread_buffer = BTreeBuffer(self.pstfile, self.sections, self.buffersize, self.caching, False, self.fileIO, self.readAhead)
+            self.threadBuffers.btree_buffer = thread_buffer
+            self.buffers.append(thread_buffer)
+        return thread_buffer
+
+    def __getattr__(self, name):
+        return getattr(self.threadBuffer(), name)
+
+    def close(self):
+        '''Flushes the BTreeBuffers of all threads and closes the BTreeFileIO. The PST file itself is left open.'''
+        for thread_buffer in self.buffers:
+            thread_buffer.close()
@@ -9,8 +9,13 @@
 # Licence:     <your licence>
 #-------------------------------------------------------------------------------
 
+import threading
 from BTree import BTree
-from BTreeBuffer import BTreeBuffer
+from BTreeBuffer import BTreeBuffer, BTreeBufferPool
+from BTreeAllocator import FreeListAllocator
+from BTreeQuery import BTreeQueryEngine
+from BTreeAsync import BTreeAsync
+from BTreeTrace import BTreeTraceRecorder
 
 class OwnBTree(BTree):
     def readNodeIntoBuffer(self, node_ref):
@@ -19,9 +24,7 @@ class OwnBTree(BTree):
            For e.g., maintaining page trailer, heap page map etc.
            Return the buffer number where the node is buffered at the end.'''
         #raise NotImplementedError('Implement readNodeIntoBuffer in class')
-        buffer_number = self.btree_buffer.getBuffer()
-        self.btree_buffer.readIntoBuffer(buffer_number, node_ref, self.nodeSize)
-        return buffer_number
+        return self.btree_buffer.getNodeBuffer(node_ref, self.nodeSize)
 
     def writeNodeFromBuffer(self, buffer_number, node_ref):
         '''A method to write BTree Node from buffer to PST file.
@@ -32,38 +35,28 @@ class OwnBTree(BTree):
         self.btree_buffer.writeFromBuffer(buffer_number, node_ref, self.nodeSize)
         return node_ref
 
-    def genIntermediateEntry(self, key, node_ref):
-        '''Returns a generated Itermediate Entry with given key and reference.
-           The Intermediate entry bytearray MUST be of size non Leaf Entry (entrySize).'''
-        #raise NotImplementedError, 'Implement genIntermediateEntry in class'
-        entry = self.toLitteEndian(key, self.keySize) + self.toLitteEndian(node_ref, 4)
-        return entry
-
-
-    def getChildRef(self, entry):
-        '''Returns the the reference to a child node in an entry.'''
-        #raise NotImplementedError('Implement getChild in class')
-        child_ref = self.toBigEndian(entry[self.keySize:])
-        return child_ref
+    # genIntermediateEntry and getChildRef are inherited: the intermediate entries of the test file are a little-endian key
+    # followed by a 4 byte little-endian child reference, which the NodeLayout of BTree encodes and decodes.
 
     def allocateNode(self):
         '''Returns an reference where a new node can can be written to.'''
         #raise NotImplementedError('Implement allocateNode in class')
-        self.btree_buffer.pstfile.seek(0)
-        location = self.toBigEndian(bytearray(self.btree_buffer.pstfile.read(4)))
+        location = self.toBigEndian(self.btree_buffer.readBytes(0, 4))
 
         new_location = location + self.nodeSize
 
-        self.btree_buffer.pstfile.seek(0)
-        self.btree_buffer.pstfile.write(self.toLitteEndian(new_location, 4))
+        self.btree_buffer.writeBytes(0, self.toLitteEndian(new_location, 4))
         return location
 
     def delNodeAllocation(self, node_ref):
         '''Deletes a given node and its allocation.'''
         #raise NotImplementedError('Implement delNodeAllocation in class')
         del_indicator = 0xFFFFFFFF
-        self.btree_buffer.pstfile.seek(node_ref)
-        self.btree_buffer.pstfile.write(self.toLitteEndian(del_indicator, 4))
+        self.btree_buffer.writeBytes(node_ref, self.toLitteEndian(del_indicator, 4))
+
+    def isDeletedNode(self, currentNode):
+        '''Returns True if the given node carries the deletion marker written by delNodeAllocation.'''
+        return self.toBigEndian(currentNode[0:4]) == 0xFFFFFFFF
 
 def toBigEndian(bytelist):
     result = 0
@@ -73,17 +66,36 @@ def toBigEndian(bytelist):
         shift = shift + 8
     return result
 
+def toLitteEndian(number, size):
+    result = bytearray(size)
+    count = 0
+    while count < size:
+        result[count] = (number >> (count * 8)) & 0xFF
+        count = count + 1
+    return result
+
+def readRootRef(btree_buffer):
+    '''Returns the root reference of the BTree of the test file, which is stored after the allocation counter.'''
+    return toBigEndian(btree_buffer.readBytes(4, 4))
+
+def writeRootRef(btree_buffer, root_ref):
+    '''Stores the root reference of the BTree of the test file after the allocation counter.'''
+    btree_buffer.writeBytes(4, toLitteEndian(root_ref, 4))
+
 def main():
 
     ## Opening the test file for BTree
     pst_file = open('test.pst', 'rb+')
 
+    ## Applying a batch whose commit was interrupted, if any
+    new_buffer = BTreeBuffer(pst_file, caching = True)
+    new_buffer.recoverBatch()
+
     ## Reading root reference of the BTree from file
-    pst_file.seek(4)
-    root_loc = toBigEndian(bytearray(pst_file.read(4)))
+    root_loc = readRootRef(new_buffer)
 
     ## Preparing the BTree
-    new_buffer = BTreeBuffer(pst_file)
+    new_allocator = FreeListAllocator(8) # Nodes start after the allocation counter and the root reference.
     test_btree = OwnBTree(new_buffer,   # BTreeBuffer object to be used by the BTree object.
                           60,           # nodeEntrySize
                           60,           # nodeMetaData
@@ -91,23 +103,103 @@ def main():
                           8,            # entrySize
                           12,           # leafEntrySize
                           4,            # keySize
-                          root_loc)     # root_ref
+                          root_loc,     # root_ref
+                          new_allocator) # node_allocator
 
     ## Test for BTreeSearch
     # key = 0x32
     # test_btree.printByteArray(test_btree.BTreeSearch(key))
 
+    ## Test for BTreeSearchMany
+    # for value in test_btree.BTreeSearchMany([0x62, 0x10, 0x33]):
+    #     test_btree.printByteArray(value)
+
+    ## Test for BTreeScan
+    # for key, value in test_btree.BTreeScan(0x20, 0x60):
+    #     print key,
+    #     test_btree.printByteArray(value)
+
     ## Test for BTreeInsertEntry
     # new_entry = bytearray('\x10\x01\x00\x00\x10\x01\x00\x00\x00\x00\x00\x00')
     # test_btree.BTreeInsertEntry(new_entry)
 
+    ## Test for BTreeUpdateEntry and BTreeUpsertEntry
+    # new_entry = bytearray('\x32\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00')
+    # test_btree.BTreeUpdateEntry(new_entry)
+    # test_btree.BTreeUpsertEntry(new_entry)
+
     ## Test for BTreeRemoveEntry
     # key = 0x70
     # test_btree.BTreeRemoveEntry(key)
 
+    ## Test for BTreeRemoveRange and BTreeRemoveMany
+    # test_btree.BTreeRemoveRange(0x20, 0x40)
+    # test_btree.BTreeRemoveMany([0x10, 0x62, 0x70])
+
+    ## Test for BTreeBulkLoad
+    # new_entries = [bytearray('\x10\x01\x00\x00\x10\x01\x00\x00\x00\x00\x00\x00'),
+    #                bytearray('\x20\x01\x00\x00\x20\x01\x00\x00\x00\x00\x00\x00')]
+    # test_btree.BTreeBulkLoad(new_entries)
+
+    ## Test for batch, storing the new root reference in the same commit
+    # with test_btree.batch(root_writer = lambda root_ref: writeRootRef(new_buffer, root_ref)):
+    #     test_btree.BTreeInsertEntry(bytearray('\x10\x01\x00\x00\x10\x01\x00\x00\x00\x00\x00\x00'))
+    #     test_btree.BTreeRemoveEntry(0x70)
+
+    ## Test for BTreeCompact
+    # test_btree.BTreeCompact(0.9)
+
+    ## Test for searching from many threads
+    # new_buffer.flush()
+    # search_pool = BTreeBufferPool(pst_file)
+    # search_btree = OwnBTree(search_pool, 60, 60, 64, 8, 12, 4, test_btree.root_ref)
+    # search_threads = [threading.Thread(target = search_btree.BTreeSearch, args = (key,)) for key in (0x20, 0x70, 0x120)]
+    # for search_thread in search_threads:
+    #     search_thread.start()
+    # for search_thread in search_threads:
+    #     search_thread.join()
+
+    ## Test for copy-on-write snapshots
+    # cow_btree = OwnBTree(search_pool, 60, 60, 64, 8, 12, 4, test_btree.root_ref, FreeListAllocator(8), False, True)
+    # with cow_btree.snapshot() as view:
+    #     with cow_btree.batch():
+    #         cow_btree.BTreeInsertEntry(bytearray('\x30\x01\x00\x00\x30\x01\x00\x00\x00\x00\x00\x00'))
+    #     print view.BTreeSearch(0x130), cow_btree.BTreeSearch(0x130)
+
+    ## Test for querying many PST files in parallel
+    # query_engine = BTreeQueryEngine(OwnBTree, (60, 60, 64, 8, 12, 4), readRootRef, processes = 4)
+    # for path, values, error in query_engine.searchMany(['test.pst', 'other.pst'], [0x20, 0x70]):
+    #     print path, values, error
+    # query_engine.close()
+
+    ## Test for asynchronous searches
+    # async_btree = BTreeAsync(search_btree)
+    # pending = async_btree.searchAsync(0x20)
+    # print async_btree.searchMany([0x20, 0x70, 0x120]), pending.get()
+    # async_btree.close()
+
+    ## Test for statistics counters
+    # test_btree.enableStats()
+    # test_btree.BTreeInsertEntry(bytearray('\x10\x01\x00\x00\x10\x01\x00\x00\x00\x00\x00\x00'))
+    # print test_btree.getStats()
+    # test_btree.disableStats()
+
+    ## Test for BTreeVerify and BTreeStats
+    # print test_btree.BTreeVerify()
+    # print test_btree.BTreeStats()
+
+    ## Test for recording a trace, replayed with: python BTreeTrace.py test.trace
+    # trace_recorder = BTreeTraceRecorder('test.trace')
+    # test_btree.setTracer(trace_recorder)
+    # test_btree.BTreeSearch(0x32)
+    # test_btree.setTracer(None)
+    # trace_recorder.close()
+
     ## Writing root reference of the BTree from file
-    pst_file.seek(4)
-    pst_file.write(test_btree.toLitteEndian(int(test_btree.root_ref), 4))
+    writeRootRef(new_buffer, int(test_btree.root_ref))
+
+    ## Writing cached nodes back to the file
+    new_buffer.close()
 
     ## Closing the test file for BTree
     pst_file.close()
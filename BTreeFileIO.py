@@ -0,0 +1,112 @@
+#-------------------------------------------------------------------------------
+# Name:        BTreeFileIO
+# Purpose:     File access backends for BTreeBuffer
+#
+# Created:     16/10/2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+import os
+import threading
+
+class BTreeFileIO(object):
+    '''BTreeFileIO is the layer used by BTreeBuffer to read and write bytes of the PST file at given positions.
+       It uses seek followed by read or write on the PST file object, so the position of the file object is shared
+       and it must only be used by one thread at a time.
+       Other ways of accessing the PST file can be plugged into a BTreeBuffer by inheriting this class.'''
+
+    pstfile = None  # The PST file object which is read and written.
+
+    def __init__(self, pstfile):
+        self.pstfile = pstfile
+
+    def read(self, seek_pos, read_size):
+        '''Returns up to 'read_size' bytes of the PST file from 'seek_pos' as a string. Fewer bytes are returned at the end of the file.'''
+        self.pstfile.seek(seek_pos)
+        return self.pstfile.read(read_size)
+
+    def write(self, seek_pos, data):
+        '''Writes the given bytes into the PST file at 'seek_pos'.'''
+        self.pstfile.seek(seek_pos)
+        self.pstfile.write(data)
+
+    def size(self):
+        '''Returns the current size of the PST file in bytes.'''
+        self.pstfile.seek(0, 2)
+        return self.pstfile.tell()
+
+    def flush(self):
+        '''Passes writes buffered in the process on to the operating system.'''
+        self.pstfile.flush()
+
+    def sync(self):
+        '''Flushes the PST file to disk.'''
+        self.pstfile.flush()
+        os.fsync(self.pstfile.fileno())
+
+    def close(self):
+        '''Releases what the backend holds besides the PST file object, which is left open.'''
+        pass
+
+
+class PositionalFileIO(BTreeFileIO):
+    '''PositionalFileIO reads the PST file through descriptors of its own, opened by the path of the PST file object.
+       Every read takes a descriptor which no other read is using, so each reading thread has its own file position
+       and any number of threads can read the PST file at the same time without locking.
+       A descriptor is only opened when all others are in use, so there are never more than the most reads ever made at once.
+       Writes go through the descriptor of the PST file object one at a time.
+       The PST file object must have been opened by path, and must not be written to directly while the backend is in use.'''
+
+    fileno = 0      # File descriptor of the PST file object, used for writes.
+    path = None     # Path of the PST file, from which the read descriptors are opened.
+    readFds = []    # Read descriptors which are not in use by a read.
+    seekLock = None # Lock serialising seek followed by write on the descriptor of the PST file object.
+
+    def __init__(self, pstfile):
+        BTreeFileIO.__init__(self, pstfile)
+        pstfile.flush()
+        self.fileno = pstfile.fileno()
+        self.path = pstfile.name
+        self.readFds = []
+        self.seekLock = threading.Lock()
+
+    def read(self, seek_pos, read_size):
+        '''Returns up to 'read_size' bytes of the PST file from 'seek_pos' as a string. Fewer bytes are returned at the end of the file.'''
+        # list.pop and list.append are atomic, so taking and giving back a descriptor needs no lock.
+        try:
+            read_fd = self.readFds.pop()
+        except IndexError:
+            read_fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.lseek(read_fd, seek_pos, os.SEEK_SET)
+            return os.read(read_fd, read_size)
+        finally:
+            self.readFds.append(read_fd)
+
+    def write(self, seek_pos, data):
+        '''Writes the given bytes into the PST file at 'seek_pos'.'''
+        data = memoryview(data)
+        with self.seekLock:
+            os.lseek(self.fileno, seek_pos, os.SEEK_SET)
+            while len(data) > 0:
+                written = os.write(self.fileno, data)
+                data = data[written:]
+
+    def size(self):
+        '''Returns the current size of the PST file in bytes.'''
+        return os.fstat(self.fileno).st_size
+
+    def flush(self):
+        '''Writes go straight to the operating system, so there is nothing to flush.'''
+        pass
+
+    def sync(self):
+        '''Flushes the PST file to disk.'''
+        os.fsync(self.fileno)
+
+    def close(self):
+        '''Closes the read descriptors. They are opened again by the next reads. No read may be running.'''
+        read_fds = self.readFds
+        self.readFds = []
+        for read_fd in read_fds:
+            os.close(read_fd)
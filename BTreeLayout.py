@@ -0,0 +1,100 @@
+#-------------------------------------------------------------------------------
+# Name:        BTreeLayout
+# Purpose:     Precompiled struct codecs for the nodes of a BTree geometry
+#
+# Created:     16/10/2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+import struct
+import threading
+
+INT_FORMATS = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'} # struct format codes of the integer sizes which can be decoded by struct.
+INT_STRUCTS = dict((size, struct.Struct('<' + code)) for size, code in INT_FORMATS.items()) # Little-endian unsigned integers of each size.
+METADATA_STRUCT = struct.Struct('<BBBB') # cEnt, cEntMax, cbEntMax and cLevel, stored at nodeMetaData.
+
+layouts = {}                    # The NodeLayout of each geometry, shared by all BTrees of that geometry.
+layoutsLock = threading.Lock()  # Lock guarding layouts.
+
+def nodeLayout(nodeEntriesSize, nodeMetaData, nodeSize, entrySize, leafEntrySize, keySize):
+    '''Returns the NodeLayout of the given geometry, building it on the first call for that geometry.'''
+    geometry = (nodeEntriesSize, nodeMetaData, nodeSize, entrySize, leafEntrySize, keySize)
+    with layoutsLock:
+        layout = layouts.get(geometry)
+        if layout == None:
+            layout = NodeLayout(*geometry)
+            layouts[geometry] = layout
+    return layout
+
+
+class NodeLayout(object):
+    '''NodeLayout holds the struct.Struct codecs of the nodes of one BTree geometry, compiled once and shared through nodeLayout.
+       Intermediate entries are decoded as a little-endian key followed by a little-endian child reference filling the rest of the entry,
+       which is what BTree.genIntermediateEntry and BTree.getChildRef read and write unless a subclass overrides them.
+       The codecs read and write the node buffers in place with unpack_from and pack_into.
+       'keyStruct' is None if the key size cannot be decoded by struct, and 'entryStruct' and 'childRefStruct' are None
+       if the key size or the reference size cannot.'''
+
+    nodeEntriesSize = 0     # The actual size of the node bucket to store entries.
+    nodeMetaData = 0        # The offset from the start position of node to its metadata location (in terms of bytes).
+    nodeSize = 0            # The size of node including space required for metadata of node.
+    entrySize = 0           # The size of an intermediate node entry in bytes.
+    leafEntrySize = 0       # The size of an leaf node entry in bytes.
+    keySize = 0             # The size of a key value in an entry in bytes.
+    refSize = 0             # The size of the child reference following the key in an intermediate entry.
+    keyStruct = None        # Decodes a key at a given offset.
+    childRefStruct = None   # Decodes a child reference at a given offset.
+    entryStruct = None      # Encodes and decodes a whole intermediate entry.
+    keyStructs = {}         # Compiled struct.Struct objects decoding all keys of a node, for each (entry size, number of entries).
+
+    def __init__(self, nodeEntriesSize, nodeMetaData, nodeSize, entrySize, leafEntrySize, keySize):
+        self.nodeEntriesSize = nodeEntriesSize
+        self.nodeMetaData = nodeMetaData
+        self.nodeSize = nodeSize
+        self.entrySize = entrySize
+        self.leafEntrySize = leafEntrySize
+        self.keySize = keySize
+        self.refSize = entrySize - keySize
+        self.keyStruct = INT_STRUCTS.get(keySize)
+        self.childRefStruct = INT_STRUCTS.get(self.refSize)
+        self.entryStruct = None
+        if self.keyStruct != None and self.childRefStruct != None:
+            self.entryStruct = struct.Struct('<' + INT_FORMATS[keySize] + INT_FORMATS[self.refSize])
+        else:
+            self.childRefStruct = None
+        self.keyStructs = {}
+
+    def key(self, currentNode, key_index):
+        '''Returns the key stored at offset 'key_index' of the given node or entry.'''
+        return self.keyStruct.unpack_from(currentNode, key_index)[0]
+
+    def childRef(self, currentNode, position):
+        '''Returns the child reference of the intermediate entry at 'position' of the given node.'''
+        return self.childRefStruct.unpack_from(currentNode, position * self.entrySize + self.keySize)[0]
+
+    def packEntry(self, key, child_ref):
+        '''Returns a new intermediate entry holding 'key' and 'child_ref'.'''
+        return bytearray(self.entryStruct.pack(key, child_ref))
+
+    def writeEntry(self, currentNode, position, key, child_ref):
+        '''Writes an intermediate entry holding 'key' and 'child_ref' at 'position' of the given node.'''
+        self.entryStruct.pack_into(currentNode, position * self.entrySize, key, child_ref)
+
+    def metadata(self, currentNode):
+        '''Returns the (cEnt, cEntMax, cbEntMax, cLevel) of the given node.'''
+        return METADATA_STRUCT.unpack_from(currentNode, self.nodeMetaData)
+
+    def writeMetadata(self, currentNode, ent_count, max_ents, ent_size, level):
+        '''Writes the cEnt, cEntMax, cbEntMax and cLevel of the given node.'''
+        METADATA_STRUCT.pack_into(currentNode, self.nodeMetaData, ent_count, max_ents, ent_size, level)
+
+    def keysStruct(self, ent_size, count):
+        '''Returns the struct.Struct decoding the keys of 'count' entries of 'ent_size' bytes, or None if the key size cannot be decoded by struct.'''
+        if self.keyStruct == None:
+            return None
+        key_struct = self.keyStructs.get((ent_size, count))
+        if key_struct == None:
+            # Every entry is decoded as its key followed by padding over the rest of the entry.
+            key_struct = struct.Struct('<' + (INT_FORMATS[self.keySize] + '%dx' % (ent_size - self.keySize)) * count)
+            self.keyStructs[(ent_size, count)] = key_struct
+        return key_struct
@@ -0,0 +1,85 @@
+#-------------------------------------------------------------------------------
+# Name:        BTreeQuery
+# Purpose:     Running BTree queries against many PST files in parallel
+#
+# Created:     16/10/2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+import multiprocessing
+import multiprocessing.pool
+import BTreeBuffer
+
+def runQuery(task):
+    '''Runs one query of a BTreeQueryEngine against the BTree of one PST file and closes the file again.
+       It is run by the workers of the pool, so it has to be a module level function.
+       Returns (path, result, error), where 'error' is None or the message of the exception raised by the query.'''
+    btree_class, geometry, root_reader, sections, buffersize, path, query, args = task
+    try:
+        pst_file = open(path, 'rb')
+        try:
+            btree_buffer = BTreeBuffer.BTreeBuffer(pst_file, sections, buffersize, True)
+            btree = btree_class(btree_buffer, *(tuple(geometry) + (root_reader(btree_buffer),)))
+            result = getattr(btree, query)(*args)
+            if query == 'BTreeScan':
+                result = list(result)
+            btree_buffer.close()
+        finally:
+            pst_file.close()
+    except Exception, error:
+        return path, None, '%s: %s' % (type(error).__name__, error)
+    return path, result, None
+
+
+class BTreeQueryEngine(object):
+    '''BTreeQueryEngine runs the same query against the BTrees of many PST files in a pool of worker processes, or threads.
+       Each worker opens one PST file at a time, read only, with a caching BTreeBuffer of 'sections' buffers of 'buffersize' bytes,
+       so the node cache of a worker never holds more than sections * buffersize bytes.
+       The queries return iterators yielding (path, result, error) for each PST file as soon as its query is done, in no particular order.
+       A PST file whose query fails yields None as result and the message of the exception as error, and the other files carry on.'''
+
+    btree_class = None      # The BTree subclass opening the BTree of each PST file, e.g. OwnBTree. The workers must be able to import it.
+    geometry = ()           # The nodeEntriesSize, nodeMetaData, nodeSize, entrySize, leafEntrySize and keySize of the BTrees, in this order.
+    root_reader = None      # Module level function returning the root reference of the BTree, given the BTreeBuffer of its PST file.
+    sections = 0            # Number of buffers of the BTreeBuffer of each worker.
+    buffersize = 0          # Size of the buffers of the BTreeBuffer of each worker.
+    pool = None             # The multiprocessing pool running the queries.
+
+    def __init__(self, btree_class, geometry, root_reader, processes = None, sections = 64, buffersize = 3850, use_threads = False):
+        self.btree_class = btree_class
+        self.geometry = tuple(geometry)
+        self.root_reader = root_reader
+        self.sections = sections
+        self.buffersize = buffersize
+        if use_threads:
+            self.pool = multiprocessing.pool.ThreadPool(processes)
+        else:
+            self.pool = multiprocessing.Pool(processes)
+
+    def runQueries(self, paths, query, args):
+        '''Starts the BTree method named 'query' with the given arguments against each PST file in 'paths'.
+           Returns an iterator over the (path, result, error) of each file, in the order the queries finish.'''
+        tasks = [(self.btree_class, self.geometry, self.root_reader, self.sections, self.buffersize, path, query, args) for path in paths]
+        return self.pool.imap_unordered(runQuery, tasks)
+
+    def searchMany(self, paths, keys):
+        '''Looks up the given keys in each PST file. The result of a file is the list returned by BTreeSearchMany.'''
+        return self.runQueries(paths, 'BTreeSearchMany', (list(keys),))
+
+    def scan(self, paths, low_key = None, high_key = None):
+        '''Scans the given key range of each PST file. The result of a file is the list of (key, value) pairs yielded by BTreeScan.'''
+        return self.runQueries(paths, 'BTreeScan', (low_key, high_key))
+
+    def export(self, paths):
+        '''Reads all leaf entries of each PST file. The result of a file is the list of its (key, value) pairs in key order.'''
+        return self.scan(paths)
+
+    def close(self):
+        '''Waits for the queries started so far and stops the workers.'''
+        self.pool.close()
+        self.pool.join()
+
+    def terminate(self):
+        '''Stops the workers at once, dropping the queries which have not finished.'''
+        self.pool.terminate()
+        self.pool.join()
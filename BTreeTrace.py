@@ -0,0 +1,257 @@
+#-------------------------------------------------------------------------------
+# Name:        BTreeTrace
+# Purpose:     Recording BTree node access traces and replaying them against node caches
+#
+# Created:     16/10/2026
+# Licence:     <your licence>
+#-------------------------------------------------------------------------------
+
+import argparse
+import collections
+import json
+import struct
+import threading
+import BTree
+
+TRACE_MAGIC = 'BTTR'                    # The first bytes of a trace file.
+TRACE_VERSION = 1                       # The version of the trace file format written by BTreeTraceRecorder.
+TRACE_HEADER = struct.Struct('<4sH')    # Magic and version at the start of a trace file.
+TRACE_RECORD = struct.Struct('<BhQI')   # Operation code, node level, node reference and duration in microseconds of each event.
+TRACE_OPERATIONS = BTree.BTree.traceOperations # The operation code of an event is the index of its operation in this tuple.
+REPLAY_POLICIES = ('lru', 'fifo', 'clock')
+
+class BTreeTraceError(RuntimeError):
+    '''Class to raise BTreeTrace Errors.'''
+    'problem in trace file'
+
+
+class BTreeTracer(object):
+    '''BTreeTracer is the tracer set on a BTree by BTree.setTracer. It calls each of its callbacks with every event it is given,
+       as callback(operation, node_ref, level, seconds). Other tracers can be made by inheriting this class and overriding traceEvent.'''
+
+    callbacks = []  # The functions called with every event.
+
+    def __init__(self, callbacks = ()):
+        self.callbacks = list(callbacks)
+
+    def addCallback(self, callback):
+        '''Calls 'callback' with every following event.'''
+        self.callbacks.append(callback)
+
+    def traceEvent(self, operation, node_ref, level, seconds):
+        '''Called by the BTree after each call of one of its traceOperations.'''
+        for callback in self.callbacks:
+            callback(operation, node_ref, level, seconds)
+
+
+class BTreeTraceRecorder(BTreeTracer):
+    '''BTreeTraceRecorder writes the events of a BTree into a binary trace file, which can be read back with readTrace and replayed with replayTrace.
+       Each event takes TRACE_RECORD.size bytes. Node references must fit in 8 bytes and levels in two signed bytes,
+       and durations are stored in whole microseconds. The events of many threads are written one at a time.'''
+
+    traceFile = None    # The trace file object being written.
+    traceLock = None    # Lock serialising the writes of the events of many threads.
+    eventCount = 0      # Number of events written so far.
+
+    def __init__(self, path, callbacks = ()):
+        BTreeTracer.__init__(self, callbacks)
+        self.traceFile = open(path, 'wb')
+        self.traceFile.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION))
+        self.traceLock = threading.Lock()
+        self.eventCount = 0
+
+    def traceEvent(self, operation, node_ref, level, seconds):
+        record = TRACE_RECORD.pack(TRACE_OPERATIONS.index(operation), level, node_ref, min(int(seconds * 1000000), 0xFFFFFFFF))
+        with self.traceLock:
+            self.traceFile.write(record)
+            self.eventCount = self.eventCount + 1
+        BTreeTracer.traceEvent(self, operation, node_ref, level, seconds)
+
+    def close(self):
+        '''Writes the remaining events and closes the trace file. The recorder must be removed from the BTree first, with setTracer(None).'''
+        with self.traceLock:
+            self.traceFile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def readTrace(path):
+    '''Yields the (operation, node_ref, level, seconds) of each event of a trace file written by BTreeTraceRecorder, in the order they happened.'''
+    trace_file = open(path, 'rb')
+    try:
+        header = trace_file.read(TRACE_HEADER.size)
+        if len(header) != TRACE_HEADER.size:
+            raise BTreeTraceError, 'Not a trace file'
+        magic, version = TRACE_HEADER.unpack(header)
+        if magic != TRACE_MAGIC:
+            raise BTreeTraceError, 'Not a trace file'
+        if version != TRACE_VERSION:
+            raise BTreeTraceError, 'Unsupported trace file version %d' % version
+        while True:
+            records = trace_file.read(TRACE_RECORD.size * 4096)
+            if len(records) % TRACE_RECORD.size != 0:
+                raise BTreeTraceError, 'Truncated trace file'
+            if not records:
+                break
+            for offset in xrange(0, len(records), TRACE_RECORD.size):
+                code, level, node_ref, microseconds = TRACE_RECORD.unpack_from(records, offset)
+                yield TRACE_OPERATIONS[code], node_ref, level, microseconds / 1000000.0
+    finally:
+        trace_file.close()
+
+
+class ReplayCache(object):
+    '''ReplayCache simulates the node cache of a caching BTreeBuffer with 'sections' buffers, evicting nodes by the given policy:
+       'lru' evicts the least recently used node, as BTreeBuffer does, 'fifo' the node cached first,
+       and 'clock' the node cached first which was not used again since it was last passed over.
+       Written nodes stay in the cache and are only written to the PST file when evicted or flushed, as in BTreeBuffer.
+       The buffers pinned by the BTree while it works on a node are not simulated, so every buffer can hold a cached node.
+       With 0 sections nothing is cached, as with a BTreeBuffer which does not cache nodes.'''
+
+    sections = 0        # Number of nodes the cache can hold.
+    policy = 'lru'      # The eviction policy, one of REPLAY_POLICIES.
+    nodes = None        # Maps the reference of each cached node to [dirty, referenced], in the order nodes are evicted.
+    counters = None     # Maps the name of each counter of the replay to its value.
+    levelMisses = None  # Maps each node level to the number of reads of nodes of that level which missed the cache.
+
+    def __init__(self, sections, policy = 'lru'):
+        if policy not in REPLAY_POLICIES:
+            raise BTreeTraceError, 'Unknown eviction policy %s' % policy
+        self.sections = sections
+        self.policy = policy
+        self.nodes = collections.OrderedDict()
+        self.counters = dict.fromkeys(('reads', 'hits', 'misses', 'writes', 'file_writes', 'evictions', 'discards'), 0)
+        self.levelMisses = {}
+
+    def read(self, node_ref, level):
+        '''Reads a node, from the cache if it holds it.'''
+        self.count('reads')
+        if node_ref in self.nodes:
+            self.count('hits')
+            self.useNode(node_ref)
+            return
+        self.count('misses')
+        self.levelMisses[level] = self.levelMisses.get(level, 0) + 1
+        self.cacheNode(node_ref, False)
+
+    def write(self, node_ref):
+        '''Writes a node, into the cache if caching.'''
+        self.count('writes')
+        if node_ref in self.nodes:
+            self.nodes[node_ref][0] = True
+            self.useNode(node_ref)
+        else:
+            self.cacheNode(node_ref, True)
+
+    def discard(self, node_ref):
+        '''Drops a deleted node from the cache without writing it.'''
+        if self.nodes.pop(node_ref, None) != None:
+            self.count('discards')
+
+    def useNode(self, node_ref):
+        '''Records a use of a cached node for the eviction policy.'''
+        if self.policy == 'lru':
+            self.nodes[node_ref] = self.nodes.pop(node_ref)
+        elif self.policy == 'clock':
+            self.nodes[node_ref][1] = True
+
+    def cacheNode(self, node_ref, dirty):
+        '''Puts a node into the cache, evicting another node if the cache is full.'''
+        if self.sections == 0:
+            if dirty:
+                self.count('file_writes')
+            return
+        if len(self.nodes) == self.sections:
+            self.evictNode()
+        self.nodes[node_ref] = [dirty, False]
+
+    def evictNode(self):
+        '''Evicts a node chosen by the eviction policy, writing it to the PST file if it was changed.'''
+        while True:
+            node_ref, state = self.nodes.popitem(False)
+            if self.policy == 'clock' and state[1]:
+                state[1] = False
+                self.nodes[node_ref] = state
+                continue
+            break
+        self.count('evictions')
+        if state[0]:
+            self.count('file_writes')
+
+    def flush(self):
+        '''Writes all changed nodes to the PST file, as BTreeBuffer.flush does.'''
+        for state in self.nodes.values():
+            if state[0]:
+                self.count('file_writes')
+                state[0] = False
+
+    def count(self, counter):
+        self.counters[counter] = self.counters[counter] + 1
+
+    def report(self):
+        '''Returns the counters of the replay as a dictionary, with the hit ratio of the reads and the misses of each level.
+           'misses' is the number of reads of the PST file and 'file_writes' the number of writes.'''
+        report = dict(self.counters)
+        report['sections'] = self.sections
+        report['policy'] = self.policy
+        report['hit_ratio'] = float(self.counters['hits']) / self.counters['reads'] if self.counters['reads'] else 0.0
+        report['level_misses'] = dict(self.levelMisses)
+        return report
+
+
+def replayTrace(events, sections, policy = 'lru'):
+    '''Replays the node reads, writes and deletions of the given events, e.g. from readTrace, against a ReplayCache
+       of 'sections' nodes evicted by 'policy'. Returns the report of the cache after flushing it.'''
+    cache = ReplayCache(sections, policy)
+    for operation, node_ref, level, seconds in events:
+        if operation == 'readNodeIntoBuffer':
+            cache.read(node_ref, level)
+        elif operation == 'writeNodeFromBuffer':
+            cache.write(node_ref)
+        elif operation == 'delNodeAllocation':
+            cache.discard(node_ref)
+    cache.flush()
+    return cache.report()
+
+def summarizeTrace(events):
+    '''Returns the number of events, total seconds and distinct nodes of each operation in the given events,
+       and the number of distinct nodes read, which is the number of buffers needed to never read a node twice.'''
+    operations = {}
+    nodes_read = set()
+    for operation, node_ref, level, seconds in events:
+        summary = operations.setdefault(operation, {'count': 0, 'seconds': 0.0})
+        summary['count'] = summary['count'] + 1
+        summary['seconds'] = summary['seconds'] + seconds
+        if operation == 'readNodeIntoBuffer':
+            nodes_read.add(node_ref)
+    return {'operations': operations, 'distinct_nodes_read': len(nodes_read)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Replays a BTree trace file against node caches of different sizes and eviction policies.')
+    parser.add_argument('trace', help = 'path of a trace file written by BTreeTraceRecorder')
+    parser.add_argument('--sections', type = int, nargs = '+', default = [16, 64, 256, 1024], help = 'numbers of buffers of the simulated caches')
+    parser.add_argument('--policies', nargs = '+', default = list(REPLAY_POLICIES), choices = REPLAY_POLICIES)
+    parser.add_argument('--output', help = 'path of the JSON report to write')
+    args = parser.parse_args()
+
+    report = {'summary': summarizeTrace(readTrace(args.trace)), 'replays': []}
+    print 'events %d  distinct nodes read %d' % (sum(summary['count'] for summary in report['summary']['operations'].values()),
+                                                 report['summary']['distinct_nodes_read'])
+    for sections in args.sections:
+        for policy in args.policies:
+            result = replayTrace(readTrace(args.trace), sections, policy)
+            report['replays'].append(result)
+            print '%6d sections  %-6s hit ratio %6.3f  file reads %8d  file writes %8d  evictions %8d' % \
+                  (sections, policy, result['hit_ratio'], result['misses'], result['file_writes'], result['evictions'])
+    if args.output:
+        report_file = open(args.output, 'w')
+        json.dump(report, report_file, indent = 2, sort_keys = True)
+        report_file.close()
+
+if __name__ == '__main__':
+    main()